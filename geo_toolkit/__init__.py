@@ -1,14 +1,122 @@
 from .geo_library import (
     logger,
+    ND_SCALE,
+    ND_NODATA,
+    ND_FLOAT_NODATA,
+    resample_band,
+    write_band,
     resample_persist_band,
     resample_bands,
+    crop_band,
     crop_persist_band,
     crop_bands,
+    get_band_name,
     load_band_image,
     load_bands,
+    normalized_difference,
+    select_nd_bands,
     compute_ndvi,
     compute_ndwi,
-    generate_persist_ndmap    
+    generate_persist_ndmap,
+    persist_ndmap,
+    load_ndmap,
+    threshold_ndmap,
+    normalized_difference_mask,
+    compute_ndmap_mask
+)
+from .io_pipeline import run_pipelined
+from .product_catalog import (
+    parse_band_filename,
+    find_band_files,
+    read_band_header,
+    build_product_catalog,
+    load_product_catalog,
+    query_products,
+    finest_band_entries
+)
+from .shared_cube import (
+    SharedBandCube,
+    iter_row_blocks,
+    map_blocks
+)
+from .quicklook import (
+    raster_overview,
+    read_raster_overview,
+    write_png,
+    render_quicklook
+)
+from .results_catalog import (
+    create_results_catalog,
+    export_lakes_catalog,
+    query_catalog_bbox,
+    query_catalog_point
+)
+from .water_service import (
+    SceneCache,
+    query_water_polygon,
+    query_water_mask,
+    create_water_server,
+    serve_water_queries
+)
+from .streaming import (
+    iter_block_windows,
+    iter_band_blocks,
+    stream_water_mask,
+    vectorize_label_blocks,
+    stream_water_polygons
+)
+from .prescreen import (
+    read_band_quicklook,
+    prescreen_scene
+)
+from .mask_processing import (
+    remove_small_components,
+    fill_small_holes,
+    clean_water_mask
+)
+from .spectral_transform import (
+    TASSELED_CAP_S2,
+    apply_linear_transform,
+    tasseled_cap,
+    StreamingPCA,
+    fit_pca_streaming,
+    persist_components
+)
+from .classifier_inference import (
+    load_classifier,
+    build_pixel_features,
+    predict_raster,
+    persist_probability
+)
+from .mosaic import (
+    group_band_paths,
+    read_mosaic_band,
+    load_mosaic_bands
+)
+from .raster_stats import (
+    RunningStats,
+    compute_raster_stats,
+    write_stats_sidecar,
+    load_stats_sidecar,
+    get_raster_stats,
+    otsu_threshold,
+    normalize_array
+)
+from .zonal_stats import (
+    label_water_mask,
+    vectorize_labels,
+    label_perimeters,
+    zonal_statistics,
+    attach_zonal_stats
+)
+from .memory_budget import (
+    parse_memory_size,
+    available_memory,
+    MemoryBudget
+)
+from .contour_vectorizer import (
+    contour_field,
+    contour_polygons
 )
 
 __version__ = "0.1.0"
@@ -0,0 +1,221 @@
+"""This module contains the functions to apply a serialized
+per-pixel classifier to a band cube, as the supervised
+alternative to NDWI thresholding (see README, Step 3).
+Supported models are scikit-learn estimators persisted with
+joblib (e.g., logistic regression, random forest, MLP) and
+ONNX models run with onnxruntime (optional dependency).
+Features (bands and derived indices) are built on the fly
+for fixed-size pixel batches, which are predicted on a thread pool;
+memory is bounded by batch_size * n_jobs.
+The output probability raster is persisted like an ND map,
+so that step 3 can threshold it.
+These functions are implemented and documented:
+
+    load_classifier()
+    build_pixel_features()
+    predict_raster()
+    persist_probability()
+
+Author: Mikel Sagardia
+Date: 2023-04-26
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import joblib
+import numpy as np
+import rasterio as rio
+
+from .geo_library import (
+    logger,
+    normalized_difference
+)
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+# Derived indices which can be used as features: (band A, band B)
+# of the normalized difference (A - B) / (A + B)
+FEATURE_INDICES = {"ndwi": ('03', '8A'),
+                   "ndvi": ('08', '04'),
+                   "mndwi": ('03', '11')}
+BATCH_SIZE = 65536
+PROBABILITY_NODATA = -9999
+
+
+class _OnnxClassifier:
+    """Adapter which exposes predict_proba() for an ONNX classifier
+    (e.g., converted with skl2onnx); onnxruntime releases the GIL,
+    so batches run in parallel on the thread pool.
+
+    Args:
+        path (str): path of the ONNX model
+    """
+    def __init__(self, path):
+        self.session = onnxruntime.InferenceSession(path,
+                                                    providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict_proba(self, features):
+        """Class probabilities of a batch of features (samples, features)."""
+        outputs = self.session.run(None, {self.input_name: features})
+        probabilities = outputs[-1]
+        # skl2onnx ZipMap output: list of {class: probability}
+        if isinstance(probabilities, list):
+            probabilities = np.array([list(row.values()) for row in probabilities])
+        return np.asarray(probabilities)
+
+
+def load_classifier(path):
+    """Load a serialized per-pixel classifier.
+
+    - `*.onnx`: ONNX model; requires onnxruntime.
+    - otherwise: joblib file with either an estimator or a dictionary
+      {'model': estimator, 'feature_names': [...]}.
+
+    Args:
+        path (str): path of the model file
+
+    Returns:
+        model (object): model with predict_proba() or predict()
+        feature_names (list[str]): feature names the model was trained
+            with, if stored in the file; else None
+    """
+    if path.endswith(".onnx"):
+        try:
+            assert onnxruntime is not None
+        except AssertionError as err:
+            logger.error("load_classifier: onnxruntime is required for %s", path)
+            raise err
+        return _OnnxClassifier(path), None
+
+    content = joblib.load(path)
+    if isinstance(content, dict):
+        return content["model"], content.get("feature_names")
+
+    return content, None
+
+
+def build_pixel_features(cube, band_names, feature_names, start, stop):
+    """Build the feature matrix of a batch of pixels.
+
+    Args:
+        cube (numpy.ndarray): band cube as (band, pixels)
+        band_names (list[str]): band names associated to the cube rows
+        feature_names (list[str]): band names ('02', '8A', ...) and/or
+            index names (keys of FEATURE_INDICES)
+        start (int): first pixel of the batch
+        stop (int): last pixel (excluded) of the batch
+
+    Returns:
+        features (numpy.ndarray): float32 array (pixels, features)
+    """
+    features = np.empty((stop - start, len(feature_names)), dtype=np.float32)
+    for i, name in enumerate(feature_names):
+        if name in FEATURE_INDICES:
+            band_a, band_b = FEATURE_INDICES[name]
+            features[:, i] = normalized_difference(
+                cube[band_names.index(band_a), start:stop],
+                cube[band_names.index(band_b), start:stop],
+                compact=False)
+        else:
+            features[:, i] = cube[band_names.index(name), start:stop]
+
+    return features
+
+
+def predict_raster(model,
+                   images,
+                   band_names,
+                   feature_names,
+                   batch_size=BATCH_SIZE,
+                   n_jobs=4,
+                   positive_class=1):
+    """Apply a per-pixel classifier to a band cube
+    in fixed-size pixel batches on a thread pool.
+    Pixels where all bands are 0 are set to PROBABILITY_NODATA.
+
+    Args:
+        model (object): classifier with predict_proba() or predict()
+        images (numpy.ndarray): band cube (band, height, width)
+        band_names (list[str]): band names associated to the images
+        feature_names (list[str]): features of the model, in order
+            (see build_pixel_features())
+        batch_size (int): number of pixels per batch (default: 65536)
+        n_jobs (int): number of threads (default: 4)
+        positive_class (int): class whose probability is returned
+            (default: 1, water)
+
+    Returns:
+        probability (numpy.ndarray): float32 array (height, width) with the
+            probability of positive_class (or the predicted class
+            if the model has no predict_proba())
+        stats (dict): pixels, seconds and pixels_per_second
+    """
+    required = {band for name in feature_names
+                for band in FEATURE_INDICES.get(name, (name,))}
+    try:
+        assert required.issubset(band_names)
+    except AssertionError as err:
+        logger.error("predict_raster: bands %s are required, available: %s",
+                     sorted(required), band_names)
+        raise err
+
+    _, height, width = images.shape
+    num_pixels = height * width
+    cube = images.reshape(images.shape[0], num_pixels)
+    probability = np.empty(num_pixels, dtype=np.float32)
+    class_index = None
+    if hasattr(model, "predict_proba") and hasattr(model, "classes_"):
+        class_index = list(model.classes_).index(positive_class)
+
+    def predict_batch(start):
+        stop = min(start + batch_size, num_pixels)
+        features = build_pixel_features(cube, band_names, feature_names, start, stop)
+        if hasattr(model, "predict_proba"):
+            result = model.predict_proba(features)
+            result = result[:, positive_class if class_index is None else class_index]
+        else:
+            result = model.predict(features)
+        probability[start:stop] = result
+        probability[start:stop][~cube[:, start:stop].any(axis=0)] = PROBABILITY_NODATA
+
+    tic = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        # list() propagates the exceptions of the batches
+        list(executor.map(predict_batch, range(0, num_pixels, batch_size)))
+    seconds = time.perf_counter() - tic
+
+    stats = {"pixels": num_pixels,
+             "seconds": seconds,
+             "pixels_per_second": num_pixels / seconds if seconds > 0 else float("inf")}
+    logger.info("predict_raster: %d pixels classified in %.2f s (%.0f pixels/s).",
+                num_pixels, seconds, stats["pixels_per_second"])
+
+    return probability.reshape(height, width), stats
+
+
+def persist_probability(probability, profile, output_path):
+    """Persist a probability/class raster as float32,
+    like the ND maps, so that step 3 can load and threshold it.
+
+    Args:
+        probability (numpy.ndarray): array (height, width)
+        profile (dict): profile dictionary of the source bands
+        output_path (str): file path to persist the raster
+
+    Returns:
+        probability_profile (dict): profile of the persisted raster
+    """
+    probability_profile = profile.copy()
+    probability_profile.update({'driver': 'GTiff',
+                                'count': 1,
+                                'dtype': 'float32',
+                                'nodata': PROBABILITY_NODATA})
+    with rio.open(output_path, 'w', **probability_profile) as dst:
+        dst.write(probability.astype(np.float32), 1)
+    logger.info("persist_probability: probability raster saved: %s", output_path)
+
+    return probability_profile
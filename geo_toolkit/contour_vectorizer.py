@@ -0,0 +1,173 @@
+"""This module contains the sub-pixel contour vectorizer,
+an alternative to rasterio.features.shapes(), which traces the
+pixel edges of the water mask (staircase polygons with a vertex
+at every pixel corner). Marching squares (skimage.measure.find_contours)
+run on the continuous ND map (or water probability) at the threshold,
+so the shorelines are interpolated between pixel centers;
+an optional topology-preserving simplification to a tolerance
+in map units reduces the vertices further. Rings are classified
+as exteriors or holes by their orientation and holes are assigned
+to the smallest exterior which contains them; the polygons are
+valid shapely polygons in the raster CRS (affine transform).
+These functions are implemented and documented:
+
+    contour_field()
+    contour_polygons()
+
+Author: Mikel Sagardia
+Date: 2023-05-05
+"""
+import numpy as np
+import geopandas as gpd
+import pandas as pd
+import shapely
+from shapely.geometry import Polygon
+from skimage import measure
+
+from .geo_library import logger, ND_SCALE, ND_NODATA
+
+# Offset from the threshold of the pixels forced by the mask
+FORCE_OFFSET = 1e-3
+
+
+def contour_field(ndmap, threshold, mask=None):
+    """Prepare the float32 field of the contours: compact (int16) ND maps
+    are unscaled, invalid pixels (ND_NODATA, NaN) are set below the
+    threshold and, if a (cleaned) mask is given, the pixels which
+    disagree with it are moved just across the threshold, so that the
+    contours follow the topology of the mask and stay sub-pixel elsewhere.
+    The field is padded with one pixel below the threshold,
+    so that all the contours are closed.
+
+    Args:
+        ndmap (numpy.ndarray): ND map or water probability (height, width)
+        threshold (float): value above which a pixel is water
+        mask (numpy.ndarray): binary water mask (e.g., the output of
+            clean_water_mask()) (default: None)
+
+    Returns:
+        field (numpy.ndarray): float32 array (height+2, width+2)
+    """
+    below = np.float32(threshold - FORCE_OFFSET)
+    above = np.float32(threshold + FORCE_OFFSET)
+    field = np.full((ndmap.shape[0] + 2, ndmap.shape[1] + 2), below - 1, dtype=np.float32)
+    inner = field[1:-1, 1:-1]
+    if ndmap.dtype == np.int16:
+        np.divide(ndmap, ND_SCALE, out=inner, dtype=np.float32)
+        inner[ndmap == ND_NODATA] = below - 1
+    else:
+        inner[...] = ndmap
+        inner[~np.isfinite(inner)] = below - 1
+    if mask is not None:
+        water = mask > 0
+        np.minimum(inner, below, out=inner, where=~water)
+        np.maximum(inner, above, out=inner, where=water)
+
+    return field
+
+
+def _polygon_labels(polygons, labels, transform):
+    """Label of the component contained in each polygon: one pixel center
+    per label is matched to the polygon which contains it. Pixel centers
+    of a component lie strictly inside its (unsimplified) contour."""
+    label_values, first = np.unique(labels.ravel(), return_index=True)
+    keep = label_values > 0
+    label_values, first = label_values[keep], first[keep]
+    rows, cols = np.divmod(first, labels.shape[1])
+    xs, ys = transform * (cols + 0.5, rows + 0.5)
+    point_index, polygon_index = shapely.STRtree(polygons).query(shapely.points(xs, ys),
+                                                                 predicate="within")
+    polygon_labels = np.full(len(polygons), -1, dtype=np.int64)
+    polygon_labels[polygon_index] = label_values[point_index]
+    missing = polygon_labels < 0
+    if missing.any():
+        logger.warning("contour_polygons: %d polygons without a component label.",
+                       int(missing.sum()))
+
+    return polygon_labels
+
+
+def contour_polygons(ndmap,
+                     threshold,
+                     transform,
+                     mask=None,
+                     simplify_tolerance=None,
+                     labels=None,
+                     crs=None):
+    """Vectorize the water regions of an ND map (values above the
+    threshold) with sub-pixel marching squares contours.
+    Water regions are 4-connected, as in rasterio.features.shapes().
+
+    Args:
+        ndmap (numpy.ndarray): ND map or water probability; float or
+            compact int16 scaled by ND_SCALE (height, width)
+        threshold (float): value above which a pixel is water
+        transform (affine.Affine): transform of the ND map
+        mask (numpy.ndarray): cleaned binary water mask which the contours
+            follow (see contour_field()) (default: None)
+        simplify_tolerance (float): tolerance in map units of the
+            topology-preserving simplification; None: no simplification
+            (default: None)
+        labels (numpy.ndarray): label image of mask (see label_water_mask());
+            if given, the polygons are indexed by component label; the parts
+            of a component split by the simplification share its label
+            (default: None)
+        crs (object): CRS of the polygons (default: None)
+
+    Returns:
+        water_geoseries (geopandas.GeoSeries): valid water polygons with holes
+    """
+    field = contour_field(ndmap, threshold, mask)
+    contours = measure.find_contours(field, level=threshold,
+                                     fully_connected='low',
+                                     positive_orientation='high')
+    # With positive_orientation='high', exteriors are clockwise in (col, row);
+    # a transform with negative determinant (north-up) flips the orientation
+    exterior_ccw = transform.determinant < 0
+
+    exteriors = []
+    holes = []
+    for contour in contours:
+        if len(contour) < 4:
+            continue
+        # Padded (row, col) -> pixel centers of the ND map -> map coordinates
+        xs, ys = transform * (contour[:, 1] - 0.5, contour[:, 0] - 0.5)
+        ring = shapely.linearrings(np.column_stack([xs, ys]))
+        if ring.is_ccw == exterior_ccw:
+            exteriors.append(ring)
+        else:
+            holes.append(ring)
+
+    # Each hole belongs to the smallest exterior which contains it;
+    # a vertex of the hole is tested, since islands may fill its inside
+    exterior_polygons = shapely.polygons(exteriors)
+    interiors = [[] for _ in exteriors]
+    if holes and exteriors:
+        tree = shapely.STRtree(exterior_polygons)
+        hole_points = shapely.get_point(holes, 0)
+        hole_index, exterior_index = tree.query(hole_points, predicate="within")
+        areas = shapely.area(exterior_polygons)
+        parents = {}
+        for hole, exterior in zip(hole_index, exterior_index):
+            if hole not in parents or areas[exterior] < areas[parents[hole]]:
+                parents[hole] = exterior
+        for hole, exterior in parents.items():
+            interiors[exterior].append(holes[hole])
+
+    polygons = [Polygon(exterior, rings) for exterior, rings in zip(exteriors, interiors)]
+    # Labels are matched before simplification, where they are exact
+    index = None
+    if labels is not None:
+        index = pd.Index(_polygon_labels(polygons, labels, transform), name="label")
+    if simplify_tolerance:
+        polygons = shapely.simplify(polygons, simplify_tolerance, preserve_topology=True)
+    polygons = shapely.make_valid(polygons)
+    # make_valid may split a polygon; the polygonal parts keep its label
+    water_geoseries = gpd.GeoSeries(polygons, index=index, crs=crs).explode(index_parts=False)
+    water_geoseries = water_geoseries[water_geoseries.geom_type == "Polygon"]
+    if labels is None:
+        water_geoseries = water_geoseries.reset_index(drop=True)
+    logger.info("contour_polygons: %d water polygons with %d vertices extracted.",
+                len(water_geoseries), int(shapely.get_num_coordinates(water_geoseries.values).sum()))
+
+    return water_geoseries
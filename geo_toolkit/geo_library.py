@@ -2,15 +2,26 @@
 process geospatial rasters. Specifically,
 these functions are implemented and documented:
 
+    resample_band()
+    write_band()
     resample_persist_band()
     resample_bands()
+    crop_band()
     crop_persist_band()
     crop_bands()
+    get_band_name()
     load_band_image()
     load_bands()
+    normalized_difference()
+    select_nd_bands()
     compute_ndvi()
     compute_ndwi()
     generate_persist_ndmap()
+    persist_ndmap()
+    load_ndmap()
+    threshold_ndmap()
+    normalized_difference_mask()
+    compute_ndmap_mask()
 
 Pylint: 9.29/10.
 
@@ -33,6 +44,8 @@ from rasterio.mask import mask
 from rasterio.transform import Affine
 
 from .resample_raster import resample_res
+from .io_pipeline import run_pipelined
+from .product_catalog import parse_band_filename
 
 # Logging configuration
 logging.basicConfig(
@@ -44,14 +57,53 @@ logging.basicConfig(
 # Thi will be imported in the rest of the modules
 logger = logging.getLogger()
 
+# Compact ND maps: int16 = round(index * ND_SCALE), ND_NODATA reserved
+ND_SCALE = 10000
+ND_NODATA = -32768
+# Float ND maps: nodata value of the persisted float32 rasters
+ND_FLOAT_NODATA = -9999
+# Number of pixels processed at once by the fused ND mask kernel
+FUSED_CHUNK_SIZE = 2**18
+
+
+def resample_band(input_path, resolution=(60,60)):
+    """Load a band pixelmap resampled to the specified resolution.
+
+    Args:
+        input_path (str): input filename of the band/channel image pixelmap
+        resolution (tuple[float]): x and y resolution to resample
+
+    Returns:
+        img (numpy.ndarray): resampled band array (1, height, width)
+        profile (dict): profile of the resampled band
+    """
+    with rio.open(input_path, 'r') as src:
+        img, profile = resample_res(src, resolution[0], resolution[1])
+
+    return img, profile
+
+
+def write_band(output_path, img, profile):
+    """Persist a band pixelmap.
+
+    Args:
+        output_path (str): output filename of the band/channel image pixelmap
+        img (numpy.ndarray): band array (1, height, width)
+        profile (dict): profile of the band
+
+    Returns: None
+    """
+    with rio.open(output_path, "w", **profile) as dataset:
+        dataset.write(img)
+
 
-# FIXME: refactor to two functions: resample & persist and use persistence manager
 def resample_persist_band(input_path,
                           output_path,
                           resolution=(60,60)):
     """Resample band pixelmap to specified resolution
     and persist.
-    
+    This function uses resample_band() and write_band().
+
     Args:
         input_path (str): input filename of the band/channel image pixelmap
         output_path (str): output filename of the band/channel image pixelmap
@@ -59,18 +111,15 @@ def resample_persist_band(input_path,
 
     Returns: None
     """
-    xres = resolution[0]
-    yres = resolution[1]
-    with rio.open(input_path, 'r') as src:
-        img, profile = resample_res(src, xres, yres)
-
-    with rio.open(output_path, "w", **profile) as dataset:
-        dataset.write(img)
+    img, profile = resample_band(input_path, resolution)
+    write_band(output_path, img, profile)
 
 
 def resample_bands(band_paths,
                    resolution=(60,60),
-                   output_folder="processed"):
+                   output_folder="processed",
+                   pipelined=False,
+                   read_ahead=2):
     """Resample band pixelmaps to specified resolution
     and persist them all. This function uses resample_persist_band().
 
@@ -80,11 +129,19 @@ def resample_bands(band_paths,
             Defaults to (60,60).
         output_folder (str): local folder into which resampled bands are saved.
             Defaults to "processed".
+        pipelined (bool): if True, the next bands are read and resampled
+            while the previous ones are written in a background thread
+            (see run_pipelined()). Defaults to False.
+        read_ahead (int): maximum number of bands read ahead and waiting
+            to be written when pipelined, e.g., the workers planned by
+            MemoryBudget.plan_scene(). Defaults to 2.
 
-    Returns: None.
+    Returns:
+        output_paths (list[str]): paths of the resampled bands,
+            in the order of band_paths.
     """
     # Extract scene path
-    scene_path = os.path.join(*band_paths[0].split(os.sep)[:-1])
+    scene_path = os.path.dirname(band_paths[0])
 
     # FIXME: refactor to function?
     # Create a folder to store all processed images images
@@ -96,32 +153,44 @@ def resample_bands(band_paths,
                     output_folder)
 
     # Resample and save all files
+    jobs = []
+    output_paths = []
     for band in band_paths:
         input_file = band
         filename = input_file.split(os.sep)[-1]
         output_file = os.path.join(scene_path, output_folder, filename)
+        output_paths.append(output_file)
         try:
             assert os.path.isfile(input_file)
-            resample_persist_band(input_path=input_file,
-                                  output_path=output_file,
-                                  resolution=resolution)
+            if pipelined:
+                jobs.append((input_file, output_file))
+            else:
+                resample_persist_band(input_path=input_file,
+                                      output_path=output_file,
+                                      resolution=resolution)
         except AssertionError as err:
             logger.error("resample_bands: input_file does not exist: %s",
                          input_file)
             raise err
 
+    if pipelined:
+        run_pipelined(jobs,
+                      read=lambda job: resample_band(job[0], resolution),
+                      write=lambda job, result: write_band(job[1], *result),
+                      read_ahead=read_ahead,
+                      write_behind=read_ahead)
+
     logger.info("resample_bands: bands correctly resampled and persisted!")
 
+    return output_paths
 
-# FIXME: refactor to two functions: crop & persist and use persistence manager
-def crop_persist_band(input_path, output_path, shapes):
-    """Load band from input path,
-    crop it according to the geometries in shapes
-    and persist to filepath in output_path.
+
+def crop_band(input_path, shapes):
+    """Load band from input path and crop it
+    according to the geometries in shapes.
 
     Args:
         input_path (str): path of the band file
-        output_path (str): path to persist cropped band
         shapes (gepandas.GeoSeries): iterable with geometries to crop
 
     Returns:
@@ -138,15 +207,37 @@ def crop_persist_band(input_path, output_path, shapes):
                          "height": out_image.shape[1],
                          "width": out_image.shape[2],
                          "transform": out_transform})
-        with rio.open(output_path, "w", **out_meta) as dest:
-            dest.write(out_image)
+
+    return out_image, out_meta
+
+
+def crop_persist_band(input_path, output_path, shapes):
+    """Load band from input path,
+    crop it according to the geometries in shapes
+    and persist to filepath in output_path.
+    This function uses crop_band() and write_band().
+
+    Args:
+        input_path (str): path of the band file
+        output_path (str): path to persist cropped band
+        shapes (gepandas.GeoSeries): iterable with geometries to crop
+
+    Returns:
+        out_image (numpy.ndarray): copped image/band array
+        out_meta (dict): dictionary with band information
+            (i.e., CRS, affine transformation matrix, etc.)
+    """
+    out_image, out_meta = crop_band(input_path, shapes)
+    write_band(output_path, out_image, out_meta)
 
     return out_image, out_meta
 
 
 def crop_bands(band_paths,
                gdf_bbox,
-               output_folder="processed"):
+               output_folder="processed",
+               pipelined=False,
+               read_ahead=2):
     """Load bands from provided paths,
     crop them according to the geometries in gdf_bbox
     and persist them to the output_folder.
@@ -157,11 +248,17 @@ def crop_bands(band_paths,
         gdf_bbox (gepandas.GeoSeries): iterable with geometries to crop.
         output_folder (str): local folder into which resampled bands are saved.
             Defaults to "processed".
+        pipelined (bool): if True, the next bands are read and cropped
+            while the previous ones are written in a background thread
+            (see run_pipelined()). Defaults to False.
+        read_ahead (int): maximum number of bands read ahead and waiting
+            to be written when pipelined, e.g., the workers planned by
+            MemoryBudget.plan_scene(). Defaults to 2.
 
     Returns: None.
     """
     # Extract scene path
-    scene_path = os.path.join(*band_paths[0].split(os.sep)[:-1])
+    scene_path = os.path.dirname(band_paths[0])
 
     # FIXME: refactor to function?
     # Create a folder to store all processed images images
@@ -173,6 +270,7 @@ def crop_bands(band_paths,
                     output_folder)
 
     # Crop all bands
+    jobs = []
     for band in band_paths:
         input_file = band
         filename = input_file.split(os.sep)[-1]
@@ -180,17 +278,45 @@ def crop_bands(band_paths,
         output_file = os.path.join(scene_path, output_folder, filename)
         try:
             assert os.path.isfile(input_file)
-            _, _ = crop_persist_band(input_path=input_file,
-                                     output_path=output_file,
-                                     shapes=gdf_bbox)
+            if pipelined:
+                jobs.append((input_file, output_file))
+            else:
+                _, _ = crop_persist_band(input_path=input_file,
+                                         output_path=output_file,
+                                         shapes=gdf_bbox)
         except AssertionError as err:
             logger.error("resample_bands: input_file does not exist: %s",
                          input_file)
             raise err
 
+    if pipelined:
+        run_pipelined(jobs,
+                      read=lambda job: crop_band(job[0], gdf_bbox),
+                      write=lambda job, result: write_band(job[1], *result),
+                      read_ahead=read_ahead,
+                      write_behind=read_ahead)
+
     logger.info("crop_bands: bands correctly cropped and persisted!")
 
 
+def get_band_name(filename):
+    """Get the band name from a Sentinel 2 band filename
+    with the format `<tile>_<datetime>_B<band>[_<res>m].<ext>`
+    (flat folders and SAFE products), independently of the extension.
+
+    Args:
+        filename (str): path or filename of the band file
+
+    Returns:
+        band_name (str): band name ('01', '02', ..., '12', '8A')
+    """
+    info = parse_band_filename(filename)
+    if info is not None:
+        return info["band"]
+
+    return os.path.splitext(filename.split(os.sep)[-1])[0][-6:-4]
+
+
 def load_band_image(filename, resample=False, resolution=(60,60)):
     """Load a band file and resample (resize) it
     if required.
@@ -209,9 +335,7 @@ def load_band_image(filename, resample=False, resolution=(60,60)):
     xres = resolution[0]
     yres = resolution[1]
     resample = True
-    # FIXME: use regex in future, or a more generic way...
-    #band_name = filename.split(os.sep)[-1][1:3]
-    band_name = filename.split(os.sep)[-1][-11:-9]
+    band_name = get_band_name(filename)
     with rio.open(filename, 'r') as src:
         img = None
         profile = None
@@ -223,7 +347,7 @@ def load_band_image(filename, resample=False, resolution=(60,60)):
     return img, profile, band_name
 
 
-def load_bands(scene_path):
+def load_bands(scene_path, pipelined=False, read_ahead=2):
     """Load band files as numpy arrays from a given
     scene path which contains the files. Band files must have
     the filename `*B?*.tiff`, being `?` the correct band number.
@@ -231,6 +355,11 @@ def load_bands(scene_path):
 
     Args:
         scene_path (str): path which contains the band files to be loaded.
+        pipelined (bool): if True, the next bands are read ahead
+            in a background thread (see run_pipelined()). Defaults to False.
+        read_ahead (int): maximum number of bands read ahead when
+            pipelined, e.g., the workers planned by MemoryBudget.plan_scene().
+            Defaults to 2.
 
     Returns:
         band_arrays (numpy.ndarray): numpy array with band pixelmaps
@@ -257,6 +386,8 @@ def load_bands(scene_path):
     for band_filename in band_paths:
         try:
             assert os.path.isfile(band_filename)
+            if pipelined:
+                continue
             img, profile, band_name = load_band_image(filename=band_filename,
                                                       resample=False)
             images.append(img)
@@ -267,6 +398,15 @@ def load_bands(scene_path):
                         scene_path)
             raise err
 
+    if pipelined:
+        for img, profile, band_name in run_pipelined(
+                band_paths,
+                read=lambda path: load_band_image(filename=path, resample=False),
+                read_ahead=read_ahead):
+            images.append(img)
+            profiles.append(profile)
+            band_names.append(band_name)
+
     # Check: are they all resampled to the same size?
     _, w, h = images[0].shape
     try:
@@ -288,7 +428,80 @@ def load_bands(scene_path):
     return band_arrays, band_names, profile
 
 
-def compute_ndvi(images, band_names):
+def normalized_difference(band_a, band_b, compact=False):
+    """Compute the normalized difference of two bands:
+
+    ND = (A - B) / (A + B)
+
+    The bands are converted to float before operating,
+    so that unsigned integer bands do not wrap around.
+    Pixels with A + B = 0 are set to 0 (float) or ND_NODATA (compact).
+
+    Args:
+        band_a (numpy.ndarray): band A
+        band_b (numpy.ndarray): band B
+        compact (bool): if True, return the ND map as int16
+            scaled by ND_SCALE, else float64 (default: False)
+
+    Returns:
+        ndmap (numpy.ndarray): ND pixelmap
+    """
+    if not compact:
+        band_a = band_a.astype(np.float64)
+        band_b = band_b.astype(np.float64)
+        # Default division by 0 to 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ndmap = np.nan_to_num((band_a - band_b) / (band_a + band_b))
+        return ndmap
+
+    # Compact: float32 temporaries, int16 output
+    diff = np.subtract(band_a, band_b, dtype=np.float32)
+    total = np.add(band_a, band_b, dtype=np.float32)
+    nodata = total == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(diff, total, out=diff)
+    np.multiply(diff, ND_SCALE, out=diff)
+    np.rint(diff, out=diff)
+    diff[nodata] = 0
+    ndmap = diff.astype(np.int16)
+    ndmap[nodata] = ND_NODATA
+
+    return ndmap
+
+
+def select_nd_bands(images, band_names, map_type="ndwi"):
+    """Select the bands A and B of the normalized difference
+    (A - B) / (A + B) of an ND map:
+
+    - ndvi: A = NIR (B8), B = Red (B4)
+    - ndwi: A = Green (B3), B = NIR (B8A); in the absence of Green,
+      A = NIR (B8A), B = SWIR (B12, else B11) (approx.)
+
+    Args:
+        images (numpy.ndarray): array with images
+            in a 3D shape: band, width, height
+        band_names (list[str]): band names associated
+            to the images, e.g.: ['01', '02', ..., '08A']
+        map_type (str): "ndvi" or "ndwi" (default: "ndwi")
+
+    Returns:
+        band_a (numpy.ndarray): band A, or None if not available
+        band_b (numpy.ndarray): band B, or None if not available
+    """
+    if map_type == "ndvi":
+        candidates = [('08', '04')]
+    else:
+        candidates = [('03', '8A'), ('8A', '12'), ('8A', '11')]
+
+    for name_a, name_b in candidates:
+        if name_a in band_names and name_b in band_names:
+            return (images[band_names.index(name_a)].squeeze(),
+                    images[band_names.index(name_b)].squeeze())
+
+    return None, None
+
+
+def compute_ndvi(images, band_names, compact=False):
     """Compute the Normalized Difference
     Vegetation Index (NDVI) pixelmap.
 
@@ -300,32 +513,21 @@ def compute_ndvi(images, band_names):
             in a 3D shape: band, width, height
         band_names (list[str]): band names associated
             to the images, e.g.: ['01', '02', ..., '08A']
+        compact (bool): if True, return NDVI as int16
+            scaled by ND_SCALE (default: False)
 
     Returns:
         ndvi (numpy.ndarray): NDVI pixelmap
     """
-    # Initialize
-    red_idx = None
-    nir_idx = None
     ndvi = None
-
-    # Get the indices of the Red and NIR bands
-    red_idx = band_names.index('04') if '04' in band_names else None
-    nir_idx = band_names.index('08') if '08' in band_names else None
-
-    # Get the corresponding bands
-    if red_idx and nir_idx:
-        red_band = images[red_idx].squeeze()
-        nir_band = images[nir_idx].squeeze()
-
-        # Compute NDVI; default fivision by 0 to 0
-        with np.errstate(divide='ignore', invalid='ignore'):
-            ndvi = np.nan_to_num((nir_band - red_band) / (nir_band + red_band))
+    band_a, band_b = select_nd_bands(images, band_names, map_type="ndvi")
+    if band_a is not None:
+        ndvi = normalized_difference(band_a, band_b, compact=compact)
 
     return ndvi
 
 
-def compute_ndwi(images, band_names):
+def compute_ndwi(images, band_names, compact=False):
     """Compute the Normalized Difference Water
     Index (NDWI) pixelmap.
 
@@ -343,52 +545,16 @@ def compute_ndwi(images, band_names):
             in a 3D shape: band, width, height
         band_names (list[str]): band names associated
             to the images, e.g.: ['01', '02', ..., '08A']
+        compact (bool): if True, return NDWI as int16
+            scaled by ND_SCALE (default: False)
 
     Returns:
         ndwi (numpy.ndarray): NDWI pixelmap
     """
-    # Initialize
-    green_idx = None
-    nir_idx = None
-    swir_idx = None
-    swir_12_idx = None
-    swir_11_idx = None
     ndwi = None
-    standard = False
-
-    # Get the indices of the Red and NIR bands
-    green_idx = band_names.index('03') if '03' in band_names else None
-    nir_idx = band_names.index('8A') if '8A' in band_names else None
-    #nir_idx = band_names.index('08') if '08' in band_names else None    
-    swir_idx = band_names.index('12') if '12' in band_names else None
-    swir_11_idx = band_names.index('11') if '11' in band_names else None
-
-    # Select formula with available
-    if green_idx and nir_idx:
-        standard = True
-    else:
-        if swir_12_idx:
-            swir_idx = swir_12_idx
-        elif swir_11_idx:
-            swir_idx = swir_11_idx
-
-    if standard:
-        # NDWI = (Green - NIR) / (Green + NIR)
-        green_band = images[green_idx].squeeze()
-        nir_band = images[nir_idx].squeeze()
-
-        # Compute NDWI; default fivision by 0 to 0
-        with np.errstate(divide='ignore', invalid='ignore'):
-            ndwi = np.nan_to_num((green_band - nir_band) / (green_band + nir_band))
-
-    elif swir_idx:
-        # NDWI = (NIR - SWIR) / (NIR + SWIR) (approx.)
-        swir_band = images[swir_idx].squeeze()
-        nir_band = images[nir_idx].squeeze()
-
-        # Compute NDWI; default fivision by 0 to 0
-        with np.errstate(divide='ignore', invalid='ignore'):
-            ndwi = np.nan_to_num((nir_band - swir_band) / (nir_band - swir_band))
+    band_a, band_b = select_nd_bands(images, band_names, map_type="ndwi")
+    if band_a is not None:
+        ndwi = normalized_difference(band_a, band_b, compact=compact)
 
     return ndwi
 
@@ -397,13 +563,19 @@ def generate_persist_ndmap(images,
                            band_names,
                            profile,
                            output_path,
-                           map_type="ndvi"):
+                           map_type="ndvi",
+                           compact=False):
     """Compute and store a normalized difference map,
     either:
 
     - Normalized Difference Vegetation Index (NDVI), or
     - Normalized Difference Water Index (NDWI)
 
+    By default the map is stored as float32 with nodata=ND_FLOAT_NODATA
+    (-9999) for the pixels without data (A + B = 0); in compact mode, it is stored as int16 scaled by ND_SCALE
+    with nodata=ND_NODATA and the scale/offset metadata set,
+    so that GDAL-based tools read the real index values.
+
     Args:
         images (numpy.ndarray): array with images
             in a 3D shape: band, width, height
@@ -412,6 +584,8 @@ def generate_persist_ndmap(images,
         profile (dict): profile dictionary of the source bands
         output_path (str): file path to persist the NDVI pixelmap
         map_type (str): "ndvi" for NDVI, "ndwi" for NDWI
+        compact (bool): compute and store the map as scaled int16
+            (default: False)
 
     Returns:
         ndmap (numpy.ndarray): ND pixelmap
@@ -423,38 +597,246 @@ def generate_persist_ndmap(images,
 
     # Compute NDVI
     if map_type == "ndvi":
-        ndmap = compute_ndvi(images, band_names)
+        ndmap = compute_ndvi(images, band_names, compact=compact)
     elif map_type == "ndwi":
-        ndmap = compute_ndwi(images, band_names)
+        ndmap = compute_ndwi(images, band_names, compact=compact)
     else:
         print(f"generate_persist_ndmap: not valid map_type: {map_type}")
 
     # FIXME: use exception handling, as before
     # Store if we obtained something from compute_ndvi
-    if ndmap.any() or ndmap_profile:    
-        # Create new profile for NDVI image
-        ndmap_profile = profile.copy()
-        ndmap_profile['count'] = 1
-        ndmap_profile['dtype'] = 'float32'
-        ndmap_profile['nodata'] = -9999
-
-        # Create a transform for the NDVI image
-        transform = profile['transform']
-        ndmap_transform = Affine(transform.a,
-                                 transform.b,
-                                 transform.c,
-                                 transform.d,
-                                 transform.e,
-                                 transform.f)
-
-        # Write the NDVI image to disk
-        with rio.open(output_path, 'w', **ndmap_profile) as ndmap_ds:
-            ndmap_ds.write(ndmap, 1)
-            ndmap_ds.transform = ndmap_transform
-
+    if ndmap.any() or ndmap_profile:
+        band_a, band_b = select_nd_bands(images, band_names, map_type=map_type)
+        ndmap, ndmap_profile = persist_ndmap(ndmap, profile, output_path, compact=compact,
+                                             nodata_mask=(band_a == 0) & (band_b == 0))
         logger.info("generate_persist_ndvi: %s correctly generated and saved.", map_type)
 
     else:
         logger.warning("generate_persist_ndvi: bands are missing to compute NDVI/NDWI.")
 
     return ndmap, ndmap_profile
+
+
+def persist_ndmap(ndmap, profile, output_path, compact=False, nodata_mask=None):
+    """Store an already computed normalized difference map,
+    e.g., the float32 map returned by compute_ndmap_mask(),
+    with the same format as generate_persist_ndmap().
+    Float maps are converted to compact int16 if required.
+
+    Args:
+        ndmap (numpy.ndarray): float ND map or compact int16 ND map
+        profile (dict): profile dictionary of the source bands
+        output_path (str): file path to persist the ND pixelmap
+        compact (bool): store the map as int16 scaled by ND_SCALE
+            (default: False)
+        nodata_mask (numpy.ndarray): pixels without data (A + B = 0),
+            stored as ND_NODATA in compact maps and as ND_FLOAT_NODATA
+            in float maps (default: None)
+
+    Returns:
+        ndmap (numpy.ndarray): ND pixelmap; float maps are returned
+            as computed (0 where A + B = 0), ND_FLOAT_NODATA is only
+            written to the file
+        ndmap_profile (dict) profile dictionary of the ND pixelmap
+    """
+    stored = ndmap
+    if compact and ndmap.dtype != np.int16:
+        scaled = np.rint(ndmap * ND_SCALE)
+        ndmap = stored = scaled.astype(np.int16)
+        if nodata_mask is not None:
+            ndmap[nodata_mask] = ND_NODATA
+    elif not compact and nodata_mask is not None and nodata_mask.any():
+        # Zero-filled pixels (ROI corners, swath gaps) are not valid zeros
+        stored = np.where(nodata_mask, np.float32(ND_FLOAT_NODATA), ndmap)
+
+    # Create new profile for the ND image
+    ndmap_profile = profile.copy()
+    ndmap_profile['count'] = 1
+    if compact:
+        ndmap_profile['dtype'] = 'int16'
+        ndmap_profile['nodata'] = ND_NODATA
+    else:
+        ndmap_profile['dtype'] = 'float32'
+        ndmap_profile['nodata'] = ND_FLOAT_NODATA
+
+    # Create a transform for the ND image
+    transform = profile['transform']
+    ndmap_transform = Affine(transform.a,
+                             transform.b,
+                             transform.c,
+                             transform.d,
+                             transform.e,
+                             transform.f)
+
+    # Write the ND image to disk
+    with rio.open(output_path, 'w', **ndmap_profile) as ndmap_ds:
+        ndmap_ds.write(stored, 1)
+        ndmap_ds.transform = ndmap_transform
+        if compact:
+            ndmap_ds.scales = (1 / ND_SCALE,)
+            ndmap_ds.offsets = (0.0,)
+
+    return ndmap, ndmap_profile
+
+
+def load_ndmap(filename, as_float=False):
+    """Load a persisted ND map, either float32 or compact int16.
+    Compact maps are returned as they are (int16) unless
+    as_float is requested; use threshold_ndmap() to threshold
+    both types in their own value space.
+
+    Args:
+        filename (str): path of the ND map raster
+        as_float (bool): if True, return compact maps as float32
+            with the real index values; nodata pixels are set to 0
+            (default: False)
+
+    Returns:
+        ndmap (numpy.ndarray): ND pixelmap
+        profile (dict): profile of the ND map raster
+    """
+    with rio.open(filename, 'r') as src:
+        ndmap = src.read(1)
+        profile = src.profile
+        scale = src.scales[0]
+        offset = src.offsets[0]
+
+    if as_float and np.issubdtype(ndmap.dtype, np.integer):
+        nodata = ndmap == profile['nodata']
+        ndmap = ndmap.astype(np.float32) * np.float32(scale) + np.float32(offset)
+        ndmap[nodata] = 0.0
+
+    return ndmap, profile
+
+
+def threshold_ndmap(ndmap, threshold):
+    """Threshold an ND map: pixels with an index value
+    larger than threshold are 1 (water/vegetation), the rest 0.
+    Compact int16 maps are thresholded directly in integer space:
+    for an integer q, q / ND_SCALE > t  <=>  q > floor(t * ND_SCALE);
+    nodata pixels (ND_NODATA) are always 0.
+
+    Args:
+        ndmap (numpy.ndarray): float or compact int16 ND pixelmap
+        threshold (float): index threshold in [-1, 1]
+
+    Returns:
+        mask (numpy.ndarray): uint8 mask
+    """
+    if np.issubdtype(ndmap.dtype, np.integer):
+        threshold = int(np.floor(threshold * ND_SCALE))
+        mask = np.greater(ndmap, threshold)
+        mask &= ndmap != ND_NODATA
+    else:
+        mask = np.greater(ndmap, threshold)
+
+    return mask.view(np.uint8)
+
+
+def normalized_difference_mask(band_a,
+                               band_b,
+                               threshold,
+                               return_ndmap=False,
+                               chunk_size=FUSED_CHUNK_SIZE):
+    """Fused normalized difference and thresholding:
+    compute the mask (A - B) / (A + B) > t directly from the bands,
+    without materializing the full-size float ND map.
+    For non-negative bands (digital numbers) and A + B > 0:
+
+    (A - B) / (A + B) > t  <=>  A * (1 - t) > B * (1 + t)
+
+    The bands are processed in chunks of chunk_size pixels with
+    reused float32 buffers (`out=`), so the temporaries stay
+    bounded by the chunk size. Pixels with A + B = 0 (nodata)
+    are never in the mask, also for negative thresholds.
+
+    Args:
+        band_a (numpy.ndarray): band A
+        band_b (numpy.ndarray): band B
+        threshold (float): index threshold in [-1, 1]
+        return_ndmap (bool): if True, compute also the float32 ND map
+            in the same pass (default: False)
+        chunk_size (int): number of pixels per chunk (default: 2**18)
+
+    Returns:
+        mask (numpy.ndarray): uint8 mask, 1 where the index is above threshold
+        ndmap (numpy.ndarray): float32 ND pixelmap (0 where A + B = 0)
+            if return_ndmap, else None
+    """
+    shape = band_a.shape
+    band_a = band_a.reshape(-1)
+    band_b = band_b.reshape(-1)
+    num_pixels = band_a.size
+    mask = np.empty(num_pixels, dtype=bool)
+    ndmap = np.empty(num_pixels, dtype=np.float32) if return_ndmap else None
+    factor_a = np.float32(1.0 - threshold)
+    factor_b = np.float32(1.0 + threshold)
+
+    chunk_size = max(1, min(chunk_size, num_pixels))
+    buffer_a = np.empty(chunk_size, dtype=np.float32)
+    buffer_b = np.empty(chunk_size, dtype=np.float32)
+    buffer_sum = np.empty(chunk_size, dtype=np.float32) if return_ndmap else None
+    for start in range(0, num_pixels, chunk_size):
+        stop = min(start + chunk_size, num_pixels)
+        size = stop - start
+        chunk_a, chunk_b = buffer_a[:size], buffer_b[:size]
+        chunk_a[...] = band_a[start:stop]
+        chunk_b[...] = band_b[start:stop]
+        if return_ndmap:
+            chunk_sum = buffer_sum[:size]
+            chunk_nd = ndmap[start:stop]
+            np.add(chunk_a, chunk_b, out=chunk_sum)
+            np.subtract(chunk_a, chunk_b, out=chunk_nd)
+            # A - B = 0 where A + B = 0 (non-negative bands): default ND to 0
+            np.divide(chunk_nd, chunk_sum, out=chunk_nd, where=chunk_sum != 0)
+        np.multiply(chunk_a, factor_a, out=chunk_a)
+        np.multiply(chunk_b, factor_b, out=chunk_b)
+        np.greater(chunk_a, chunk_b, out=mask[start:stop])
+
+    mask = mask.reshape(shape).view(np.uint8)
+    if return_ndmap:
+        ndmap = ndmap.reshape(shape)
+
+    return mask, ndmap
+
+
+def compute_ndmap_mask(images,
+                       band_names,
+                       threshold,
+                       map_type="ndwi",
+                       return_ndmap=False,
+                       chunk_size=FUSED_CHUNK_SIZE):
+    """Compute the thresholded mask of an ND map (NDWI or NDVI)
+    directly from the band cube, with the fused kernel
+    normalized_difference_mask(); equivalent to
+    threshold_ndmap(compute_ndwi(images, band_names), threshold)
+    except for nodata pixels, which are never in the mask.
+
+    Args:
+        images (numpy.ndarray): array with images
+            in a 3D shape: band, width, height
+        band_names (list[str]): band names associated
+            to the images, e.g.: ['01', '02', ..., '08A']
+        threshold (float): index threshold in [-1, 1]
+        map_type (str): "ndvi" or "ndwi" (default: "ndwi")
+        return_ndmap (bool): if True, return also the float32 ND map
+            (default: False)
+        chunk_size (int): number of pixels per chunk (default: 2**18)
+
+    Returns:
+        mask (numpy.ndarray): uint8 mask (1 water/vegetation, 0 else)
+        ndmap (numpy.ndarray): float32 ND pixelmap if return_ndmap, else None
+    """
+    band_a, band_b = select_nd_bands(images, band_names, map_type=map_type)
+    try:
+        assert band_a is not None
+    except AssertionError as err:
+        logger.error("compute_ndmap_mask: bands for %s not available: %s",
+                     map_type, band_names)
+        raise err
+
+    return normalized_difference_mask(band_a,
+                                      band_b,
+                                      threshold,
+                                      return_ndmap=return_ndmap,
+                                      chunk_size=chunk_size)
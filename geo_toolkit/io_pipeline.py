@@ -0,0 +1,160 @@
+"""This module contains the pipelined (producer/consumer)
+execution of the band-processing loops: while a band is processed
+in the calling thread, the next bands are read ahead by a
+reader thread and the previous results are written by a
+writer thread. Reading, processing and writing overlap
+even on a single core, because GDAL releases the GIL
+during I/O; the bounded queues cap the number of
+bands held in memory. Errors of any stage are raised
+in the calling thread and stop the other stages.
+These functions are implemented and documented:
+
+    run_pipelined()
+
+Author: Mikel Sagardia
+Date: 2023-04-29
+"""
+import logging
+import queue
+import threading
+
+# Same (root) logger as geo_library, which imports this module
+logger = logging.getLogger()
+
+# Seconds between checks of the stop flag while waiting on a queue
+_POLL_INTERVAL = 0.1
+_DONE = object()
+
+
+class _StageError:
+    """Wrapper of an exception raised in a background stage."""
+    def __init__(self, error):
+        self.error = error
+
+
+def _put(bounded_queue, item, stop):
+    """Put an item in a bounded queue unless the pipeline is stopped.
+
+    Returns:
+        put (bool): False if the pipeline was stopped before the put
+    """
+    while not stop.is_set():
+        try:
+            bounded_queue.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(bounded_queue, stop):
+    """Get an item from a bounded queue unless the pipeline is stopped.
+
+    Returns:
+        item (object): the item, or _DONE if the pipeline was stopped
+    """
+    while not stop.is_set():
+        try:
+            return bounded_queue.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def run_pipelined(items,
+                  read,
+                  process=None,
+                  write=None,
+                  read_ahead=2,
+                  write_behind=2):
+    """Run read -> process -> write over items with overlapped stages:
+    read(item) runs in a reader thread, process(item, data) in the
+    calling thread and write(item, result) in a writer thread.
+    At most read_ahead read items and write_behind results
+    wait in the queues, so memory is bounded.
+
+    Args:
+        items (iterable): items to process, e.g., band paths
+        read (callable): read(item) -> data
+        process (callable): process(item, data) -> result; default:
+            the data is the result
+        write (callable): write(item, result); default: no writer thread
+        read_ahead (int): maximum number of items read ahead (default: 2)
+        write_behind (int): maximum number of results waiting
+            to be written (default: 2)
+
+    Returns:
+        results (list): the results of process() in item order
+            if write is None, else an empty list
+    """
+    stop = threading.Event()
+    read_queue = queue.Queue(maxsize=max(1, read_ahead))
+    write_queue = queue.Queue(maxsize=max(1, write_behind))
+    write_errors = []
+
+    def reader():
+        try:
+            for item in items:
+                data = read(item)
+                if not _put(read_queue, (item, data), stop):
+                    return
+        except Exception as err: # pylint: disable=broad-except
+            _put(read_queue, _StageError(err), stop)
+            return
+        _put(read_queue, _DONE, stop)
+
+    def writer():
+        while True:
+            entry = write_queue.get()
+            if entry is _DONE:
+                return
+            try:
+                write(*entry)
+            except Exception as err: # pylint: disable=broad-except
+                write_errors.append(err)
+                stop.set()
+                return
+
+    reader_thread = threading.Thread(target=reader, name="pipeline-reader", daemon=True)
+    writer_thread = None
+    if write is not None:
+        writer_thread = threading.Thread(target=writer, name="pipeline-writer", daemon=True)
+        writer_thread.start()
+    reader_thread.start()
+
+    results = []
+    try:
+        while True:
+            entry = _get(read_queue, stop)
+            if entry is _DONE:
+                break
+            if isinstance(entry, _StageError):
+                logger.error("run_pipelined: read stage failed: %s", entry.error)
+                raise entry.error
+            item, data = entry
+            result = data if process is None else process(item, data)
+            if writer_thread is None:
+                results.append(result)
+            elif not _put(write_queue, (item, result), stop):
+                break
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        if writer_thread is not None:
+            # The writer stops after the pending results (or after an error)
+            while writer_thread.is_alive():
+                try:
+                    write_queue.put(_DONE, timeout=_POLL_INTERVAL)
+                    break
+                except queue.Full:
+                    continue
+            writer_thread.join()
+        stop.set()
+        reader_thread.join()
+
+    if write_errors:
+        logger.error("run_pipelined: write stage failed: %s", write_errors[0])
+        raise write_errors[0]
+
+    return results
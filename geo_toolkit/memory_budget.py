@@ -0,0 +1,336 @@
+"""This module contains the memory-budget governor: a memory limit,
+read from the arguments, the environment variable
+GEO_TOOLKIT_MEMORY_BUDGET or a YAML config file (key memory_budget),
+which the processing stages consult to size their window/chunk
+sizes, the number of concurrent workers and the cache capacities
+from the raster shapes, dtypes and band counts. If a scene does
+not fit in memory, the plan switches to block-wise streaming
+instead of failing. The planned and the observed peak memory
+(tracemalloc, which follows the NumPy allocations, and the
+maximum resident set size) are reported per stage.
+These functions/classes are implemented and documented:
+
+    parse_memory_size()
+    available_memory()
+    MemoryBudget
+
+Author: Mikel Sagardia
+Date: 2023-05-04
+"""
+import math
+import os
+import re
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import yaml
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+from .geo_library import logger
+
+ENV_VARIABLE = "GEO_TOOLKIT_MEMORY_BUDGET"
+CONFIG_KEY = "memory_budget"
+# Default budget: fraction of the available memory (or fixed if unknown)
+DEFAULT_FRACTION = 0.5
+DEFAULT_BUDGET = 4 * 2**30
+# Bytes per pixel besides the band stack in the in-memory path:
+# ND maps, water mask, labels and their temporaries
+IN_MEMORY_OVERHEAD = 32
+# Bytes per element of the fused band-to-mask kernel (float32 buffers + mask)
+FUSED_BYTES_PER_ELEMENT = 16
+# Limits of the streaming block side (pixels), multiple of BLOCK_ALIGNMENT
+BLOCK_ALIGNMENT = 256
+MAX_BLOCK_SIZE = 8192
+MIN_CHUNK_SIZE = 2**12
+MAX_CHUNK_SIZE = 2**24
+
+_UNITS = {"": 1, "b": 1, "k": 2**10, "kb": 2**10, "kib": 2**10,
+          "m": 2**20, "mb": 2**20, "mib": 2**20, "g": 2**30, "gb": 2**30,
+          "gib": 2**30, "t": 2**40, "tb": 2**40, "tib": 2**40}
+
+
+def available_memory():
+    """Memory available for new processes, in bytes.
+
+    Returns:
+        nbytes (int): available memory, None if unknown
+    """
+    try:
+        with open("/proc/meminfo", 'r', encoding='utf-8') as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 2**10
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def parse_memory_size(value):
+    """Parse a memory size: bytes (int), a string with units
+    ("512MB", "4G", "1.5GiB") or a percentage of the
+    available memory ("50%").
+
+    Args:
+        value (int, float or str): memory size
+
+    Returns:
+        nbytes (int): memory size in bytes
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip().lower()
+    if text.endswith("%"):
+        available = available_memory() or DEFAULT_BUDGET / DEFAULT_FRACTION
+        return int(float(text[:-1]) / 100 * available)
+    match = re.fullmatch(r"([0-9]*\.?[0-9]+)\s*([a-z]*)", text)
+    try:
+        assert match is not None and match.group(2) in _UNITS
+    except AssertionError as err:
+        logger.error("parse_memory_size: invalid memory size: %s", value)
+        raise err
+
+    return int(float(match.group(1)) * _UNITS[match.group(2)])
+
+
+def _max_rss():
+    """Maximum resident set size of the process so far, in bytes."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return max_rss if os.uname().sysname == "Darwin" else max_rss * 2**10
+
+
+class MemoryBudget:
+    """Memory budget consulted by the processing stages.
+    Create it with from_config() to read the limit from the
+    environment or a config file.
+
+    Args:
+        limit (int or str): memory limit, see parse_memory_size()
+        trace (bool): trace the allocations with tracemalloc to report
+            the observed peak of every stage (slower) (default: False)
+    """
+    def __init__(self, limit, trace=False):
+        self.limit = parse_memory_size(limit)
+        self.stages = []
+        self._current = None
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        logger.info("MemoryBudget: limit %.1f MB.", self.limit / 2**20)
+
+    @classmethod
+    def from_config(cls, limit=None, config=None, trace=False):
+        """Create a memory budget; the limit is taken from, by priority:
+        the argument limit, the environment variable GEO_TOOLKIT_MEMORY_BUDGET,
+        the key memory_budget of config, or DEFAULT_FRACTION of the
+        available memory.
+
+        Args:
+            limit (int or str): memory limit (default: None)
+            config (dict or str): configuration dictionary or
+                path of a YAML config file (default: None)
+            trace (bool): trace the allocations (default: False)
+
+        Returns:
+            budget (MemoryBudget)
+        """
+        if limit is None:
+            limit = os.environ.get(ENV_VARIABLE)
+        if limit is None and config is not None:
+            if isinstance(config, str):
+                with open(config, 'r', encoding='utf-8') as config_file:
+                    config = yaml.safe_load(config_file) or {}
+            limit = config.get(CONFIG_KEY)
+        if limit is None:
+            available = available_memory()
+            limit = int(available * DEFAULT_FRACTION) if available else DEFAULT_BUDGET
+
+        return cls(limit, trace=trace)
+
+    def fits(self, nbytes, share=1.0):
+        """Whether nbytes fit in a share of the budget."""
+        return nbytes <= self.limit * share
+
+    def concurrency(self, item_bytes, max_workers=None, share=1.0):
+        """Number of items (bands, scenes, tasks) which can be
+        processed at the same time within a share of the budget.
+
+        Args:
+            item_bytes (int): bytes required by one item
+            max_workers (int): upper limit (default: os.cpu_count())
+            share (float): share of the budget (default: 1.0)
+
+        Returns:
+            workers (int): at least 1
+        """
+        max_workers = max_workers or os.cpu_count() or 1
+        fitting = int(self.limit * share // max(1, item_bytes))
+
+        return max(1, min(max_workers, fitting))
+
+    def cache_capacity(self, item_bytes, max_items=None, share=0.5):
+        """Number of items a cache can hold within a share of the budget.
+
+        Args:
+            item_bytes (int): bytes of one cached item
+            max_items (int): upper limit (default: None)
+            share (float): share of the budget (default: 0.5)
+
+        Returns:
+            capacity (int): at least 1
+        """
+        capacity = max(1, int(self.limit * share // max(1, item_bytes)))
+
+        return capacity if max_items is None else min(capacity, max_items)
+
+    def chunk_size(self, bytes_per_element, concurrency=1, share=0.25):
+        """Elements per chunk (power of 2) of a chunked kernel,
+        e.g., the fused band-to-mask kernel or a classifier batch.
+
+        Args:
+            bytes_per_element (int): working bytes per element
+            concurrency (int): chunks processed at the same time (default: 1)
+            share (float): share of the budget for the chunks (default: 0.25)
+
+        Returns:
+            chunk_size (int): in [MIN_CHUNK_SIZE, MAX_CHUNK_SIZE]
+        """
+        elements = self.limit * share / (bytes_per_element * max(1, concurrency))
+        chunk_size = 2**int(math.log2(max(1, elements)))
+
+        return int(min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, chunk_size)))
+
+    def block_size(self, band_count, dtype="uint16", concurrency=1, share=0.5):
+        """Side (pixels) of the square windows of block-wise streaming:
+        band_count bands of dtype are read (and converted to float32)
+        per block, concurrency blocks at the same time.
+
+        Args:
+            band_count (int): bands read per block
+            dtype (str or numpy.dtype): band dtype (default: "uint16")
+            concurrency (int): blocks in memory at the same time (default: 1)
+            share (float): share of the budget for the blocks (default: 0.5)
+
+        Returns:
+            block_size (int): multiple of BLOCK_ALIGNMENT, at most MAX_BLOCK_SIZE
+        """
+        bytes_per_pixel = band_count * (np.dtype(dtype).itemsize + 4) + IN_MEMORY_OVERHEAD
+        side = math.sqrt(self.limit * share / (bytes_per_pixel * max(1, concurrency)))
+        block_size = int(side // BLOCK_ALIGNMENT) * BLOCK_ALIGNMENT
+
+        return min(MAX_BLOCK_SIZE, max(BLOCK_ALIGNMENT, block_size))
+
+    def plan_scene(self, shape, band_count, dtype="uint16", stream_bands=2):
+        """Plan the processing of a scene: in memory (load_bands()
+        stacks all the bands) if it fits in the budget, else streaming.
+
+        Args:
+            shape (tuple[int]): (height, width) of the in-memory raster
+            band_count (int): number of bands stacked in memory
+            dtype (str or numpy.dtype): band dtype (default: "uint16")
+            stream_bands (int): bands read per block when streaming
+                (default: 2, the ND map bands)
+
+        Returns:
+            plan (dict): in_memory (bool), planned_bytes (in-memory peak),
+                block_size (streaming), chunk_size (fused kernel)
+                and workers (concurrent bands)
+        """
+        pixels = int(shape[0]) * int(shape[1])
+        band_bytes = pixels * np.dtype(dtype).itemsize
+        # The band list and the stacked cube coexist while stacking
+        planned_bytes = 2 * band_count * band_bytes + pixels * IN_MEMORY_OVERHEAD
+        plan = {"in_memory": self.fits(planned_bytes),
+                "planned_bytes": planned_bytes,
+                "block_size": self.block_size(stream_bands, dtype),
+                "chunk_size": self.chunk_size(FUSED_BYTES_PER_ELEMENT),
+                "workers": self.concurrency(band_bytes, share=0.5)}
+        logger.info("MemoryBudget: scene %s x %d bands: %.1f MB planned, %s.",
+                    tuple(shape), band_count, planned_bytes / 2**20,
+                    "in memory" if plan["in_memory"]
+                    else f"streaming (block size {plan['block_size']})")
+
+        return plan
+
+    def start_stage(self, name, planned_bytes=None):
+        """Start measuring a (non nested) stage; see stage()."""
+        if self._current is not None:
+            self.end_stage()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self._current = {"stage": name,
+                         "planned_bytes": planned_bytes,
+                         "start": time.perf_counter()}
+
+    def end_stage(self):
+        """End the current stage and record its planned and observed memory.
+
+        Returns:
+            record (dict): stage, planned_bytes, observed_peak (tracemalloc,
+                None if not tracing), max_rss (process) and seconds
+        """
+        record = self._current
+        if record is None:
+            return None
+        self._current = None
+        record["seconds"] = time.perf_counter() - record.pop("start")
+        record["observed_peak"] = tracemalloc.get_traced_memory()[1] \
+            if tracemalloc.is_tracing() else None
+        record["max_rss"] = _max_rss()
+        self.stages.append(record)
+
+        observed = record["observed_peak"]
+        if observed is not None and observed > self.limit:
+            logger.warning("MemoryBudget: stage %s peaked at %.1f MB, over the "
+                           "limit of %.1f MB.", record["stage"], observed / 2**20,
+                           self.limit / 2**20)
+
+        return record
+
+    @contextmanager
+    def stage(self, name, planned_bytes=None):
+        """Context manager which records the planned and observed
+        peak memory of a stage:
+
+            with budget.stage("step_2", planned_bytes):
+                ...
+
+        Args:
+            name (str): stage name
+            planned_bytes (int): planned peak of the stage (default: None)
+        """
+        self.start_stage(name, planned_bytes)
+        try:
+            yield self
+        finally:
+            self.end_stage()
+
+    def report(self):
+        """Log the planned and observed peak memory of all the stages.
+
+        Returns:
+            stages (list[dict]): records of end_stage()
+        """
+        self.end_stage()
+
+        def megabytes(nbytes):
+            return "-" if nbytes is None else f"{nbytes / 2**20:.1f} MB"
+
+        for record in self.stages:
+            logger.info("MemoryBudget: %s: planned %s, observed peak %s, "
+                        "max RSS %s, %.2f s.", record["stage"],
+                        megabytes(record["planned_bytes"]),
+                        megabytes(record["observed_peak"]),
+                        megabytes(record["max_rss"]), record["seconds"])
+
+        return self.stages
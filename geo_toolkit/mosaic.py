@@ -0,0 +1,206 @@
+"""This module contains the functions to load the bands
+of a ROI which spans several Sentinel 2 tiles (MGRS) of the same date
+as one seamless band stack, without merging rasters to disk.
+Each tile is wrapped in a lazy virtual warp (GDAL WarpedVRT) onto
+the output grid of the ROI, and only the window of the grid
+which overlaps the tile is read; tiles which do not intersect
+the ROI are not read at all. Thus, the cost scales with the ROI,
+not with the number or the size of the tiles.
+These functions are implemented and documented:
+
+    group_band_paths()
+    roi_grid()
+    read_mosaic_band()
+    load_mosaic_bands()
+
+Author: Mikel Sagardia
+Date: 2023-04-27
+"""
+import math
+import os
+
+import numpy as np
+
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+
+from .geo_library import (
+    logger,
+    get_band_name
+)
+
+
+def group_band_paths(band_paths):
+    """Group band files of several tiles by band name.
+    Band filenames have the format `<tile>_<datetime>_B<band>_<res>m.<ext>`;
+    a warning is logged if the tiles have different sensing dates.
+
+    Args:
+        band_paths (list[str]): paths of the band files of all tiles
+
+    Returns:
+        groups (dict): {band_name: sorted list of paths}
+    """
+    groups = {}
+    for path in sorted(band_paths):
+        groups.setdefault(get_band_name(path), []).append(path)
+
+    dates = {os.path.basename(path).split('_')[1][:8] for path in band_paths}
+    if len(dates) > 1:
+        logger.warning("group_band_paths: tiles with different sensing dates: %s",
+                       sorted(dates))
+
+    return groups
+
+
+def roi_grid(bounds, resolution=(60,60)):
+    """Output grid of a ROI: anchored at its upper-left corner,
+    with the given pixel size.
+
+    Args:
+        bounds (tuple[float]): left, bottom, right, top in the output CRS
+        resolution (tuple[float]): x and y pixel size (default: (60,60))
+
+    Returns:
+        transform (affine.Affine): transform of the grid
+        width (int): number of columns
+        height (int): number of rows
+    """
+    left, bottom, right, top = bounds
+    xres, yres = resolution
+    width = max(1, math.ceil((right - left) / xres))
+    height = max(1, math.ceil((top - bottom) / yres))
+
+    return from_origin(left, top, xres, yres), width, height
+
+
+def read_mosaic_band(paths,
+                     bounds,
+                     crs,
+                     resolution=(60,60),
+                     resampling=Resampling.bilinear,
+                     nodata=0):
+    """Read one band of several tiles onto the grid of a ROI.
+    Each tile is reprojected lazily with a WarpedVRT; only the part
+    of the grid which overlaps the tile is read and pasted where
+    no previous tile provided data (first tile wins in overlaps).
+
+    Args:
+        paths (list[str]): paths of the band file of each tile
+        bounds (tuple[float]): ROI (left, bottom, right, top) in crs
+        crs (rasterio.crs.CRS): output CRS
+        resolution (tuple[float]): x and y pixel size (default: (60,60))
+        resampling (rasterio.enums.Resampling): resampling method
+            (default: bilinear, as resample_bands())
+        nodata (int): nodata value of the tiles and the output (default: 0)
+
+    Returns:
+        img (numpy.ndarray): band array (height, width)
+        transform (affine.Affine): transform of the ROI grid
+    """
+    transform, width, height = roi_grid(bounds, resolution)
+    left, bottom, right, top = bounds
+    img = None
+    num_tiles = 0
+    for path in paths:
+        with rio.open(path, 'r') as src:
+            if img is None:
+                img = np.full((height, width), nodata, dtype=src.dtypes[0])
+            t_left, t_bottom, t_right, t_top = transform_bounds(src.crs, crs, *src.bounds)
+            overlap = (max(left, t_left), max(bottom, t_bottom),
+                       min(right, t_right), min(top, t_top))
+            if overlap[0] >= overlap[2] or overlap[1] >= overlap[3]:
+                continue
+            # Window of the ROI grid covered by the tile
+            window = from_bounds(*overlap, transform=transform)
+            col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+            window = Window(col_off, row_off,
+                            math.ceil(window.col_off + window.width) - col_off,
+                            math.ceil(window.row_off + window.height) - row_off)
+            window = window.intersection(Window(0, 0, width, height))
+            with WarpedVRT(src,
+                           crs=crs,
+                           transform=transform,
+                           width=width,
+                           height=height,
+                           resampling=resampling,
+                           src_nodata=nodata,
+                           nodata=nodata) as vrt:
+                tile_img = vrt.read(1, window=window)
+            rows, cols = window.toslices()
+            target = img[rows, cols]
+            empty = target == nodata
+            target[empty] = tile_img[empty]
+            num_tiles += 1
+
+    logger.info("read_mosaic_band: %d of %d tiles intersect the ROI.",
+                num_tiles, len(paths))
+
+    return img, transform
+
+
+def load_mosaic_bands(band_paths,
+                      gdf_bbox,
+                      resolution=(60,60),
+                      crs=None,
+                      resampling=Resampling.bilinear):
+    """Load the bands of a ROI which spans several tiles
+    as a seamless band stack, as load_bands() does for one tile,
+    without persisting resampled, cropped or merged rasters.
+    This function uses read_mosaic_band().
+
+    Args:
+        band_paths (list[str]): paths of the band files of all tiles
+        gdf_bbox (geopandas.GeoSeries): geometries of the ROI
+        resolution (tuple[float]): x and y pixel size (default: (60,60))
+        crs (rasterio.crs.CRS): output CRS; default: CRS of the first tile
+        resampling (rasterio.enums.Resampling): resampling method
+            (default: bilinear)
+
+    Returns:
+        band_arrays (numpy.ndarray): numpy array with band pixelmaps
+            with the shape (num_bands, height, width).
+        band_names (list[str]): band types/names: 1, 2, 3, ..., 12, 8A.
+        profile (dict): profile of the ROI grid.
+    """
+    try:
+        assert len(band_paths) > 0
+    except AssertionError as err:
+        logger.error("load_mosaic_bands: no band paths provided.")
+        raise err
+
+    groups = group_band_paths(band_paths)
+    if crs is None:
+        with rio.open(groups[next(iter(groups))][0], 'r') as src:
+            crs = src.crs
+    bounds = tuple(gdf_bbox.to_crs(crs).total_bounds)
+
+    images = []
+    band_names = []
+    for band_name, paths in groups.items():
+        img, transform = read_mosaic_band(paths,
+                                          bounds,
+                                          crs,
+                                          resolution=resolution,
+                                          resampling=resampling)
+        images.append(img)
+        band_names.append(band_name)
+    band_arrays = np.stack(images)
+
+    profile = {'driver': 'GTiff',
+               'dtype': band_arrays.dtype.name,
+               'nodata': 0,
+               'width': band_arrays.shape[2],
+               'height': band_arrays.shape[1],
+               'count': 1,
+               'crs': crs,
+               'transform': transform}
+
+    logger.info("load_mosaic_bands: %d bands loaded as a %dx%d mosaic.",
+                len(band_names), band_arrays.shape[1], band_arrays.shape[2])
+
+    return band_arrays, band_names, profile
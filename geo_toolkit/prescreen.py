@@ -0,0 +1,171 @@
+"""This module contains the functions of the quicklook pre-screen,
+which decides whether a scene is worth processing
+before paying for the full resample, crop, index
+and vectorize chain. Only a coarse version of the required
+bands is read over the ROI: GDAL serves decimated reads
+from the raster overviews or, for JP2 files,
+from the lower wavelet resolution levels.
+These functions are implemented and documented:
+
+    read_band_quicklook()
+    prescreen_scene()
+
+Author: Mikel Sagardia
+Date: 2023-04-20
+"""
+import math
+
+import numpy as np
+
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin, rowcol
+from rasterio.windows import from_bounds
+
+from .geo_library import (
+    logger,
+    get_band_name,
+    normalized_difference
+)
+
+# Blue (cloud), Green and NIR bands
+PRESCREEN_BANDS = {"blue": '02', "green": '03', "nir": '8A'}
+
+
+def read_band_quicklook(path, bounds, resolution=160):
+    """Read a band over some bounds at a coarse resolution.
+    The read is decimated (average resampling), so GDAL
+    takes the pixels from the best matching overview or
+    JP2 resolution level instead of the full resolution data.
+
+    Args:
+        path (str): path of the band file
+        bounds (tuple[float]): left, bottom, right, top in the band CRS
+        resolution (float): output pixel size in CRS units (default: 160)
+
+    Returns:
+        img (numpy.ndarray): quicklook band array (rows, cols)
+        transform (affine.Affine): transform of the quicklook grid
+    """
+    left, bottom, right, top = bounds
+    out_shape = (max(1, math.ceil((top - bottom) / resolution)),
+                 max(1, math.ceil((right - left) / resolution)))
+    with rio.open(path, 'r') as src:
+        # Quicklook grid anchored at the upper-left corner of the ROI
+        window = from_bounds(left, top - out_shape[0]*resolution,
+                             left + out_shape[1]*resolution, top,
+                             transform=src.transform)
+        img = src.read(1,
+                       window=window,
+                       out_shape=out_shape,
+                       boundless=True,
+                       fill_value=0,
+                       resampling=Resampling.average)
+
+    return img, from_origin(left, top, resolution, resolution)
+
+
+def prescreen_scene(band_paths,
+                    bounds,
+                    points,
+                    resolution=160,
+                    radius=500,
+                    ndwi_threshold=0.0,
+                    cloud_threshold=2500,
+                    min_water_fraction=0.5,
+                    max_cloud_fraction=0.3,
+                    require_all=True):
+    """Pre-screen a scene with a coarse quicklook of the ROI:
+    compute the NDWI and the water and cloud fractions
+    in a disc around each target point and check them
+    against the criteria.
+
+    Args:
+        band_paths (list[str]): paths of the band files; B02, B03
+            and B8A are used
+        bounds (tuple[float]): ROI (left, bottom, right, top) in the band CRS
+        points (geopandas.GeoDataFrame or GeoSeries): target points
+            in the band CRS; the column id is used if available
+        resolution (float): quicklook pixel size in CRS units (default: 160)
+        radius (float): radius around each point in CRS units (default: 500)
+        ndwi_threshold (float): NDWI value above which a pixel is water
+            (default: 0.0)
+        cloud_threshold (float): B02 digital number above which a pixel
+            is cloud; L1C values are reflectance x 10000, plus an offset
+            of 1000 since processing baseline 04.00 (default: 2500)
+        min_water_fraction (float): minimum fraction of water pixels
+            around a point (default: 0.5)
+        max_cloud_fraction (float): maximum fraction of cloud pixels
+            around a point (default: 0.3)
+        require_all (bool): if True, all points must pass the criteria,
+            else at least one (default: True)
+
+    Returns:
+        result (dict): with the keys passed (bool), reason (str)
+            and points (list[dict] with id, water_fraction,
+            cloud_fraction and valid_pixels per point)
+    """
+    paths = {get_band_name(path): path for path in band_paths}
+    try:
+        assert all(band in paths for band in PRESCREEN_BANDS.values())
+    except AssertionError as err:
+        logger.error("prescreen_scene: bands %s are required.",
+                     list(PRESCREEN_BANDS.values()))
+        raise err
+
+    quicklooks = {}
+    for key, band in PRESCREEN_BANDS.items():
+        quicklooks[key], transform = read_band_quicklook(paths[band],
+                                                         bounds,
+                                                         resolution=resolution)
+    valid = (quicklooks["green"] > 0) & (quicklooks["nir"] > 0)
+    water = normalized_difference(quicklooks["green"], quicklooks["nir"]) > ndwi_threshold
+    cloud = quicklooks["blue"] > cloud_threshold
+
+    # Pixel center coordinates of the quicklook grid
+    rows, cols = np.indices(valid.shape)
+    xs = transform.c + (cols + 0.5) * transform.a
+    ys = transform.f + (rows + 0.5) * transform.e
+
+    geometries = points.geometry if hasattr(points, "geometry") else points
+    ids = list(points["id"]) if "id" in getattr(points, "columns", []) \
+        else list(range(len(geometries)))
+    point_results = []
+    failures = []
+    for point_id, point in zip(ids, geometries):
+        disc = (xs - point.x)**2 + (ys - point.y)**2 <= radius**2
+        # The pixel of the point is always part of the disc
+        row, col = rowcol(transform, point.x, point.y)
+        if 0 <= row < valid.shape[0] and 0 <= col < valid.shape[1]:
+            disc[row, col] = True
+        disc &= valid
+        valid_pixels = int(disc.sum())
+        water_fraction = float(water[disc].mean()) if valid_pixels else 0.0
+        cloud_fraction = float(cloud[disc].mean()) if valid_pixels else 1.0
+        point_results.append({"id": point_id,
+                              "water_fraction": water_fraction,
+                              "cloud_fraction": cloud_fraction,
+                              "valid_pixels": valid_pixels})
+        if valid_pixels == 0:
+            failures.append(f"point {point_id}: no valid data")
+        elif cloud_fraction > max_cloud_fraction:
+            failures.append(f"point {point_id}: cloud fraction "
+                            f"{cloud_fraction:.2f} > {max_cloud_fraction}")
+        elif water_fraction < min_water_fraction:
+            failures.append(f"point {point_id}: water fraction "
+                            f"{water_fraction:.2f} < {min_water_fraction}")
+
+    if require_all:
+        passed = len(failures) == 0
+    else:
+        passed = len(failures) < len(point_results)
+    reason = "; ".join(failures) if failures else "all points passed"
+
+    if passed:
+        logger.info("prescreen_scene: scene passed (%s).", reason)
+    else:
+        logger.warning("prescreen_scene: scene rejected: %s.", reason)
+
+    return {"passed": passed,
+            "reason": reason,
+            "points": point_results}
@@ -0,0 +1,298 @@
+"""This module contains the Sentinel 2 product catalog:
+band files of SAFE products (GRANULE/<granule>/IMG_DATA, also the
+R10m/R20m/R60m folders of L2A) and of flat folders are discovered
+once, their filenames are parsed (tile, sensing date, band,
+native resolution) and their georeferencing (CRS, bounds,
+transform) is read from a single header read per file.
+Everything is stored in a persistent JSON manifest which is
+updated incrementally (only new or modified files are read),
+so that lookups by tile, date range or bounding box
+need neither filesystem scans nor raster opens.
+These functions are implemented and documented:
+
+    parse_band_filename()
+    find_band_files()
+    read_band_header()
+    build_product_catalog()
+    load_product_catalog()
+    query_products()
+    finest_band_entries()
+
+Author: Mikel Sagardia
+Date: 2023-05-02
+"""
+import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import rasterio as rio
+from rasterio.warp import transform_bounds
+
+# Same (root) logger as geo_library, which imports this module
+logger = logging.getLogger()
+
+MANIFEST_VERSION = 1
+# <...>T<tile>_<YYYYMMDDTHHMMSS>_B<band>[_<res>m].<ext>
+BAND_FILENAME_PATTERN = re.compile(
+    r"T(?P<tile>\d{2}[A-Z]{3})_(?P<datetime>\d{8}T\d{6})_"
+    r"B(?P<band>0[1-9]|1[0-2]|8A)(?:_(?P<resolution>\d{2})m)?"
+    r"\.(?P<extension>jp2|tiff?)$",
+    re.IGNORECASE)
+# S2A_MSIL1C_20230207T101109_N0509_R022_T32UQU_20230207T121212.SAFE
+SAFE_PATTERN = re.compile(r"^(?P<mission>S2[A-D])_MSI(?P<level>L1C|L2A)_.*\.SAFE$")
+# Native resolution (m) of the Sentinel 2 bands
+NATIVE_RESOLUTION = {'01': 60, '02': 10, '03': 10, '04': 10, '05': 20,
+                     '06': 20, '07': 20, '08': 10, '8A': 20, '09': 60,
+                     '10': 60, '11': 20, '12': 20}
+
+
+def parse_band_filename(path):
+    """Parse a Sentinel 2 band filename, independently of the
+    layout (SAFE or flat folder) and of the extension.
+
+    Args:
+        path (str): path or filename of the band file
+
+    Returns:
+        info (dict): tile, datetime ('YYYYMMDDTHHMMSS'), date ('YYYY-MM-DD'),
+            band ('01', ..., '12', '8A'), resolution (int, from the filename
+            or the native resolution of the band), extension;
+            None if the filename is not a band file
+    """
+    match = BAND_FILENAME_PATTERN.search(os.path.basename(path))
+    if match is None:
+        return None
+    band = match.group("band").upper()
+    sensing = match.group("datetime")
+    resolution = match.group("resolution")
+
+    return {"tile": match.group("tile").upper(),
+            "datetime": sensing,
+            "date": f"{sensing[:4]}-{sensing[4:6]}-{sensing[6:8]}",
+            "band": band,
+            "resolution": int(resolution) if resolution else NATIVE_RESOLUTION[band],
+            "extension": match.group("extension").lower()}
+
+
+def _product_info(path):
+    """SAFE product name and processing level of a band path, if any."""
+    for part in reversed(os.path.normpath(path).split(os.sep)):
+        match = SAFE_PATTERN.match(part)
+        if match:
+            return part, match.group("level")
+    return None, None
+
+
+def find_band_files(roots, exclude_dirs=()):
+    """Find all the band files under some root folders
+    with a single recursive scan.
+
+    Args:
+        roots (list[str]): folders with SAFE products or band files
+        exclude_dirs (iterable[str]): names of folders not to scan,
+            e.g., the output folder "processed" (default: ())
+
+    Returns:
+        band_files (list[str]): absolute paths of the band files, sorted
+    """
+    exclude_dirs = set(exclude_dirs)
+    band_files = []
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(os.path.abspath(root)):
+            dirnames[:] = [name for name in dirnames if name not in exclude_dirs]
+            band_files += [os.path.join(dirpath, name) for name in filenames
+                           if BAND_FILENAME_PATTERN.search(name)]
+
+    return sorted(band_files)
+
+
+def read_band_header(path):
+    """Read the georeferencing of a band file (header only).
+
+    Args:
+        path (str): path of the band file
+
+    Returns:
+        header (dict): crs, bounds, transform (6 coefficients), width,
+            height, dtype and bounds_wgs84 (lng/lat)
+    """
+    with rio.open(path, 'r') as src:
+        bounds = list(src.bounds)
+        header = {"crs": src.crs.to_string() if src.crs else None,
+                  "bounds": bounds,
+                  "transform": list(src.transform)[:6],
+                  "width": src.width,
+                  "height": src.height,
+                  "dtype": src.dtypes[0],
+                  "bounds_wgs84": list(transform_bounds(src.crs, "EPSG:4326", *bounds))
+                                  if src.crs else None}
+
+    return header
+
+
+def _write_manifest(manifest_path, catalog):
+    """Write the manifest atomically (temporary file + rename)."""
+    folder = os.path.dirname(os.path.abspath(manifest_path))
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as manifest:
+        json.dump(catalog, manifest)
+    os.replace(tmp_path, manifest_path)
+
+
+def load_product_catalog(manifest_path):
+    """Load a product catalog manifest.
+
+    Args:
+        manifest_path (str): path of the JSON manifest
+
+    Returns:
+        catalog (dict): with the keys version and entries
+            ({absolute path: entry}); empty if the manifest does not exist
+    """
+    if not os.path.isfile(manifest_path):
+        return {"version": MANIFEST_VERSION, "entries": {}}
+    with open(manifest_path, 'r', encoding='utf-8') as manifest:
+        catalog = json.load(manifest)
+    if catalog.get("version") != MANIFEST_VERSION:
+        logger.warning("load_product_catalog: manifest version %s ignored: %s",
+                       catalog.get("version"), manifest_path)
+        return {"version": MANIFEST_VERSION, "entries": {}}
+
+    return catalog
+
+
+def build_product_catalog(roots,
+                          manifest_path,
+                          exclude_dirs=(),
+                          max_workers=8):
+    """Build or update the product catalog of some root folders.
+    Files whose size and modification time did not change keep
+    their entry; only new or modified files are opened (header read,
+    on a thread pool). Entries of deleted files under the roots are
+    dropped; entries under other roots are kept.
+
+    Args:
+        roots (list[str]): folders with SAFE products or band files
+        manifest_path (str): path of the JSON manifest
+        exclude_dirs (iterable[str]): names of folders not to scan (default: ())
+        max_workers (int): number of threads for the header reads (default: 8)
+
+    Returns:
+        catalog (dict): updated catalog; catalog["last_update"] contains
+            the number of files found, read and removed
+    """
+    catalog = load_product_catalog(manifest_path)
+    entries = catalog["entries"]
+    band_files = find_band_files(roots, exclude_dirs=exclude_dirs)
+    found = set(band_files)
+
+    # Drop entries of files which disappeared from the scanned roots
+    prefixes = tuple(os.path.join(os.path.abspath(root), "") for root in roots)
+    removed = [path for path in entries
+               if path.startswith(prefixes) and path not in found]
+    for path in removed:
+        del entries[path]
+
+    to_read = []
+    for path in band_files:
+        file_stat = os.stat(path)
+        entry = entries.get(path)
+        if entry is None or entry["size"] != file_stat.st_size \
+                or entry["mtime"] != file_stat.st_mtime:
+            to_read.append((path, file_stat))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        headers = list(executor.map(lambda job: read_band_header(job[0]), to_read))
+    for (path, file_stat), header in zip(to_read, headers):
+        product, level = _product_info(path)
+        entry = {"path": path, "product": product, "level": level,
+                 "size": file_stat.st_size, "mtime": file_stat.st_mtime}
+        entry.update(parse_band_filename(path))
+        entry.update(header)
+        entries[path] = entry
+
+    catalog["last_update"] = {"found": len(band_files),
+                              "read": len(to_read),
+                              "removed": len(removed)}
+    _write_manifest(manifest_path, catalog)
+    logger.info("build_product_catalog: %d band files found, %d headers read, "
+                "%d entries removed; manifest: %s",
+                len(band_files), len(to_read), len(removed), manifest_path)
+
+    return catalog
+
+
+def query_products(catalog,
+                   tile=None,
+                   start_date=None,
+                   end_date=None,
+                   bbox=None,
+                   bands=None,
+                   resolution=None,
+                   path_prefix=None):
+    """Look up band entries in a catalog; all the criteria are optional
+    and combined (AND). No file is accessed.
+
+    Args:
+        catalog (dict): catalog of build_product_catalog()/load_product_catalog()
+        tile (str): MGRS tile, e.g., "32UQU" (default: None)
+        start_date (str): first date 'YYYY-MM-DD', included (default: None)
+        end_date (str): last date 'YYYY-MM-DD', included (default: None)
+        bbox (tuple[float]): lng/lat bounds (minx, miny, maxx, maxy)
+            which the band must intersect (default: None)
+        bands (list[str]): band names, e.g., ['03', '8A'] (default: None)
+        resolution (int): resolution in meters (default: None)
+        path_prefix (str): folder which must contain the band file (default: None)
+
+    Returns:
+        entries (list[dict]): matching entries, sorted by path
+    """
+    if tile is not None:
+        tile = tile.upper().lstrip("T")
+    if path_prefix is not None:
+        path_prefix = os.path.join(os.path.abspath(path_prefix), "")
+    matches = []
+    for entry in catalog["entries"].values():
+        if tile is not None and entry["tile"] != tile:
+            continue
+        if start_date is not None and entry["date"] < start_date:
+            continue
+        if end_date is not None and entry["date"] > end_date:
+            continue
+        if bands is not None and entry["band"] not in bands:
+            continue
+        if resolution is not None and entry["resolution"] != resolution:
+            continue
+        if path_prefix is not None and not entry["path"].startswith(path_prefix):
+            continue
+        if bbox is not None:
+            west, south, east, north = entry["bounds_wgs84"]
+            if west > bbox[2] or east < bbox[0] or south > bbox[3] or north < bbox[1]:
+                continue
+        matches.append(entry)
+
+    return sorted(matches, key=lambda entry: entry["path"])
+
+
+def finest_band_entries(entries):
+    """Keep one entry per band of each tile and sensing time:
+    the one with the finest resolution, e.g., R10m instead of
+    R20m/R60m in L2A products, which contain bands at several
+    resolutions.
+
+    Args:
+        entries (list[dict]): catalog entries, e.g., of query_products()
+
+    Returns:
+        entries (list[dict]): entries without duplicated bands, sorted by path
+    """
+    finest = {}
+    for entry in entries:
+        key = (entry["tile"], entry["datetime"], entry["band"])
+        if key not in finest or entry["resolution"] < finest[key]["resolution"]:
+            finest[key] = entry
+
+    return sorted(finest.values(), key=lambda entry: entry["path"])
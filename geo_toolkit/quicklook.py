@@ -0,0 +1,256 @@
+"""This module contains a headless quicklook renderer
+which replaces the matplotlib plot of the final result.
+A block-reduced overview of the water mask (or ND map)
+is drawn into a uint8 RGB canvas of fixed size, independent
+of the scene size; polygon outlines and points are rasterized
+directly into the canvas with NumPy, and the canvas is written
+as a PNG file with zlib and struct (no display, no matplotlib).
+These functions are implemented and documented:
+
+    raster_overview()
+    read_raster_overview()
+    draw_lines()
+    draw_points()
+    write_png()
+    render_quicklook()
+
+Author: Mikel Sagardia
+Date: 2023-05-01
+"""
+import math
+import struct
+import zlib
+
+import numpy as np
+import rasterio as rio
+from rasterio.windows import Window
+
+from .geo_library import logger
+
+QUICKLOOK_SIZE = (800, 800)
+POLYGON_COLOR = (255, 0, 0)
+POINT_COLOR = (0, 0, 255)
+
+
+def raster_overview(raster, factor, reduce="max"):
+    """Block-reduce a raster by an integer factor.
+
+    Args:
+        raster (numpy.ndarray): 2D array (height, width)
+        factor (int): block side length
+        reduce (str): "max" (keeps thin features of masks)
+            or "mean" (continuous maps) (default: "max")
+
+    Returns:
+        overview (numpy.ndarray): array (ceil(height/factor), ceil(width/factor))
+    """
+    if factor <= 1:
+        return raster
+    height, width = raster.shape
+    rows, cols = -(-height // factor), -(-width // factor)
+    fill = raster.min() if reduce == "max" else np.nan
+    padded = np.full((rows * factor, cols * factor), fill,
+                     dtype=raster.dtype if reduce == "max" else np.float32)
+    padded[:height, :width] = raster
+    blocks = padded.reshape(rows, factor, cols, factor)
+    if reduce == "max":
+        return blocks.max(axis=(1, 3))
+    with np.errstate(invalid='ignore'):
+        return np.nanmean(blocks, axis=(1, 3))
+
+
+def read_raster_overview(path, size=QUICKLOOK_SIZE, reduce="max", strip_rows=64):
+    """Block-reduce a single-band raster file to fit in size; the file
+    is read in strips of strip_rows overview rows, so the full-resolution
+    raster is never loaded (e.g., the water mask of streaming).
+
+    Args:
+        path (str): path of the raster file
+        size (tuple[int]): maximum (width, height) (default: (800, 800))
+        reduce (str): "max" or "mean", see raster_overview() (default: "max")
+        strip_rows (int): overview rows per read (default: 64)
+
+    Returns:
+        overview (numpy.ndarray): block-reduced raster
+        transform (affine.Affine): transform of the overview
+    """
+    with rio.open(path, 'r') as src:
+        factor = max(1, math.ceil(max(src.height / size[1], src.width / size[0])))
+        step = factor * strip_rows
+        strips = []
+        for row_off in range(0, src.height, step):
+            window = Window(0, row_off, src.width, min(step, src.height - row_off))
+            strips.append(raster_overview(src.read(1, window=window), factor, reduce))
+        transform = src.transform * src.transform.scale(factor)
+
+    return np.concatenate(strips), transform
+
+
+def draw_lines(canvas, rows, cols, color, width=1):
+    """Draw a polyline into an RGB canvas, in place.
+    All segments are sampled at once (one sample per pixel step).
+
+    Args:
+        canvas (numpy.ndarray): uint8 array (height, width, 3)
+        rows (numpy.ndarray): row coordinates of the vertices (float)
+        cols (numpy.ndarray): column coordinates of the vertices (float)
+        color (tuple[int]): RGB color
+        width (int): line width in pixels (default: 1)
+
+    Returns: None.
+    """
+    rows, cols = np.asarray(rows, dtype=np.float64), np.asarray(cols, dtype=np.float64)
+    if rows.size < 2:
+        draw_points(canvas, rows, cols, color, radius=width // 2)
+        return
+    d_rows, d_cols = np.diff(rows), np.diff(cols)
+    steps = np.maximum(np.ceil(np.maximum(np.abs(d_rows), np.abs(d_cols))), 1).astype(np.int64)
+    # Parameter t in [0, 1) for each sample of each segment
+    segment = np.repeat(np.arange(steps.size), steps)
+    t = (np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)) / steps[segment]
+    sample_rows = np.append(rows[segment] + t * d_rows[segment], rows[-1])
+    sample_cols = np.append(cols[segment] + t * d_cols[segment], cols[-1])
+    draw_points(canvas, sample_rows, sample_cols, color, radius=width // 2, square=True)
+
+
+def draw_points(canvas, rows, cols, color, radius=3, square=False):
+    """Draw filled discs (or squares) into an RGB canvas, in place;
+    pixels out of the canvas are clipped.
+
+    Args:
+        canvas (numpy.ndarray): uint8 array (height, width, 3)
+        rows (numpy.ndarray): row coordinates of the centers (float)
+        cols (numpy.ndarray): column coordinates of the centers (float)
+        color (tuple[int]): RGB color
+        radius (int): radius in pixels (default: 3)
+        square (bool): draw squares instead of discs (default: False)
+
+    Returns: None.
+    """
+    offset_rows, offset_cols = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    inside = np.ones(offset_rows.shape, dtype=bool) if square \
+        else offset_rows**2 + offset_cols**2 <= radius**2 + radius
+    offset_rows, offset_cols = offset_rows[inside], offset_cols[inside]
+    rows = np.rint(np.asarray(rows, dtype=np.float64)).astype(np.int64)
+    cols = np.rint(np.asarray(cols, dtype=np.float64)).astype(np.int64)
+    all_rows = (rows[:, np.newaxis] + offset_rows).ravel()
+    all_cols = (cols[:, np.newaxis] + offset_cols).ravel()
+    valid = (all_rows >= 0) & (all_rows < canvas.shape[0]) \
+        & (all_cols >= 0) & (all_cols < canvas.shape[1])
+    canvas[all_rows[valid], all_cols[valid]] = color
+
+
+def write_png(path, rgb):
+    """Write an RGB image as an 8-bit PNG file.
+
+    Args:
+        path (str): output path
+        rgb (numpy.ndarray): uint8 array (height, width, 3)
+
+    Returns: None.
+    """
+    height, width, _ = rgb.shape
+    # Each scanline starts with its filter type (0: none)
+    scanlines = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    scanlines[:, 1:] = rgb.reshape(height, width * 3)
+
+    def chunk(chunk_type, data):
+        return struct.pack(">I", len(data)) + chunk_type + data \
+            + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    with open(path, 'wb') as png:
+        png.write(b"\x89PNG\r\n\x1a\n")
+        png.write(chunk(b"IHDR", header))
+        png.write(chunk(b"IDAT", zlib.compress(scanlines.tobytes(), 6)))
+        png.write(chunk(b"IEND", b""))
+
+
+def _geometry_rings(geometry):
+    """Exterior and interior rings (or lines) of a shapely geometry."""
+    if geometry is None or geometry.is_empty:
+        return []
+    if hasattr(geometry, "geoms"):
+        return [ring for part in geometry.geoms for ring in _geometry_rings(part)]
+    if geometry.geom_type == "Polygon":
+        return [geometry.exterior] + list(geometry.interiors)
+    return [geometry]
+
+
+def render_quicklook(raster,
+                     transform,
+                     output_path=None,
+                     polygons=None,
+                     points=None,
+                     size=QUICKLOOK_SIZE,
+                     mode="mask",
+                     polygon_color=POLYGON_COLOR,
+                     point_color=POINT_COLOR,
+                     line_width=2,
+                     point_radius=4):
+    """Render a quicklook of a water mask or ND map with polygon
+    outlines and points, as an RGB image of fixed size.
+    The raster is block-reduced to fit in size (aspect ratio kept,
+    centered on a black background).
+
+    Args:
+        raster (numpy.ndarray): water mask (mode "mask") or float ND map
+            in [-1, 1] (mode "ndmap"), (height, width)
+        transform (affine.Affine): transform of the raster
+        output_path (str): PNG path; None to skip writing (default: None)
+        polygons (iterable): shapely geometries in the raster CRS,
+            e.g., a GeoSeries (default: None)
+        points (iterable): shapely points in the raster CRS (default: None)
+        size (tuple[int]): output (width, height) (default: (800, 800))
+        mode (str): "mask" or "ndmap" (default: "mask")
+        polygon_color (tuple[int]): RGB color of the outlines (default: red)
+        point_color (tuple[int]): RGB color of the points (default: blue)
+        line_width (int): outline width in pixels (default: 2)
+        point_radius (int): point radius in pixels (default: 4)
+
+    Returns:
+        canvas (numpy.ndarray): uint8 RGB array (size[1], size[0], 3)
+    """
+    out_width, out_height = size
+    height, width = raster.shape
+    factor = max(1, math.ceil(max(height / out_height, width / out_width)))
+    if mode == "mask":
+        overview = raster_overview(raster, factor, reduce="max")
+        gray = np.where(overview > 0, 255, 0).astype(np.uint8)
+    else:
+        overview = raster_overview(raster.astype(np.float32), factor, reduce="mean")
+        gray = np.nan_to_num((np.clip(overview, -1, 1) + 1) * 127.5).astype(np.uint8)
+    # Upscale the overview if the raster is smaller than the canvas
+    zoom = max(1, min(out_height // gray.shape[0], out_width // gray.shape[1]))
+    gray = np.repeat(np.repeat(gray, zoom, axis=0), zoom, axis=1)
+
+    canvas = np.zeros((out_height, out_width, 3), dtype=np.uint8)
+    row_off = (out_height - gray.shape[0]) // 2
+    col_off = (out_width - gray.shape[1]) // 2
+    canvas[row_off:row_off + gray.shape[0], col_off:col_off + gray.shape[1]] = gray[..., np.newaxis]
+
+    # World coordinates -> raster pixels -> canvas pixels
+    inverse = ~transform
+    scale = zoom / factor
+
+    def to_canvas(coords):
+        coords = np.asarray(coords, dtype=np.float64)
+        cols, rows = inverse * (coords[:, 0], coords[:, 1])
+        return (np.asarray(rows) * scale + row_off - 0.5,
+                np.asarray(cols) * scale + col_off - 0.5)
+
+    for geometry in polygons if polygons is not None else []:
+        for ring in _geometry_rings(geometry):
+            rows, cols = to_canvas(ring.coords)
+            draw_lines(canvas, rows, cols, polygon_color, width=line_width)
+    if points is not None:
+        coords = [(point.x, point.y) for point in points if not point.is_empty]
+        if coords:
+            rows, cols = to_canvas(coords)
+            draw_points(canvas, rows, cols, point_color, radius=point_radius)
+
+    if output_path is not None:
+        write_png(output_path, canvas)
+        logger.info("render_quicklook: quicklook saved: %s", output_path)
+
+    return canvas
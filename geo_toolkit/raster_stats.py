@@ -0,0 +1,358 @@
+"""This module contains the functions and classes to compute
+band and index (ND map) statistics in one streaming pass
+over block windows, without loading the full rasters.
+Per raster, the count, min, max, mean, variance, a fixed-bin
+histogram and approximate percentiles (from the histogram)
+are computed; the statistics of different blocks or workers
+are merged exactly (Chan et al. parallel update of mean and variance).
+The statistics are persisted in a JSON sidecar next to each
+raster (`<raster>.stats.json`) and reused for normalization
+and automatic thresholds (Otsu) instead of reloading the raster.
+These functions/classes are implemented and documented:
+
+    RunningStats
+    compute_raster_stats()
+    write_stats_sidecar()
+    load_stats_sidecar()
+    get_raster_stats()
+    otsu_threshold()
+    normalize_array()
+
+Author: Mikel Sagardia
+Date: 2023-04-28
+"""
+import json
+import os
+
+import numpy as np
+import rasterio as rio
+
+from .geo_library import logger
+from .streaming import iter_block_windows
+
+# Histogram ranges and bins: band digital numbers and ND maps;
+# values out of the range are counted in the first/last bin
+BAND_RANGE = (0, 20000)
+BAND_BINS = 2000
+INDEX_RANGE = (-1.0, 1.0)
+INDEX_BINS = 2000
+SIDECAR_SUFFIX = ".stats.json"
+
+
+class RunningStats:
+    """Mergeable statistics of a stream of values:
+    count, min, max, mean, variance and a fixed-bin histogram.
+
+    Args:
+        value_range (tuple[float]): range of the histogram (default: (-1, 1))
+        bins (int): number of histogram bins (default: 2000)
+    """
+    def __init__(self, value_range=INDEX_RANGE, bins=INDEX_BINS):
+        self.value_range = (float(value_range[0]), float(value_range[1]))
+        self.bins = int(bins)
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.histogram = np.zeros(self.bins, dtype=np.int64)
+
+    def update(self, values):
+        """Add a batch of values; NaNs must be removed by the caller.
+
+        Args:
+            values (numpy.ndarray): values of any shape
+
+        Returns:
+            self (RunningStats)
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if values.size == 0:
+            return self
+        batch = RunningStats(self.value_range, self.bins)
+        batch.count = values.size
+        batch.min = float(values.min())
+        batch.max = float(values.max())
+        batch.mean = float(values.mean())
+        batch.m2 = float(((values - batch.mean)**2).sum())
+        # Bin index computed directly: out-of-range values go to the end bins
+        low, high = self.value_range
+        index = ((values - low) * (self.bins / (high - low))).astype(np.int64)
+        np.clip(index, 0, self.bins - 1, out=index)
+        batch.histogram = np.bincount(index, minlength=self.bins)
+
+        return self.merge(batch)
+
+    def merge(self, other):
+        """Merge the statistics of another stream in place.
+
+        Args:
+            other (RunningStats): statistics with the same histogram bins
+
+        Returns:
+            self (RunningStats)
+        """
+        try:
+            assert other.value_range == self.value_range and other.bins == self.bins
+        except AssertionError as err:
+            logger.error("RunningStats: histograms with different bins cannot be merged.")
+            raise err
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.mean, self.m2 = other.mean, other.m2
+        else:
+            total = self.count + other.count
+            delta = other.mean - self.mean
+            self.m2 += other.m2 + delta**2 * self.count * other.count / total
+            self.mean += delta * other.count / total
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.histogram += other.histogram
+
+        return self
+
+    @property
+    def variance(self):
+        """Population variance of the values."""
+        return self.m2 / self.count if self.count > 0 else float("nan")
+
+    @property
+    def bin_edges(self):
+        """Edges of the histogram bins (bins + 1)."""
+        return np.linspace(self.value_range[0], self.value_range[1], self.bins + 1)
+
+    def percentile(self, q):
+        """Approximate percentile(s), interpolated linearly
+        within the histogram bins and clipped to [min, max].
+
+        Args:
+            q (float or array-like): percentile(s) in [0, 100]
+
+        Returns:
+            value (float or numpy.ndarray): percentile value(s)
+        """
+        cumulative = np.concatenate([[0], np.cumsum(self.histogram)])
+        values = np.interp(np.asarray(q, dtype=np.float64) / 100.0 * self.count,
+                           cumulative, self.bin_edges)
+
+        return np.clip(values, self.min, self.max)
+
+    def to_dict(self):
+        """Serializable dictionary of the statistics."""
+        return {"count": int(self.count),
+                "min": float(self.min) if self.count else None,
+                "max": float(self.max) if self.count else None,
+                "mean": float(self.mean),
+                "variance": float(self.variance) if self.count else None,
+                "m2": float(self.m2),
+                "percentiles": {str(q): float(self.percentile(q))
+                                for q in (1, 2, 5, 25, 50, 75, 95, 98, 99)}
+                               if self.count else {},
+                "value_range": list(self.value_range),
+                "bins": self.bins,
+                "histogram": self.histogram.tolist()}
+
+    @classmethod
+    def from_dict(cls, content):
+        """Create the statistics from a dictionary of to_dict().
+
+        Args:
+            content (dict): dictionary with the statistics
+
+        Returns:
+            stats (RunningStats)
+        """
+        stats = cls(content["value_range"], content["bins"])
+        stats.count = content["count"]
+        if stats.count:
+            stats.min, stats.max = content["min"], content["max"]
+        stats.mean, stats.m2 = content["mean"], content["m2"]
+        stats.histogram = np.asarray(content["histogram"], dtype=np.int64)
+
+        return stats
+
+
+def compute_raster_stats(path,
+                         block_size=1024,
+                         value_range=None,
+                         bins=None):
+    """Compute the statistics of the first band of a raster
+    in one pass over its block windows; each block is summarized
+    and merged. Nodata (0 for bands without nodata metadata) and NaN
+    pixels are ignored; compact (int16) ND maps are converted
+    with their scale and offset.
+
+    Args:
+        path (str): path of the raster
+        block_size (int): block side length (pixels) (default: 1024)
+        value_range (tuple[float]): histogram range; default: INDEX_RANGE
+            for ND maps (float or scaled), else BAND_RANGE
+        bins (int): number of histogram bins; default: INDEX_BINS or BAND_BINS
+
+    Returns:
+        stats (RunningStats): statistics of the raster
+    """
+    with rio.open(path, 'r') as src:
+        scale, offset = src.scales[0], src.offsets[0]
+        is_index = np.dtype(src.dtypes[0]).kind == 'f' or scale != 1.0
+        if value_range is None:
+            value_range = INDEX_RANGE if is_index else BAND_RANGE
+        if bins is None:
+            bins = INDEX_BINS if is_index else BAND_BINS
+        # Sentinel 2 bands without nodata metadata use 0 as nodata
+        nodata = src.nodata if src.nodata is not None or is_index else 0
+        stats = RunningStats(value_range, bins)
+        for window in iter_block_windows(src.height, src.width, block_size=block_size):
+            block = src.read(1, window=window)
+            valid = np.ones(block.shape, dtype=bool) if nodata is None \
+                else block != nodata
+            if block.dtype.kind == 'f':
+                valid &= ~np.isnan(block)
+            values = block[valid]
+            if scale != 1.0 or offset != 0.0:
+                values = values * scale + offset
+            stats.update(values)
+
+    logger.info("compute_raster_stats: %s: %d valid pixels, mean %.4f, std %.4f.",
+                path, stats.count, stats.mean, np.sqrt(stats.variance))
+
+    return stats
+
+
+def _sidecar_path(path):
+    """Path of the statistics sidecar of a raster."""
+    return path + SIDECAR_SUFFIX
+
+
+def write_stats_sidecar(path, stats):
+    """Persist the statistics of a raster in its JSON sidecar,
+    with the size and modification time of the raster
+    to detect stale sidecars.
+
+    Args:
+        path (str): path of the raster
+        stats (RunningStats): statistics of the raster
+
+    Returns:
+        sidecar_path (str): path of the sidecar
+    """
+    file_stat = os.stat(path)
+    content = stats.to_dict()
+    content["source"] = {"size": file_stat.st_size, "mtime": file_stat.st_mtime}
+    sidecar_path = _sidecar_path(path)
+    with open(sidecar_path, 'w', encoding='utf-8') as sidecar:
+        json.dump(content, sidecar)
+
+    return sidecar_path
+
+
+def load_stats_sidecar(path):
+    """Load the statistics of a raster from its sidecar.
+
+    Args:
+        path (str): path of the raster
+
+    Returns:
+        stats (RunningStats): statistics of the raster, or None if the
+            sidecar does not exist or the raster changed since it was written
+    """
+    sidecar_path = _sidecar_path(path)
+    if not os.path.isfile(sidecar_path):
+        return None
+    with open(sidecar_path, 'r', encoding='utf-8') as sidecar:
+        content = json.load(sidecar)
+    file_stat = os.stat(path)
+    if content.get("source") != {"size": file_stat.st_size, "mtime": file_stat.st_mtime}:
+        logger.info("load_stats_sidecar: stale sidecar ignored: %s", sidecar_path)
+        return None
+
+    return RunningStats.from_dict(content)
+
+
+def get_raster_stats(path, recompute=False, block_size=1024):
+    """Get the statistics of a raster from its sidecar
+    or, if missing or stale, compute and persist them.
+
+    Args:
+        path (str): path of the raster
+        recompute (bool): ignore the sidecar (default: False)
+        block_size (int): block side length (pixels) (default: 1024)
+
+    Returns:
+        stats (RunningStats): statistics of the raster
+    """
+    stats = None if recompute else load_stats_sidecar(path)
+    if stats is None:
+        stats = compute_raster_stats(path, block_size=block_size)
+        write_stats_sidecar(path, stats)
+
+    return stats
+
+
+def otsu_threshold(stats):
+    """Otsu threshold of a histogram: the bin edge which
+    maximizes the between-class variance.
+
+    Args:
+        stats (RunningStats): statistics with the histogram
+
+    Returns:
+        threshold (float): threshold value; values above it are
+            the upper class (e.g., water in an NDWI map)
+    """
+    try:
+        assert stats.count > 0
+    except AssertionError as err:
+        logger.error("otsu_threshold: empty histogram.")
+        raise err
+    edges = stats.bin_edges
+    centers = (edges[:-1] + edges[1:]) / 2
+    histogram = stats.histogram.astype(np.float64)
+    weight_low = np.cumsum(histogram)[:-1]
+    weight_high = stats.count - weight_low
+    sum_low = np.cumsum(histogram * centers)[:-1]
+    sum_total = (histogram * centers).sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_low = sum_low / weight_low
+        mean_high = (sum_total - sum_low) / weight_high
+        between = weight_low * weight_high * (mean_low - mean_high)**2
+    between = np.nan_to_num(between, nan=-1.0)
+    # Threshold at the upper edge of the last bin of the lower class
+    threshold = float(edges[int(np.argmax(between)) + 1])
+    logger.info("otsu_threshold: threshold %.4f.", threshold)
+
+    return threshold
+
+
+def normalize_array(array, stats, method="zscore", percentiles=(2, 98)):
+    """Normalize an array with precomputed statistics.
+
+    Args:
+        array (numpy.ndarray): array to normalize
+        stats (RunningStats): statistics of the raster of the array
+        method (str): "zscore" (mean 0, std 1), "minmax" (to [0, 1])
+            or "percentile" (percentiles to [0, 1], clipped) (default: "zscore")
+        percentiles (tuple[float]): percentiles of the "percentile" method
+            (default: (2, 98))
+
+    Returns:
+        normalized (numpy.ndarray): float32 normalized array
+    """
+    array = np.asarray(array, dtype=np.float32)
+    if method == "zscore":
+        low, span = stats.mean, np.sqrt(stats.variance)
+    elif method == "minmax":
+        low, span = stats.min, stats.max - stats.min
+    elif method == "percentile":
+        low, high = stats.percentile(percentiles)
+        span = high - low
+    else:
+        logger.error("normalize_array: unknown method: %s", method)
+        raise ValueError(f"Unknown normalization method: {method}")
+    normalized = (array - np.float32(low)) / np.float32(span if span > 0 else 1.0)
+    if method == "percentile":
+        np.clip(normalized, 0.0, 1.0, out=normalized)
+
+    return normalized
@@ -0,0 +1,501 @@
+"""This module contains the functions to persist
+the identified lake polygons of all processed scenes
+into a single GeoPackage (SQLite) results catalog
+with an R-tree spatial index, and to query it.
+These functions are implemented and documented:
+
+    create_results_catalog()
+    export_lakes_catalog()
+    query_catalog_bbox()
+    query_catalog_point()
+
+The catalog contains two tables:
+
+- `scenes`: attributes table with the scene metadata
+    and the paths of the raster products (bands, NDVI, NDWI).
+- `lakes`: features table with the lake polygons,
+    the scene they belong to and the id from `lakes.geojson`.
+    Its geometries are indexed in `rtree_lakes_geom`, which is
+    kept up to date by the standard GeoPackage R-tree triggers,
+    so edits done with GDAL/QGIS/geopandas are indexed too.
+
+All geometries are stored in a common CRS (EPSG:4326 by default),
+so that queries can span scenes from different UTM zones.
+Writes are done in a single IMMEDIATE transaction per scene
+and the database uses WAL journaling, so that several
+batch workers can export to the same catalog.
+
+Author: Mikel Sagardia
+Date: 2023-04-12
+"""
+import json
+import struct
+import sqlite3
+from datetime import datetime, timezone
+from functools import partial
+
+import geopandas as gpd
+import shapely
+from pyproj import CRS
+
+from .geo_library import logger
+
+# GeoPackage identifiers: application_id = "GPKG", user_version = 1.2.0
+GPKG_APPLICATION_ID = 0x47504B47
+GPKG_USER_VERSION = 10200
+LAKES_TABLE = "lakes"
+SCENES_TABLE = "scenes"
+GEOMETRY_COLUMN = "geom"
+RTREE_TABLE = f"rtree_{LAKES_TABLE}_{GEOMETRY_COLUMN}"
+GPKG_CORE_TABLES = [
+    """CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (
+        srs_name TEXT NOT NULL,
+        srs_id INTEGER NOT NULL PRIMARY KEY,
+        organization TEXT NOT NULL,
+        organization_coordsys_id INTEGER NOT NULL,
+        definition TEXT NOT NULL,
+        description TEXT)""",
+    """CREATE TABLE IF NOT EXISTS gpkg_contents (
+        table_name TEXT NOT NULL PRIMARY KEY,
+        data_type TEXT NOT NULL,
+        identifier TEXT UNIQUE,
+        description TEXT DEFAULT '',
+        last_change DATETIME NOT NULL DEFAULT
+            (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+        min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,
+        srs_id INTEGER)""",
+    """CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (
+        table_name TEXT NOT NULL,
+        column_name TEXT NOT NULL,
+        geometry_type_name TEXT NOT NULL,
+        srs_id INTEGER NOT NULL,
+        z TINYINT NOT NULL,
+        m TINYINT NOT NULL,
+        CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name))""",
+    """CREATE TABLE IF NOT EXISTS gpkg_extensions (
+        table_name TEXT,
+        column_name TEXT,
+        extension_name TEXT NOT NULL,
+        definition TEXT NOT NULL,
+        scope TEXT NOT NULL,
+        CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name))""",
+]
+# Triggers of the GeoPackage R-tree extension (spec 1.2);
+# {t}: table, {c}: geometry column, {i}: primary key, {r}: R-tree table
+GPKG_RTREE_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS {r}_insert AFTER INSERT ON {t}
+    WHEN (NEW.{c} NOT NULL AND NOT ST_IsEmpty(NEW.{c}))
+    BEGIN
+        INSERT OR REPLACE INTO {r} VALUES (NEW.{i},
+            ST_MinX(NEW.{c}), ST_MaxX(NEW.{c}),
+            ST_MinY(NEW.{c}), ST_MaxY(NEW.{c}));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS {r}_update1 AFTER UPDATE OF {c} ON {t}
+    WHEN OLD.{i} = NEW.{i} AND (NEW.{c} NOTNULL AND NOT ST_IsEmpty(NEW.{c}))
+    BEGIN
+        INSERT OR REPLACE INTO {r} VALUES (NEW.{i},
+            ST_MinX(NEW.{c}), ST_MaxX(NEW.{c}),
+            ST_MinY(NEW.{c}), ST_MaxY(NEW.{c}));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS {r}_update2 AFTER UPDATE OF {c} ON {t}
+    WHEN OLD.{i} = NEW.{i} AND (NEW.{c} ISNULL OR ST_IsEmpty(NEW.{c}))
+    BEGIN
+        DELETE FROM {r} WHERE id = OLD.{i};
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS {r}_update3 AFTER UPDATE ON {t}
+    WHEN OLD.{i} != NEW.{i} AND (NEW.{c} NOTNULL AND NOT ST_IsEmpty(NEW.{c}))
+    BEGIN
+        DELETE FROM {r} WHERE id = OLD.{i};
+        INSERT OR REPLACE INTO {r} VALUES (NEW.{i},
+            ST_MinX(NEW.{c}), ST_MaxX(NEW.{c}),
+            ST_MinY(NEW.{c}), ST_MaxY(NEW.{c}));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS {r}_update4 AFTER UPDATE ON {t}
+    WHEN OLD.{i} != NEW.{i} AND (NEW.{c} ISNULL OR ST_IsEmpty(NEW.{c}))
+    BEGIN
+        DELETE FROM {r} WHERE id IN (OLD.{i}, NEW.{i});
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS {r}_delete AFTER DELETE ON {t}
+    WHEN OLD.{c} NOT NULL
+    BEGIN
+        DELETE FROM {r} WHERE id = OLD.{i};
+    END""",
+]
+# Seconds a worker waits for the write lock of another worker
+BUSY_TIMEOUT = 60
+
+
+def _connect(catalog_path):
+    """Open a connection to the catalog with the settings
+    required for concurrent access (WAL, busy timeout).
+    Transactions are handled explicitly (isolation_level=None).
+    The SQL functions used by the R-tree triggers (ST_IsEmpty,
+    ST_MinX, ST_MaxX, ST_MinY, ST_MaxY) are registered,
+    as GDAL does when it opens a GeoPackage.
+
+    Args:
+        catalog_path (str): path of the GeoPackage file.
+
+    Returns:
+        conn (sqlite3.Connection): connection to the catalog.
+    """
+    conn = sqlite3.connect(catalog_path,
+                           timeout=BUSY_TIMEOUT,
+                           isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.create_function("ST_IsEmpty", 1,
+                         lambda blob: int(_gpkg_envelope(blob) is None),
+                         deterministic=True)
+    for position, name in enumerate(["ST_MinX", "ST_MaxX", "ST_MinY", "ST_MaxY"]):
+        conn.create_function(name, 1,
+                             partial(_gpkg_envelope_value, position=position),
+                             deterministic=True)
+
+    return conn
+
+
+def _catalog_srs_id(conn):
+    """Get the SRS id of the lakes geometry column.
+
+    Args:
+        conn (sqlite3.Connection): connection to the catalog.
+
+    Returns:
+        srs_id (int): EPSG code of the catalog geometries.
+    """
+    row = conn.execute("SELECT srs_id FROM gpkg_geometry_columns "
+                       "WHERE table_name = ?", (LAKES_TABLE,)).fetchone()
+
+    return row[0]
+
+
+def _geometry_to_gpkg(geometry, srs_id):
+    """Encode a shapely geometry as a GeoPackage geometry blob:
+    header with XY envelope + little endian WKB.
+
+    Args:
+        geometry (shapely.Geometry): geometry to encode.
+        srs_id (int): SRS id of the geometry.
+
+    Returns:
+        blob (bytes): GeoPackage binary geometry.
+        envelope (tuple[float]): minx, maxx, miny, maxy.
+    """
+    minx, miny, maxx, maxy = geometry.bounds
+    envelope = (minx, maxx, miny, maxy)
+    # flags: little endian (bit 0) + XY envelope (envelope type 1, bits 1-3)
+    header = struct.pack("<2sBBi4d", b"GP", 0, 0b00000011, srs_id, *envelope)
+    wkb = shapely.to_wkb(geometry, byte_order=1)
+
+    return header + wkb, envelope
+
+
+def _gpkg_to_geometry(blob):
+    """Decode a GeoPackage geometry blob into a shapely geometry.
+
+    Args:
+        blob (bytes): GeoPackage binary geometry.
+
+    Returns:
+        geometry (shapely.Geometry): decoded geometry.
+    """
+    flags = blob[3]
+    envelope_type = (flags >> 1) & 0b111
+    # Envelope sizes in doubles: none, XY, XYZ, XYM, XYZM
+    envelope_doubles = (0, 4, 6, 6, 8)[envelope_type]
+
+    return shapely.from_wkb(blob[8 + 8*envelope_doubles:])
+
+
+def _gpkg_envelope(blob):
+    """Get the XY envelope of a GeoPackage geometry blob;
+    it is read from the header if present, otherwise
+    it is computed from the geometry.
+
+    Args:
+        blob (bytes): GeoPackage binary geometry.
+
+    Returns:
+        envelope (tuple[float]): minx, maxx, miny, maxy;
+            None if the blob is NULL or the geometry is empty.
+    """
+    if blob is None:
+        return None
+    flags = blob[3]
+    # Empty geometry flag (bit 4)
+    if flags & 0b00010000:
+        return None
+    if (flags >> 1) & 0b111:
+        byte_order = "<" if flags & 0b1 else ">"
+        return struct.unpack(f"{byte_order}4d", blob[8:40])
+    geometry = _gpkg_to_geometry(blob)
+    if geometry.is_empty:
+        return None
+    minx, miny, maxx, maxy = geometry.bounds
+
+    return (minx, maxx, miny, maxy)
+
+
+def _gpkg_envelope_value(blob, position):
+    """Get one coordinate of the XY envelope of a GeoPackage
+    geometry blob; used for ST_MinX, ST_MaxX, ST_MinY, ST_MaxY.
+
+    Args:
+        blob (bytes): GeoPackage binary geometry.
+        position (int): 0: minx, 1: maxx, 2: miny, 3: maxy.
+
+    Returns:
+        value (float): coordinate; None for NULL/empty geometries.
+    """
+    envelope = _gpkg_envelope(blob)
+
+    return None if envelope is None else envelope[position]
+
+
+def create_results_catalog(catalog_path, srs_epsg=4326):
+    """Create an empty GeoPackage results catalog
+    if it does not exist yet. The catalog contains
+    the GeoPackage core tables, the `scenes` attributes table,
+    the `lakes` features table and its R-tree spatial index
+    with the triggers which maintain it. Missing tables
+    and triggers are added to an existing catalog.
+
+    Args:
+        catalog_path (str): path of the GeoPackage file.
+        srs_epsg (int): EPSG code of the CRS in which
+            all lake geometries are stored (default: 4326).
+
+    Returns: None.
+    """
+    crs = CRS.from_epsg(srs_epsg)
+    conn = _connect(catalog_path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(f"PRAGMA application_id = {GPKG_APPLICATION_ID}")
+        conn.execute(f"PRAGMA user_version = {GPKG_USER_VERSION}")
+        # Note: executescript() would commit the IMMEDIATE transaction
+        for statement in GPKG_CORE_TABLES:
+            conn.execute(statement)
+        srs_rows = [
+            ("Undefined cartesian SRS", -1, "NONE", -1, "undefined", None),
+            ("Undefined geographic SRS", 0, "NONE", 0, "undefined", None),
+            (crs.name, srs_epsg, "EPSG", srs_epsg, crs.to_wkt("WKT1_GDAL"), None)
+        ]
+        conn.executemany("INSERT OR IGNORE INTO gpkg_spatial_ref_sys "
+                         "VALUES (?, ?, ?, ?, ?, ?)", srs_rows)
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {SCENES_TABLE} (
+                scene_id TEXT NOT NULL PRIMARY KEY,
+                tile TEXT,
+                sensing_date TEXT,
+                crs TEXT,
+                band_paths TEXT,
+                ndvi_path TEXT,
+                ndwi_path TEXT,
+                metadata TEXT,
+                lake_count INTEGER,
+                processed_at TEXT)""")
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {LAKES_TABLE} (
+                fid INTEGER PRIMARY KEY AUTOINCREMENT,
+                {GEOMETRY_COLUMN} BLOB,
+                scene_id TEXT NOT NULL,
+                lake_id TEXT)""")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{LAKES_TABLE}_scene "
+                     f"ON {LAKES_TABLE} (scene_id)")
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {RTREE_TABLE} "
+                     "USING rtree(id, minx, maxx, miny, maxy)")
+        for trigger in GPKG_RTREE_TRIGGERS:
+            conn.execute(trigger.format(t=LAKES_TABLE, c=GEOMETRY_COLUMN,
+                                        i="fid", r=RTREE_TABLE))
+        conn.execute("INSERT OR IGNORE INTO gpkg_contents "
+                     "(table_name, data_type, identifier, srs_id) "
+                     "VALUES (?, 'features', ?, ?)",
+                     (LAKES_TABLE, LAKES_TABLE, srs_epsg))
+        conn.execute("INSERT OR IGNORE INTO gpkg_contents "
+                     "(table_name, data_type, identifier) "
+                     "VALUES (?, 'attributes', ?)",
+                     (SCENES_TABLE, SCENES_TABLE))
+        conn.execute("INSERT OR IGNORE INTO gpkg_geometry_columns "
+                     "VALUES (?, ?, 'GEOMETRY', ?, 0, 0)",
+                     (LAKES_TABLE, GEOMETRY_COLUMN, srs_epsg))
+        conn.execute("INSERT OR IGNORE INTO gpkg_extensions VALUES "
+                     "(?, ?, 'gpkg_rtree_index', "
+                     "'http://www.geopackage.org/spec120/#extension_rtree', "
+                     "'write-only')",
+                     (LAKES_TABLE, GEOMETRY_COLUMN))
+        conn.execute("COMMIT")
+    except sqlite3.Error as err:
+        conn.execute("ROLLBACK")
+        logger.error("create_results_catalog: catalog could not be created: %s",
+                     catalog_path)
+        raise err
+    finally:
+        conn.close()
+
+    logger.info("create_results_catalog: catalog ready: %s", catalog_path)
+
+
+def export_lakes_catalog(catalog_path,
+                         gdf_lakes,
+                         scene_id,
+                         scene_metadata=None,
+                         id_column="id"):
+    """Insert the lake polygons of a scene into the results catalog,
+    together with the scene metadata. All rows of the scene are
+    written in one transaction; previous rows of the same scene
+    are replaced, so re-processing a scene is idempotent.
+    The catalog is created if it does not exist; the R-tree
+    is maintained by the triggers of the catalog.
+
+    Args:
+        catalog_path (str): path of the GeoPackage file.
+        gdf_lakes (geopandas.GeoDataFrame): lake polygons with a CRS
+            and the column id_column (id from `lakes.geojson`).
+        scene_id (str): unique scene identifier, e.g., "scene_1".
+        scene_metadata (dict): optional scene metadata; the keys
+            tile, sensing_date, band_paths, ndvi_path and ndwi_path
+            are stored in their own columns, the rest as JSON.
+        id_column (str): column of gdf_lakes with the lake id
+            (default: "id").
+
+    Returns:
+        lake_count (int): number of inserted lake polygons.
+    """
+    scene_metadata = dict(scene_metadata or {})
+    # Also adds the R-tree triggers to catalogs created without them
+    create_results_catalog(catalog_path)
+
+    try:
+        assert gdf_lakes.crs is not None
+    except AssertionError as err:
+        logger.error("export_lakes_catalog: gdf_lakes has no CRS (scene %s).",
+                     scene_id)
+        raise err
+
+    conn = _connect(catalog_path)
+    try:
+        srs_id = _catalog_srs_id(conn)
+        geometries = gdf_lakes.geometry.to_crs(epsg=srs_id).values
+        lake_ids = [None if lake_id is None else str(lake_id)
+                    for lake_id in gdf_lakes[id_column]]
+
+        # Encode everything before taking the write lock
+        rows = []
+        for geometry, lake_id in zip(geometries, lake_ids):
+            blob, _ = _geometry_to_gpkg(geometry, srs_id)
+            rows.append((blob, scene_id, lake_id))
+
+        scene_row = (scene_id,
+                     scene_metadata.pop("tile", None),
+                     scene_metadata.pop("sensing_date", None),
+                     gdf_lakes.crs.to_string(),
+                     json.dumps(scene_metadata.pop("band_paths", [])),
+                     scene_metadata.pop("ndvi_path", None),
+                     scene_metadata.pop("ndwi_path", None),
+                     json.dumps(scene_metadata, default=str),
+                     len(rows),
+                     datetime.now(timezone.utc).isoformat())
+
+        conn.execute("BEGIN IMMEDIATE")
+        # Replace previous results of the scene;
+        # the triggers update the R-tree
+        conn.execute(f"DELETE FROM {LAKES_TABLE} WHERE scene_id = ?",
+                     (scene_id,))
+        conn.execute(f"INSERT OR REPLACE INTO {SCENES_TABLE} "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", scene_row)
+        conn.executemany(f"INSERT INTO {LAKES_TABLE} "
+                         f"({GEOMETRY_COLUMN}, scene_id, lake_id) "
+                         "VALUES (?, ?, ?)", rows)
+        # Update the extent of the layer
+        extent = conn.execute(f"SELECT MIN(minx), MIN(miny), MAX(maxx), MAX(maxy) "
+                              f"FROM {RTREE_TABLE}").fetchone()
+        conn.execute("UPDATE gpkg_contents SET min_x = ?, min_y = ?, "
+                     "max_x = ?, max_y = ?, "
+                     "last_change = strftime('%Y-%m-%dT%H:%M:%fZ','now') "
+                     "WHERE table_name = ?", (*extent, LAKES_TABLE))
+        conn.execute("COMMIT")
+    except sqlite3.Error as err:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        logger.error("export_lakes_catalog: scene %s could not be exported to %s",
+                     scene_id, catalog_path)
+        raise err
+    finally:
+        conn.close()
+
+    logger.info("export_lakes_catalog: %d lake polygons of %s exported to %s.",
+                len(rows), scene_id, catalog_path)
+
+    return len(rows)
+
+
+def query_catalog_bbox(catalog_path, bbox, scene_ids=None):
+    """Get all lake polygons of all scenes which intersect
+    a bounding box. Candidates are taken from the R-tree
+    and then filtered with the exact geometry.
+
+    Args:
+        catalog_path (str): path of the GeoPackage file.
+        bbox (list[float]): minx, miny, maxx, maxy in the catalog CRS
+            (lng/lat for the default EPSG:4326).
+        scene_ids (list[str]): optional list of scenes to restrict
+            the query to (default: None, all scenes).
+
+    Returns:
+        gdf (geopandas.GeoDataFrame): lake polygons with the columns
+            fid, scene_id, lake_id, geometry and the scene metadata
+            columns sensing_date, tile, ndvi_path and ndwi_path.
+    """
+    minx, miny, maxx, maxy = bbox
+    sql = (f"SELECT l.fid, l.scene_id, l.lake_id, l.{GEOMETRY_COLUMN}, "
+           "s.tile, s.sensing_date, s.ndvi_path, s.ndwi_path "
+           f"FROM {RTREE_TABLE} r "
+           f"JOIN {LAKES_TABLE} l ON l.fid = r.id "
+           f"LEFT JOIN {SCENES_TABLE} s ON s.scene_id = l.scene_id "
+           "WHERE r.maxx >= ? AND r.minx <= ? AND r.maxy >= ? AND r.miny <= ?")
+    params = [minx, maxx, miny, maxy]
+    if scene_ids:
+        sql += f" AND l.scene_id IN ({', '.join('?' * len(scene_ids))})"
+        params.extend(scene_ids)
+
+    conn = _connect(catalog_path)
+    try:
+        srs_id = _catalog_srs_id(conn)
+        rows = conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+    columns = ["fid", "scene_id", "lake_id", "geometry",
+               "tile", "sensing_date", "ndvi_path", "ndwi_path"]
+    records = {column: [row[i] for row in rows]
+               for i, column in enumerate(columns)}
+    records["geometry"] = [_gpkg_to_geometry(blob) for blob in records["geometry"]]
+    gdf = gpd.GeoDataFrame(records, geometry="geometry", crs=f"EPSG:{srs_id}")
+
+    # Exact filter of the R-tree candidates
+    query_box = shapely.box(minx, miny, maxx, maxy)
+    gdf = gdf[gdf.intersects(query_box)].reset_index(drop=True)
+
+    return gdf
+
+
+def query_catalog_point(catalog_path, x, y, scene_ids=None):
+    """Get all lake polygons of all scenes which contain a point.
+
+    Args:
+        catalog_path (str): path of the GeoPackage file.
+        x (float): x coordinate (longitude for EPSG:4326).
+        y (float): y coordinate (latitude for EPSG:4326).
+        scene_ids (list[str]): optional list of scenes to restrict
+            the query to (default: None, all scenes).
+
+    Returns:
+        gdf (geopandas.GeoDataFrame): lake polygons which contain
+            the point; same columns as in query_catalog_bbox().
+    """
+    gdf = query_catalog_bbox(catalog_path, [x, y, x, y], scene_ids=scene_ids)
+    gdf = gdf[gdf.intersects(shapely.Point(x, y))].reset_index(drop=True)
+
+    return gdf
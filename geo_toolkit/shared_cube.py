@@ -0,0 +1,317 @@
+"""This module contains a band cube (band, height, width)
+backed by shared memory (multiprocessing.shared_memory)
+or by a memory-mapped file, so that process pool workers
+attach to it by name, zero-copy, instead of receiving
+a pickled copy of the whole cube with every task.
+Only a small descriptor (name, shape, dtype, band names)
+is sent to the workers; the helpers below hand
+row blocks of the cube to a process pool.
+
+Lifecycle: the creating process owns the segment and
+unlinks it on close(), when the object is garbage-collected
+or at interpreter exit; if the owner crashes, the
+multiprocessing resource tracker unlinks the shared memory.
+Memory-mapped files of crashed owners cannot be removed then:
+their name contains the owner process id and they are removed
+when the next memmap cube is created in the same folder (POSIX).
+Workers attach without registering the segment, so their exit
+never removes it.
+These functions/classes are implemented and documented:
+
+    SharedBandCube
+    iter_row_blocks()
+    map_blocks()
+
+Author: Mikel Sagardia
+Date: 2023-04-30
+"""
+import mmap
+import os
+import re
+import sys
+import tempfile
+import uuid
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .geo_library import logger
+
+# Cubes attached in the current (worker) process, by name;
+# the oldest ones are released beyond _MAX_ATTACHED
+_ATTACHED = {}
+_MAX_ATTACHED = 4
+# geo_cube_<uuid>_<owner pid>.dat
+_MEMMAP_PATTERN = re.compile(r"^geo_cube_[0-9a-f]{16}_(?P<pid>\d+)\.dat$")
+
+
+class _AttachedSegment:
+    """Mapping of an existing POSIX shared memory segment, opened
+    without the resource tracker (same interface as SharedMemory
+    for the attached cubes: buf and close())."""
+    def __init__(self, name):
+        # pylint: disable=import-outside-toplevel
+        import _posixshmem
+        fd = _posixshmem.shm_open("/" + name, os.O_RDWR, mode=0o600)
+        try:
+            self._mmap = mmap.mmap(fd, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
+        self.buf = memoryview(self._mmap)
+
+    def close(self):
+        """Release the mapping; BufferError if views are alive."""
+        self.buf.release()
+        self._mmap.close()
+
+
+def _attach_shared_memory(name):
+    """Attach to an existing shared memory segment without
+    registering it in the resource tracker, which would unlink
+    it when this process exits (or, if the tracker is shared with
+    the owner, drop the owner registration when unregistered).
+
+    Args:
+        name (str): name of the segment
+
+    Returns:
+        shm (multiprocessing.shared_memory.SharedMemory or _AttachedSegment)
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    if os.name != "posix":
+        # Windows segments are not tracked
+        return shared_memory.SharedMemory(name=name)
+    # Before Python 3.13, SharedMemory always registers the segment
+    return _AttachedSegment(name)
+
+
+def _remove_stale_files(directory):
+    """Remove the memmap files of owners which are no longer running
+    (crashed before removing them); only on POSIX, where a process id
+    can be probed without side effects."""
+    if os.name != "posix":
+        return
+    for filename in os.listdir(directory):
+        match = _MEMMAP_PATTERN.match(filename)
+        if match is None:
+            continue
+        try:
+            os.kill(int(match.group("pid")), 0)
+        except ProcessLookupError:
+            try:
+                os.remove(os.path.join(directory, filename))
+                logger.info("SharedBandCube: stale memmap file removed: %s", filename)
+            except FileNotFoundError:
+                pass
+        except PermissionError:
+            # The process exists (another user)
+            pass
+
+
+def _release(shm, path, owner):
+    """Close the mapping and, for the owner, remove the segment/file."""
+    if shm is not None:
+        try:
+            shm.close()
+        except BufferError:
+            # Views of the cube are still alive; the mapping is freed with them
+            pass
+        if owner:
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+    elif owner and path is not None and os.path.isfile(path):
+        os.remove(path)
+
+
+class SharedBandCube:
+    """Band cube in shared memory or in a memory-mapped file.
+    Create it with from_array() or empty(); attach to it in
+    other processes with attach(descriptor).
+
+    Args:
+        descriptor (dict): name or path, shape, dtype, band names and backend
+        owner (bool): if True, this object removes the segment/file
+            when closed (default: False)
+    """
+    def __init__(self, descriptor, owner=False):
+        self.descriptor = descriptor
+        self.owner = owner
+        self.band_names = descriptor["band_names"]
+        shape, dtype = tuple(descriptor["shape"]), np.dtype(descriptor["dtype"])
+        self._shm = None
+        path = None
+        if descriptor["backend"] == "shm":
+            if owner:
+                nbytes = max(1, int(np.prod(shape)) * dtype.itemsize)
+                self._shm = shared_memory.SharedMemory(name=descriptor["name"],
+                                                       create=True,
+                                                       size=nbytes)
+            else:
+                self._shm = _attach_shared_memory(descriptor["name"])
+            self.array = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf)
+        else:
+            path = descriptor["path"]
+            self.array = np.memmap(path, dtype=dtype, shape=shape,
+                                   mode="w+" if owner else "r+")
+        self._finalizer = weakref.finalize(self, _release, self._shm, path, owner)
+
+    @classmethod
+    def empty(cls, shape, dtype, band_names=None, backend="shm", directory=None):
+        """Create an empty (zeroed) shared band cube.
+
+        Args:
+            shape (tuple[int]): (band, height, width)
+            dtype (numpy.dtype): data type
+            band_names (list[str]): band names (default: None)
+            backend (str): "shm" (shared memory) or "memmap"
+                (memory-mapped file) (default: "shm")
+            directory (str): folder of the memmap file; stale files of
+                crashed owners are removed from it (default: system
+                temporary folder)
+
+        Returns:
+            cube (SharedBandCube): owner of the new cube
+        """
+        try:
+            assert backend in ("shm", "memmap")
+        except AssertionError as err:
+            logger.error("SharedBandCube: unknown backend: %s", backend)
+            raise err
+        name = f"geo_cube_{uuid.uuid4().hex[:16]}"
+        descriptor = {"backend": backend,
+                      "name": name,
+                      "path": None,
+                      "shape": [int(size) for size in shape],
+                      "dtype": np.dtype(dtype).str,
+                      "band_names": list(band_names) if band_names is not None else None}
+        if backend == "memmap":
+            directory = directory or tempfile.gettempdir()
+            _remove_stale_files(directory)
+            descriptor["path"] = os.path.join(directory, f"{name}_{os.getpid()}.dat")
+
+        return cls(descriptor, owner=True)
+
+    @classmethod
+    def from_array(cls, images, band_names=None, backend="shm", directory=None):
+        """Create a shared band cube with a copy of an array,
+        e.g., the output of load_bands().
+
+        Args:
+            images (numpy.ndarray): band cube (band, height, width)
+            band_names (list[str]): band names (default: None)
+            backend (str): "shm" or "memmap" (default: "shm")
+            directory (str): folder of the memmap file (default: temp folder)
+
+        Returns:
+            cube (SharedBandCube): owner of the new cube
+        """
+        cube = cls.empty(images.shape, images.dtype, band_names, backend, directory)
+        cube.array[...] = images
+        logger.info("SharedBandCube: %s cube %s (%.1f MB) created.",
+                    backend, images.shape, images.nbytes / 2**20)
+
+        return cube
+
+    @classmethod
+    def attach(cls, descriptor):
+        """Attach to a cube created in another process (zero-copy).
+        In a process, the last attached cubes are cached by name.
+
+        Args:
+            descriptor (dict): descriptor of the cube
+
+        Returns:
+            cube (SharedBandCube): attached (non-owner) cube
+        """
+        key = descriptor["name"]
+        if key in _ATTACHED:
+            _ATTACHED[key] = _ATTACHED.pop(key)
+        else:
+            while len(_ATTACHED) >= _MAX_ATTACHED:
+                _ATTACHED.pop(next(iter(_ATTACHED))).close()
+            _ATTACHED[key] = cls(descriptor, owner=False)
+
+        return _ATTACHED[key]
+
+    def close(self):
+        """Release the cube; the owner removes the segment/file."""
+        self.array = None
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_row_blocks(height, block_rows):
+    """Iterate over the row blocks of a cube.
+
+    Args:
+        height (int): number of rows
+        block_rows (int): number of rows per block
+
+    Yields:
+        row_start (int), row_stop (int)
+    """
+    for row_start in range(0, height, block_rows):
+        yield row_start, min(row_start + block_rows, height)
+
+
+def _run_block(descriptor, function, row_start, row_stop, args):
+    """Worker task: attach to the cube and apply function to a row block."""
+    cube = SharedBandCube.attach(descriptor)
+
+    return function(cube.array[:, row_start:row_stop], cube.band_names, *args)
+
+
+def map_blocks(function,
+               cube,
+               args=(),
+               block_rows=None,
+               max_workers=None,
+               executor=None):
+    """Apply a function to the row blocks of a shared band cube
+    on a process pool. Workers receive only the cube descriptor
+    and the block rows, and attach to the cube zero-copy:
+
+        function(images_block, band_names, *args) -> result
+
+    Args:
+        function (callable): picklable (module-level) function
+        cube (SharedBandCube): shared band cube
+        args (tuple): extra arguments of function (default: ())
+        block_rows (int): rows per block; default: height split
+            evenly among the workers
+        max_workers (int): number of processes (default: os.cpu_count())
+        executor (concurrent.futures.Executor): pool to reuse (default: None,
+            a ProcessPoolExecutor is created and shut down)
+
+    Returns:
+        results (list): results of the blocks, in row order
+    """
+    height = cube.array.shape[1]
+    max_workers = max_workers or os.cpu_count() or 1
+    if block_rows is None:
+        block_rows = max(1, -(-height // max_workers))
+    blocks = list(iter_row_blocks(height, block_rows))
+
+    pool = executor or ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [pool.submit(_run_block, cube.descriptor, function,
+                               row_start, row_stop, args)
+                   for row_start, row_stop in blocks]
+        results = [future.result() for future in futures]
+    finally:
+        if executor is None:
+            pool.shutdown()
+    logger.info("map_blocks: %s applied to %d row blocks.",
+                getattr(function, "__name__", function), len(blocks))
+
+    return results
@@ -0,0 +1,292 @@
+"""This module contains the functions to apply linear
+spectral transforms to the band cube, as alternatives to the NDWI
+when its quality is poor (see README, Step 3):
+
+- Tasseled cap transformation with built-in Sentinel 2 coefficients.
+- Principal Component Analysis (PCA), fitted incrementally
+  on pixel samples streamed block by block.
+
+A transform is a coefficient matrix (components, bands) applied
+as one chunked float32 matrix multiplication over (bands, H*W),
+so memory stays bounded by the chunk size.
+These functions/classes are implemented and documented:
+
+    apply_linear_transform()
+    tasseled_cap()
+    StreamingPCA
+    fit_pca_streaming()
+    persist_components()
+
+Author: Mikel Sagardia
+Date: 2023-04-24
+"""
+import os
+
+import numpy as np
+import rasterio as rio
+
+from .geo_library import logger
+from .streaming import iter_band_blocks
+
+# Tasseled cap coefficients for Sentinel 2 top-of-atmosphere reflectance
+# Shi, T., Xu, H. (2019). Derivation of Tasseled Cap Transformation
+# Coefficients for Sentinel-2 MSI At-Sensor Reflectance Data. IEEE JSTARS.
+TASSELED_CAP_S2 = {
+    "bands": ['02', '03', '04', '8A', '11', '12'],
+    "components": ["brightness", "greenness", "wetness"],
+    "coefficients": [
+        [0.3510, 0.3813, 0.3437, 0.7196, 0.2396, 0.1949],
+        [-0.3599, -0.3533, -0.4734, 0.6633, 0.0087, -0.2856],
+        [0.2578, 0.2305, 0.0883, 0.1071, -0.7611, -0.5308]
+    ]
+}
+# L1C digital numbers to reflectance: reflectance = DN * scale + offset
+# (since processing baseline 04.00, offset = -0.1)
+REFLECTANCE_SCALE = 1e-4
+# Number of pixels transformed at once
+CHUNK_SIZE = 2**18
+COMPONENT_NODATA = -9999
+
+
+def apply_linear_transform(images,
+                           band_names,
+                           coefficients,
+                           coefficient_bands,
+                           intercept=None,
+                           scale=1.0,
+                           offset=0.0,
+                           chunk_size=CHUNK_SIZE):
+    """Apply a linear transform to a band cube:
+
+    components = coefficients @ (bands * scale + offset) + intercept
+
+    The cube is processed in chunks of chunk_size pixels as
+    float32 matrix multiplications over (bands, pixels).
+    Pixels where all the used bands are 0 are set to COMPONENT_NODATA.
+
+    Args:
+        images (numpy.ndarray): band cube (band, height, width)
+        band_names (list[str]): band names associated to the images
+        coefficients (array-like): matrix (components, len(coefficient_bands))
+        coefficient_bands (list[str]): band names of the coefficient columns
+        intercept (array-like): optional vector (components,) (default: None)
+        scale (float): scale applied to the band values (default: 1.0)
+        offset (float): offset applied to the band values (default: 0.0)
+        chunk_size (int): number of pixels per chunk (default: 2**18)
+
+    Returns:
+        components (numpy.ndarray): float32 array (component, height, width)
+    """
+    try:
+        assert all(band in band_names for band in coefficient_bands)
+    except AssertionError as err:
+        logger.error("apply_linear_transform: bands %s are required, available: %s",
+                     coefficient_bands, band_names)
+        raise err
+
+    indices = [band_names.index(band) for band in coefficient_bands]
+    coefficients = np.asarray(coefficients, dtype=np.float32)
+    if intercept is not None:
+        intercept = np.asarray(intercept, dtype=np.float32)[:, np.newaxis]
+    _, height, width = images.shape
+    num_pixels = height * width
+    # View (not copy) of the contiguous cube as (bands, pixels)
+    cube = images.reshape(images.shape[0], num_pixels)
+
+    components = np.empty((coefficients.shape[0], num_pixels), dtype=np.float32)
+    for start in range(0, num_pixels, chunk_size):
+        stop = min(start + chunk_size, num_pixels)
+        chunk = cube[indices, start:stop].astype(np.float32)
+        nodata = ~chunk.any(axis=0)
+        if scale != 1.0:
+            chunk *= np.float32(scale)
+        if offset != 0.0:
+            chunk += np.float32(offset)
+        result = coefficients @ chunk
+        if intercept is not None:
+            result += intercept
+        result[:, nodata] = COMPONENT_NODATA
+        components[:, start:stop] = result
+
+    return components.reshape(coefficients.shape[0], height, width)
+
+
+def tasseled_cap(images,
+                 band_names,
+                 scale=REFLECTANCE_SCALE,
+                 offset=0.0,
+                 chunk_size=CHUNK_SIZE):
+    """Compute the Sentinel 2 tasseled cap components
+    (brightness, greenness, wetness) of a band cube.
+
+    Args:
+        images (numpy.ndarray): band cube (band, height, width)
+        band_names (list[str]): band names associated to the images;
+            B02, B03, B04, B8A, B11 and B12 are required
+        scale (float): digital number to reflectance scale (default: 1e-4)
+        offset (float): digital number to reflectance offset; -0.1 for
+            processing baseline 04.00 or later (default: 0.0)
+        chunk_size (int): number of pixels per chunk (default: 2**18)
+
+    Returns:
+        components (numpy.ndarray): float32 array (3, height, width)
+    """
+    return apply_linear_transform(images,
+                                  band_names,
+                                  TASSELED_CAP_S2["coefficients"],
+                                  TASSELED_CAP_S2["bands"],
+                                  scale=scale,
+                                  offset=offset,
+                                  chunk_size=chunk_size)
+
+
+class StreamingPCA:
+    """Principal Component Analysis fitted incrementally:
+    the mean and the scatter matrix of the samples are merged
+    batch by batch (Chan et al. parallel update), so the full set
+    of pixels never needs to be in memory.
+
+    Args:
+        n_components (int): number of principal components (default: 3)
+    """
+    def __init__(self, n_components=3):
+        self.n_components = n_components
+        self.count = 0
+        self.mean_ = None
+        self.scatter_ = None
+        self.components_ = None
+        self.explained_variance_ = None
+
+    def partial_fit(self, samples):
+        """Update the statistics with a batch of samples.
+
+        Args:
+            samples (numpy.ndarray): array (samples, bands)
+
+        Returns:
+            self (StreamingPCA)
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        count = samples.shape[0]
+        if count == 0:
+            return self
+        mean = samples.mean(axis=0)
+        centered = samples - mean
+        scatter = centered.T @ centered
+        if self.count == 0:
+            self.mean_, self.scatter_ = mean, scatter
+        else:
+            total = self.count + count
+            delta = mean - self.mean_
+            self.scatter_ = self.scatter_ + scatter \
+                + np.outer(delta, delta) * self.count * count / total
+            self.mean_ = self.mean_ + delta * count / total
+        self.count += count
+        self.components_ = None
+
+        return self
+
+    def finalize(self):
+        """Compute the principal components from the statistics.
+
+        Returns:
+            self (StreamingPCA)
+        """
+        try:
+            assert self.count > 1
+        except AssertionError as err:
+            logger.error("StreamingPCA: not enough samples to fit: %d", self.count)
+            raise err
+        covariance = self.scatter_ / (self.count - 1)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:self.n_components]
+        self.explained_variance_ = eigenvalues[order]
+        self.components_ = eigenvectors[:, order].T
+
+        return self
+
+    def coefficients(self):
+        """Coefficients and intercept for apply_linear_transform():
+        pc = components @ (x - mean) = components @ x - components @ mean.
+
+        Returns:
+            coefficients (numpy.ndarray): matrix (components, bands)
+            intercept (numpy.ndarray): vector (components,)
+        """
+        if self.components_ is None:
+            self.finalize()
+
+        return self.components_, -self.components_ @ self.mean_
+
+
+def fit_pca_streaming(band_paths,
+                      n_components=3,
+                      sample_fraction=0.05,
+                      block_size=1024,
+                      seed=0):
+    """Fit a PCA on a random sample of pixels read block by block
+    from the band files, without materializing the band cube.
+    Pixels where all bands are 0 (nodata) are not sampled.
+
+    Args:
+        band_paths (list[str]): paths of the band files
+        n_components (int): number of principal components (default: 3)
+        sample_fraction (float): fraction of pixels sampled per block
+            (default: 0.05)
+        block_size (int): block side length (pixels) (default: 1024)
+        seed (int): seed of the random sampling (default: 0)
+
+    Returns:
+        pca (StreamingPCA): fitted PCA
+        band_names (list[str]): band names of the PCA input columns
+    """
+    rng = np.random.default_rng(seed)
+    pca = StreamingPCA(n_components=n_components)
+    band_names = None
+    for _, blocks in iter_band_blocks(band_paths, block_size=block_size):
+        band_names = list(blocks.keys())
+        pixels = np.stack([block.ravel() for block in blocks.values()], axis=1)
+        pixels = pixels[pixels.any(axis=1)]
+        num_samples = int(np.ceil(sample_fraction * len(pixels)))
+        if num_samples > 0:
+            pca.partial_fit(pixels[rng.choice(len(pixels), num_samples, replace=False)])
+    pca.finalize()
+    logger.info("fit_pca_streaming: PCA fitted on %d pixels; explained variance: %s",
+                pca.count, pca.explained_variance_)
+
+    return pca, band_names
+
+
+def persist_components(components,
+                       component_names,
+                       profile,
+                       output_folder,
+                       prefix=""):
+    """Persist transform components, one float32 raster per component,
+    as the ND maps in generate_persist_ndmap().
+
+    Args:
+        components (numpy.ndarray): array (component, height, width)
+        component_names (list[str]): names of the components
+        profile (dict): profile dictionary of the source bands
+        output_folder (str): folder to write the rasters to
+        prefix (str): filename prefix, e.g., "tc_" or "pca_" (default: "")
+
+    Returns:
+        output_paths (list[str]): paths of the persisted components
+    """
+    component_profile = profile.copy()
+    component_profile.update({'driver': 'GTiff',
+                              'count': 1,
+                              'dtype': 'float32',
+                              'nodata': COMPONENT_NODATA})
+    output_paths = []
+    for component, name in zip(components, component_names):
+        output_path = os.path.join(output_folder, f"{prefix}{name}.tiff")
+        with rio.open(output_path, 'w', **component_profile) as dst:
+            dst.write(component, 1)
+        output_paths.append(output_path)
+    logger.info("persist_components: %s persisted to %s.",
+                component_names, output_folder)
+
+    return output_paths
@@ -0,0 +1,365 @@
+"""This module contains the functions of the streaming
+(block-window) water extraction pipeline. Instead of loading
+whole rasters as in load_bands(), aligned block windows
+are read across the needed bands and, for each block,
+the ND map, the water mask and the connected component labels
+are computed and written window by window.
+Blobs which span several blocks are merged with a union-find
+structure on the block borders; then, the labels are vectorized
+block by block and the pieces of the same blob are dissolved.
+Peak memory is proportional to the block size, not to the tile size.
+These functions are implemented and documented:
+
+    iter_block_windows()
+    iter_band_blocks()
+    stream_water_mask()
+    vectorize_label_blocks()
+    stream_water_polygons()
+
+Author: Mikel Sagardia
+Date: 2023-04-18
+"""
+import os
+from collections import defaultdict
+
+import numpy as np
+from scipy import ndimage
+
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.features import shapes
+from rasterio.windows import Window, from_bounds
+from rasterio.windows import bounds as window_bounds
+from rasterio.windows import transform as window_transform
+
+import geopandas as gpd
+import shapely
+from shapely.geometry import shape
+
+from .geo_library import (
+    logger,
+    get_band_name,
+    compute_ndvi,
+    compute_ndwi,
+    threshold_ndmap
+)
+
+# Bands required by each ND map
+ND_MAP_BANDS = {"ndwi": ['03', '8A'],
+                "ndvi": ['04', '08']}
+ND_MAP_FUNCTIONS = {"ndwi": compute_ndwi,
+                    "ndvi": compute_ndvi}
+
+
+def iter_block_windows(height, width, block_size=1024, window=None):
+    """Iterate over the block windows of a raster, in row-major order.
+
+    Args:
+        height (int): raster height (pixels)
+        width (int): raster width (pixels)
+        block_size (int): block side length (pixels) (default: 1024)
+        window (rasterio.windows.Window): optional window to restrict
+            the iteration to (default: None, full raster)
+
+    Yields:
+        window (rasterio.windows.Window): block window
+            in raster pixel coordinates
+    """
+    if window is None:
+        window = Window(0, 0, width, height)
+    row_start, col_start = int(window.row_off), int(window.col_off)
+    row_stop = row_start + int(window.height)
+    col_stop = col_start + int(window.width)
+    for row in range(row_start, row_stop, block_size):
+        for col in range(col_start, col_stop, block_size):
+            yield Window(col, row,
+                         min(block_size, col_stop - col),
+                         min(block_size, row_stop - row))
+
+
+def iter_band_blocks(band_paths,
+                     block_size=1024,
+                     bounds=None,
+                     resampling=Resampling.bilinear):
+    """Read aligned block windows across several bands.
+    The block grid is defined by the band with the finest
+    resolution (reference band); the blocks of the rest of
+    the bands are read from the same geographic window
+    and resampled on the fly to the block shape.
+
+    Args:
+        band_paths (list[str]): paths of the band files; all bands
+            must share the CRS
+        block_size (int): block side length in reference pixels
+            (default: 1024)
+        bounds (tuple[float]): optional bounds (left, bottom, right, top)
+            in the band CRS to restrict the blocks to (default: None)
+        resampling (rasterio.enums.Resampling): resampling method
+            for the coarser bands (default: bilinear)
+
+    Yields:
+        window (rasterio.windows.Window): block window in the
+            reference grid (relative to the bounds window, if given)
+        blocks (dict): band name -> block array (rows, cols)
+    """
+    sources = [rio.open(path, 'r') for path in band_paths]
+    try:
+        reference = min(sources, key=lambda src: src.res[0]*src.res[1])
+        region = Window(0, 0, reference.width, reference.height)
+        if bounds is not None:
+            region = from_bounds(*bounds, transform=reference.transform)
+            region = region.round_offsets(op="floor").round_lengths(op="ceil")
+            region = region.intersection(Window(0, 0, reference.width, reference.height))
+        for window in iter_block_windows(reference.height, reference.width,
+                                         block_size=block_size, window=region):
+            block_bounds = window_bounds(window, reference.transform)
+            out_shape = (int(window.height), int(window.width))
+            blocks = {}
+            for path, src in zip(band_paths, sources):
+                src_window = from_bounds(*block_bounds, transform=src.transform)
+                blocks[get_band_name(path)] = src.read(1,
+                                                    window=src_window,
+                                                    out_shape=out_shape,
+                                                    resampling=resampling)
+            # Window relative to the processed region
+            yield Window(window.col_off - region.col_off,
+                         window.row_off - region.row_off,
+                         window.width,
+                         window.height), blocks
+    finally:
+        for src in sources:
+            src.close()
+
+
+def _region_profile(band_paths, bounds=None):
+    """Profile of the reference (finest) band grid,
+    restricted to bounds if given.
+
+    Args:
+        band_paths (list[str]): paths of the band files
+        bounds (tuple[float]): optional bounds in the band CRS
+
+    Returns:
+        profile (dict): profile with width, height, transform and crs
+    """
+    profiles = []
+    for path in band_paths:
+        with rio.open(path, 'r') as src:
+            profiles.append(src.profile)
+    profile = min(profiles,
+                  key=lambda prof: abs(prof['transform'].a*prof['transform'].e)).copy()
+    if bounds is not None:
+        region = from_bounds(*bounds, transform=profile['transform'])
+        region = region.round_offsets(op="floor").round_lengths(op="ceil")
+        region = region.intersection(Window(0, 0, profile['width'], profile['height']))
+        profile.update({'width': int(region.width),
+                        'height': int(region.height),
+                        'transform': window_transform(region, profile['transform'])})
+
+    return profile
+
+
+class _UnionFind:
+    """Array-based union-find of global component labels."""
+
+    def __init__(self):
+        self.parent = np.arange(1024, dtype=np.int64)
+        self.size = 1 # label 0 is the background
+
+    def add(self, count):
+        """Add count new labels; returns the first new label."""
+        first = self.size
+        self.size += count
+        if self.size > len(self.parent):
+            # Grow geometrically to keep appends amortized O(1)
+            capacity = max(self.size, 2*len(self.parent))
+            self.parent = np.concatenate(
+                [self.parent, np.arange(len(self.parent), capacity, dtype=np.int64)])
+        return first
+
+    def find(self, label):
+        """Root of a label, with path halving."""
+        parent = self.parent
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]
+            label = parent[label]
+        return label
+
+    def union_pairs(self, labels_a, labels_b):
+        """Merge the components of all (a, b) pairs with a, b > 0."""
+        valid = (labels_a > 0) & (labels_b > 0)
+        pairs = np.unique(np.stack([labels_a[valid], labels_b[valid]], axis=1), axis=0)
+        for label_a, label_b in pairs:
+            root_a, root_b = self.find(label_a), self.find(label_b)
+            if root_a != root_b:
+                self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    def roots(self):
+        """Root of every label, resolved with vectorized pointer jumping."""
+        roots = self.parent[:self.size].copy()
+        while True:
+            jumped = roots[roots]
+            if np.array_equal(jumped, roots):
+                return roots
+            roots = jumped
+
+
+def stream_water_mask(band_paths,
+                      mask_path,
+                      labels_path,
+                      threshold=0.0,
+                      map_type="ndwi",
+                      block_size=1024,
+                      bounds=None):
+    """Compute the water mask and the connected component labels
+    of a (full tile) scene block by block, and write both rasters
+    window by window. Components are labeled per block and merged
+    across block borders with a union-find structure.
+
+    Args:
+        band_paths (list[str]): paths of the band files; only the bands
+            required by map_type are read
+        mask_path (str): output path of the uint8 water mask
+        labels_path (str): output path of the int32 block labels
+        threshold (float): index value above which a pixel is water
+            (default: 0.0)
+        map_type (str): "ndwi" or "ndvi" (default: "ndwi")
+        block_size (int): block side length (pixels) (default: 1024)
+        bounds (tuple[float]): optional bounds in the band CRS
+            to restrict the processing to (default: None, full tile)
+
+    Returns:
+        roots (numpy.ndarray): root component of every block label;
+            roots[labels] yields the global component labels
+        profile (dict): profile of the mask raster
+    """
+    band_paths = [path for path in band_paths
+                  if get_band_name(path) in ND_MAP_BANDS[map_type]]
+    try:
+        assert len(band_paths) == len(ND_MAP_BANDS[map_type])
+    except AssertionError as err:
+        logger.error("stream_water_mask: bands %s are required for %s.",
+                     ND_MAP_BANDS[map_type], map_type)
+        raise err
+
+    profile = _region_profile(band_paths, bounds=bounds)
+    profile.update({'driver': 'GTiff', 'count': 1, 'nodata': None,
+                    'tiled': True, 'blockxsize': 256, 'blockysize': 256,
+                    'compress': 'deflate'})
+    mask_profile = dict(profile, dtype='uint8')
+    labels_profile = dict(profile, dtype='int32')
+
+    union_find = _UnionFind()
+    # Global labels of the last row of the previous block row
+    # and of the last column of the previous block
+    bottom_row = np.zeros(profile['width'], dtype=np.int64)
+    right_col = None
+    with rio.open(mask_path, 'w', **mask_profile) as mask_dst, \
+         rio.open(labels_path, 'w', **labels_profile) as labels_dst:
+        for window, blocks in iter_band_blocks(band_paths,
+                                               block_size=block_size,
+                                               bounds=bounds):
+            band_names = list(blocks.keys())
+            ndmap = ND_MAP_FUNCTIONS[map_type](np.stack(list(blocks.values())),
+                                               band_names)
+            water_mask = threshold_ndmap(ndmap, threshold)
+            labels, count = ndimage.label(water_mask)
+            labels = labels.astype(np.int64)
+            if count > 0:
+                first = union_find.add(count)
+                labels[labels > 0] += first - 1
+
+            col_0, col_1 = int(window.col_off), int(window.col_off + window.width)
+            # Merge with the block above and with the block on the left
+            if window.row_off > 0:
+                union_find.union_pairs(bottom_row[col_0:col_1], labels[0, :])
+            if window.col_off > 0:
+                union_find.union_pairs(right_col, labels[:, 0])
+            bottom_row[col_0:col_1] = labels[-1, :]
+            right_col = labels[:, -1]
+
+            mask_dst.write(water_mask, 1, window=window)
+            labels_dst.write(labels.astype(np.int32), 1, window=window)
+
+    roots = union_find.roots()
+    logger.info("stream_water_mask: %d block components, %d water blobs.",
+                len(roots) - 1, int(np.count_nonzero(roots[1:] == np.arange(1, len(roots)))))
+
+    return roots, mask_profile
+
+
+def vectorize_label_blocks(labels_path, roots, block_size=1024):
+    """Vectorize the block labels written by stream_water_mask()
+    block by block; the pieces of the blobs which span
+    several blocks are dissolved into a single polygon.
+
+    Args:
+        labels_path (str): path of the int32 block labels raster
+        roots (numpy.ndarray): root component of every block label
+        block_size (int): block side length (pixels) (default: 1024)
+
+    Returns:
+        polygons (dict): root component label -> shapely polygon
+    """
+    pieces = defaultdict(list)
+    with rio.open(labels_path, 'r') as src:
+        for window in iter_block_windows(src.height, src.width, block_size=block_size):
+            labels = roots[src.read(1, window=window)].astype(np.int32)
+            for geometry, value in shapes(labels,
+                                          mask=labels > 0,
+                                          transform=window_transform(window, src.transform)):
+                pieces[int(value)].append(shape(geometry))
+
+    polygons = {}
+    for label, geometries in pieces.items():
+        polygons[label] = geometries[0] if len(geometries) == 1 \
+            else shapely.union_all(geometries)
+
+    return polygons
+
+
+def stream_water_polygons(band_paths,
+                          output_folder,
+                          threshold=0.0,
+                          map_type="ndwi",
+                          block_size=1024,
+                          bounds=None):
+    """Extract the water polygons of a (full tile) scene with bounded
+    memory: stream_water_mask() + vectorize_label_blocks().
+    The water mask (water_mask.tiff) and the block labels
+    (water_labels.tiff) are persisted to output_folder.
+
+    Args:
+        band_paths (list[str]): paths of the band files
+        output_folder (str): folder for the mask and labels rasters
+        threshold (float): index value above which a pixel is water
+            (default: 0.0)
+        map_type (str): "ndwi" or "ndvi" (default: "ndwi")
+        block_size (int): block side length (pixels) (default: 1024)
+        bounds (tuple[float]): optional bounds in the band CRS
+            to restrict the processing to (default: None, full tile)
+
+    Returns:
+        water_geoseries (geopandas.GeoSeries): water polygons in the
+            band CRS, indexed by component label
+        mask_path (str): path of the persisted water mask
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    mask_path = os.path.join(output_folder, "water_mask.tiff")
+    labels_path = os.path.join(output_folder, "water_labels.tiff")
+
+    roots, profile = stream_water_mask(band_paths,
+                                       mask_path,
+                                       labels_path,
+                                       threshold=threshold,
+                                       map_type=map_type,
+                                       block_size=block_size,
+                                       bounds=bounds)
+    polygons = vectorize_label_blocks(labels_path, roots, block_size=block_size)
+    water_geoseries = gpd.GeoSeries(list(polygons.values()),
+                                    index=list(polygons.keys()),
+                                    crs=profile['crs'])
+    logger.info("stream_water_polygons: %d water polygons extracted.",
+                len(water_geoseries))
+
+    return water_geoseries, mask_path
@@ -0,0 +1,465 @@
+"""This module implements a long-running local HTTP service
+which answers water polygon and water mask queries
+with low latency. The band cube and the ND maps of each scene
+are loaded only once and kept in memory in a bounded LRU cache;
+each query works only on the raster window it needs.
+These functions/classes are implemented and documented:
+
+    SceneCache
+    query_water_polygon()
+    query_water_mask()
+    create_water_server()
+    serve_water_queries()
+
+Endpoints (all GET, JSON responses, coordinates in lng/lat EPSG:4326):
+
+    /health
+    /polygon?scene=scene_1&lon=12.45&lat=47.87&threshold=0.0
+    /mask?scene=scene_1&bbox=12.40,47.85,12.50,47.90&threshold=0.0
+
+Usage:
+
+    python -m geo_toolkit.water_service \\
+        --scene scene_1=data/scene_1/processed \\
+        --scene scene_2=data/scene_2/processed \\
+        --port 8000 --preload
+
+Author: Mikel Sagardia
+Date: 2023-04-14
+"""
+import os
+import json
+import time
+import argparse
+import threading
+from glob import glob
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+from scipy import ndimage
+
+import rasterio as rio
+from rasterio.features import shapes
+from rasterio.transform import rowcol
+from rasterio.warp import transform as transform_coords
+from rasterio.warp import transform_bounds, transform_geom
+from rasterio.errors import WindowError
+from rasterio.windows import Window, from_bounds
+from rasterio.windows import transform as window_transform
+
+from shapely.geometry import shape
+
+from .geo_library import (
+    logger,
+    load_bands,
+    compute_ndvi,
+    compute_ndwi,
+    threshold_ndmap,
+    get_band_name,
+    select_nd_bands
+)
+from .memory_budget import ENV_VARIABLE, MemoryBudget
+
+# CRS of the query coordinates and the returned geometries
+QUERY_CRS = "EPSG:4326"
+# Initial half size (pixels) of the window grown around a query point
+POLYGON_WINDOW_HALF_SIZE = 64
+# Share of the memory budget for the scene cache
+CACHE_BUDGET_SHARE = 0.5
+
+
+class SceneCache:
+    """Bounded LRU cache of loaded scenes. Each entry contains
+    the band cube, the band names, the profile and the ND maps
+    (NDWI, NDVI) of a scene. The least recently used scene
+    is evicted when the number of scenes or the total
+    number of bytes exceeds the limits.
+
+    Args:
+        scene_paths (dict): scene id -> path with the processed
+            band files (see load_bands()).
+        capacity (int): maximum number of scenes in memory (default: 2).
+        max_bytes (int): maximum number of bytes in memory (default: None,
+            only capacity is considered).
+        compact (bool): keep the ND maps as scaled int16 instead
+            of float32 (default: False).
+    """
+    def __init__(self, scene_paths, capacity=2, max_bytes=None, compact=False):
+        self.scene_paths = dict(scene_paths)
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.compact = compact
+        self._scenes = OrderedDict()
+        # Scenes being loaded: scene id -> event set when done
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _scene_nbytes(scene):
+        """Number of bytes of the arrays of a cached scene."""
+        return sum(value.nbytes for value in scene.values()
+                   if isinstance(value, np.ndarray))
+
+    def nbytes(self):
+        """Number of bytes of all cached scenes."""
+        return sum(self._scene_nbytes(scene) for scene in self._scenes.values())
+
+    @staticmethod
+    def estimate_nbytes(scene_path, compact=False):
+        """Number of bytes of a scene once cached, estimated from
+        the headers of its band files (no band is read).
+
+        Args:
+            scene_path (str): path with the processed band files.
+            compact (bool): int16 instead of float32 ND maps (default: False).
+
+        Returns:
+            nbytes (int): band cube and available ND maps (NDWI, NDVI).
+        """
+        nbytes = 0
+        pixels = 0
+        band_names = []
+        for band_path in glob(os.path.join(scene_path, "*B?*.tiff")):
+            with rio.open(band_path, 'r') as src:
+                nbytes += src.width * src.height * np.dtype(src.dtypes[0]).itemsize
+                pixels = max(pixels, src.width * src.height)
+            band_names.append(get_band_name(band_path))
+        # ND maps whose bands are available (same selection as compute_ndwi/ndvi)
+        placeholders = np.zeros((len(band_names), 1, 1))
+        n_maps = sum(select_nd_bands(placeholders, band_names, map_type)[0] is not None
+                     for map_type in ("ndwi", "ndvi"))
+
+        return nbytes + n_maps * pixels * (2 if compact else 4)
+
+    def _load(self, scene_id):
+        """Load the band cube of a scene and compute its ND maps.
+
+        Args:
+            scene_id (str): scene identifier.
+
+        Returns:
+            scene (dict): cache entry.
+        """
+        band_arrays, band_names, profile = load_bands(self.scene_paths[scene_id])
+        # ND maps are kept as float32 (or int16 if compact):
+        # a fraction of the memory, enough precision
+        maps = {}
+        for map_type, compute in [("ndwi", compute_ndwi), ("ndvi", compute_ndvi)]:
+            ndmap = compute(band_arrays, band_names, compact=self.compact)
+            if ndmap is not None:
+                maps[map_type] = ndmap if self.compact else ndmap.astype(np.float32)
+        logger.info("SceneCache: scene %s loaded.", scene_id)
+
+        return {"bands": band_arrays,
+                "band_names": band_names,
+                "profile": profile,
+                **maps}
+
+    def get(self, scene_id):
+        """Get a scene from the cache, loading it if necessary.
+
+        Args:
+            scene_id (str): scene identifier.
+
+        Returns:
+            scene (dict): cache entry with the keys
+                bands, band_names, profile, ndwi and ndvi.
+        """
+        try:
+            assert scene_id in self.scene_paths
+        except AssertionError as err:
+            logger.error("SceneCache: unknown scene: %s", scene_id)
+            raise KeyError(scene_id) from err
+
+        # The lock is held only to look up, insert and evict: a scene
+        # is loaded outside of it, so that cached scenes are served meanwhile;
+        # concurrent requests of a scene being loaded wait for that load
+        while True:
+            with self._lock:
+                if scene_id in self._scenes:
+                    self._scenes.move_to_end(scene_id)
+                    return self._scenes[scene_id]
+                loading = self._loading.get(scene_id)
+                if loading is None:
+                    loading = self._loading[scene_id] = threading.Event()
+                    break
+            loading.wait()
+
+        try:
+            scene = self._load(scene_id)
+            with self._lock:
+                self._scenes[scene_id] = scene
+                # Evict least recently used scenes, but never the new one
+                while len(self._scenes) > 1 and (
+                        len(self._scenes) > self.capacity
+                        or (self.max_bytes and self.nbytes() > self.max_bytes)):
+                    evicted, _ = self._scenes.popitem(last=False)
+                    logger.info("SceneCache: scene %s evicted.", evicted)
+        finally:
+            # On failure, the waiting requests try to load the scene themselves
+            with self._lock:
+                del self._loading[scene_id]
+            loading.set()
+
+        return scene
+
+    def loaded(self):
+        """Ids of the scenes currently in memory, from least to
+        most recently used."""
+        return list(self._scenes.keys())
+
+
+def query_water_polygon(scene, lon, lat, threshold, map_type="ndwi"):
+    """Get the water polygon which contains a point:
+    the connected component of pixels with an index value
+    larger than threshold. The component is labeled
+    in a window around the point which grows until the component
+    does not touch the window border (or the window is the full raster).
+
+    Args:
+        scene (dict): scene from SceneCache.get().
+        lon (float): longitude of the point (EPSG:4326).
+        lat (float): latitude of the point (EPSG:4326).
+        threshold (float): index value above which a pixel is water.
+        map_type (str): "ndwi" or "ndvi" (default: "ndwi").
+
+    Returns:
+        feature (dict): GeoJSON feature in EPSG:4326 with the water
+            polygon, or None if the point is outside of the scene
+            or it is not water.
+    """
+    ndmap = scene[map_type]
+    profile = scene["profile"]
+    height, width = ndmap.shape
+
+    xs, ys = transform_coords(QUERY_CRS, profile["crs"], [lon], [lat])
+    row, col = rowcol(profile["transform"], xs[0], ys[0])
+    if not (0 <= row < height and 0 <= col < width):
+        return None
+    if not threshold_ndmap(ndmap[row:row+1, col:col+1], threshold)[0, 0]:
+        return None
+
+    half_size = POLYGON_WINDOW_HALF_SIZE
+    while True:
+        row_0, row_1 = max(row - half_size, 0), min(row + half_size + 1, height)
+        col_0, col_1 = max(col - half_size, 0), min(col + half_size + 1, width)
+        labels, _ = ndimage.label(threshold_ndmap(ndmap[row_0:row_1, col_0:col_1],
+                                                  threshold))
+        component = labels == labels[row - row_0, col - col_0]
+        # Does the component touch a window border which is not a raster border?
+        touches = ((row_0 > 0 and component[0, :].any())
+                   or (row_1 < height and component[-1, :].any())
+                   or (col_0 > 0 and component[:, 0].any())
+                   or (col_1 < width and component[:, -1].any()))
+        if not touches:
+            break
+        half_size *= 2
+
+    window = Window(col_0, row_0, col_1 - col_0, row_1 - row_0)
+    polygons = [shape(geometry) for geometry, _ in
+                shapes(component.astype(np.uint8),
+                       mask=component,
+                       transform=window_transform(window, profile["transform"]))]
+    polygon = polygons[0]
+
+    return {"type": "Feature",
+            "geometry": transform_geom(profile["crs"], QUERY_CRS, polygon.__geo_interface__),
+            "properties": {"map_type": map_type,
+                           "threshold": threshold,
+                           "pixel_count": int(component.sum()),
+                           "area": polygon.area}}
+
+
+def query_water_mask(scene, bbox, threshold, map_type="ndwi"):
+    """Get the water mask of a bounding box:
+    pixels with an index value larger than threshold are 1, else 0.
+
+    Args:
+        scene (dict): scene from SceneCache.get().
+        bbox (list[float]): lng/lat bounding box: minx, miny, maxx, maxy.
+        threshold (float): index value above which a pixel is water.
+        map_type (str): "ndwi" or "ndvi" (default: "ndwi").
+
+    Returns:
+        result (dict): with the keys crs, transform (GDAL-ordered
+            coefficients of the window), shape, water_pixels and mask
+            (list of rows), or None if the bbox does not overlap the scene.
+    """
+    ndmap = scene[map_type]
+    profile = scene["profile"]
+    height, width = ndmap.shape
+
+    bounds = transform_bounds(QUERY_CRS, profile["crs"], *bbox)
+    window = from_bounds(*bounds, transform=profile["transform"])
+    window = window.round_offsets(op="floor").round_lengths(op="ceil")
+    try:
+        window = window.intersection(Window(0, 0, width, height))
+    except WindowError:
+        # bbox outside of the scene
+        return None
+
+    rows, cols = window.toslices()
+    mask = threshold_ndmap(ndmap[rows, cols], threshold)
+
+    return {"crs": profile["crs"].to_string(),
+            "transform": list(window_transform(window, profile["transform"]).to_gdal()),
+            "shape": list(mask.shape),
+            "water_pixels": int(mask.sum()),
+            "mask": mask.tolist()}
+
+
+class _WaterQueryHandler(BaseHTTPRequestHandler):
+    """HTTP request handler of the water query service;
+    the scene cache is taken from the server instance."""
+
+    def _send_json(self, status, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """Dispatch GET requests to the query functions."""
+        tic = time.perf_counter()
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        cache = self.server.scene_cache
+        try:
+            if url.path == "/health":
+                self._send_json(200, {"scenes": list(cache.scene_paths),
+                                      "loaded": cache.loaded()})
+                return
+            if url.path not in ("/polygon", "/mask"):
+                self._send_json(404, {"error": f"unknown endpoint: {url.path}"})
+                return
+            scene = cache.get(params["scene"])
+            threshold = float(params.get("threshold", 0.0))
+            map_type = params.get("map_type", "ndwi")
+            if url.path == "/polygon":
+                result = query_water_polygon(scene,
+                                             float(params["lon"]),
+                                             float(params["lat"]),
+                                             threshold,
+                                             map_type=map_type)
+            else:
+                bbox = [float(value) for value in params["bbox"].split(",")]
+                assert len(bbox) == 4
+                result = query_water_mask(scene, bbox, threshold, map_type=map_type)
+        except (KeyError, ValueError, AssertionError) as err:
+            self._send_json(400, {"error": f"invalid query: {err!r}"})
+            return
+        except Exception as err: # pylint: disable=broad-except
+            # E.g., band files which cannot be read: answer instead of dropping
+            logger.exception("water_service: %s failed: %s", self.path, err)
+            self._send_json(500, {"error": f"internal error: {err!r}"})
+            return
+
+        elapsed_ms = 1000*(time.perf_counter() - tic)
+        logger.info("water_service: %s answered in %.1f ms.", url.path, elapsed_ms)
+        if result is None:
+            self._send_json(404, {"error": "no water at the queried location",
+                                  "elapsed_ms": elapsed_ms})
+        else:
+            self._send_json(200, {"result": result, "elapsed_ms": elapsed_ms})
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        """Send access logs to the package logger instead of stderr."""
+        logger.debug("water_service: " + format, *args)
+
+
+def create_water_server(scene_paths,
+                        host="127.0.0.1",
+                        port=8000,
+                        cache_capacity=2,
+                        cache_max_bytes=None,
+                        compact=False,
+                        preload=False):
+    """Create the HTTP server of the water query service;
+    call serve_forever() on it to start answering queries.
+
+    Args:
+        scene_paths (dict): scene id -> path with the processed band files.
+        host (str): host to bind (default: "127.0.0.1", localhost only).
+        port (int): port to bind; 0 picks a free port (default: 8000).
+        cache_capacity (int): maximum number of scenes in memory (default: 2).
+        cache_max_bytes (int): maximum number of bytes in memory (default: None).
+        compact (bool): keep the ND maps as scaled int16 (default: False).
+        preload (bool): load the first cache_capacity scenes
+            before answering queries (default: False).
+
+    Returns:
+        server (http.server.ThreadingHTTPServer): server with
+            the attribute scene_cache (SceneCache).
+    """
+    server = ThreadingHTTPServer((host, port), _WaterQueryHandler)
+    server.daemon_threads = True
+    server.scene_cache = SceneCache(scene_paths,
+                                    capacity=cache_capacity,
+                                    max_bytes=cache_max_bytes,
+                                    compact=compact)
+    if preload:
+        for scene_id in list(scene_paths)[:cache_capacity]:
+            server.scene_cache.get(scene_id)
+
+    return server
+
+
+def serve_water_queries(scene_paths, **kwargs):
+    """Create the water query service and serve until interrupted.
+
+    Args:
+        scene_paths (dict): scene id -> path with the processed band files.
+        kwargs: arguments passed to create_water_server().
+
+    Returns: None.
+    """
+    server = create_water_server(scene_paths, **kwargs)
+    host, port = server.server_address[:2]
+    logger.info("water_service: serving water queries on http://%s:%d", host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Water polygon query service.")
+    parser.add_argument("--scene", action="append", required=True,
+                        help="scene_id=path_to_processed_bands (repeatable)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--cache-capacity", type=int, default=2)
+    parser.add_argument("--memory-budget", default=None,
+                        help="cache memory limit, e.g., 4G or 50%% "
+                             "(default: GEO_TOOLKIT_MEMORY_BUDGET)")
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--preload", action="store_true")
+    args = parser.parse_args()
+
+    # The scene cache is bounded by a share of the memory budget, if any
+    scene_paths = dict(scene.split("=", 1) for scene in args.scene)
+    cache_capacity = args.cache_capacity
+    cache_max_bytes = None
+    if args.memory_budget or os.environ.get(ENV_VARIABLE):
+        budget = MemoryBudget.from_config(limit=args.memory_budget)
+        scene_nbytes = max(SceneCache.estimate_nbytes(path, compact=args.compact)
+                           for path in scene_paths.values())
+        cache_capacity = budget.cache_capacity(scene_nbytes,
+                                               max_items=args.cache_capacity,
+                                               share=CACHE_BUDGET_SHARE)
+        cache_max_bytes = int(budget.limit * CACHE_BUDGET_SHARE)
+
+    serve_water_queries(scene_paths,
+                        host=args.host,
+                        port=args.port,
+                        cache_capacity=cache_capacity,
+                        cache_max_bytes=cache_max_bytes,
+                        compact=args.compact,
+                        preload=args.preload)
@@ -0,0 +1,186 @@
+"""This module contains the per-lake (per connected component)
+zonal statistics computed from the label image of the water mask:
+pixel count, area, perimeter and mean/min/max of any number of
+index rasters (e.g., NDWI and NDVI), for all the components at once.
+All reductions are vectorized (bincount and minimum/maximum.at
+over the labeled pixels), so the cost does not depend on
+the number of lakes; the water polygons are vectorized from
+the same label image and carry their label, which is used
+to attach the statistics to the lake GeoDataFrame.
+These functions are implemented and documented:
+
+    label_water_mask()
+    vectorize_labels()
+    label_perimeters()
+    zonal_statistics()
+    attach_zonal_stats()
+
+Author: Mikel Sagardia
+Date: 2023-05-03
+"""
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from scipy import ndimage
+from rasterio.features import shapes
+from shapely.geometry import shape
+
+from .geo_library import logger, ND_SCALE, ND_NODATA, ND_FLOAT_NODATA
+
+
+def label_water_mask(water_mask, structure=None):
+    """Label the connected components of a water mask.
+
+    Args:
+        water_mask (numpy.ndarray): binary mask, water pixels > 0
+        structure (numpy.ndarray): connectivity structure; default:
+            4-connectivity, as in rasterio.features.shapes()
+
+    Returns:
+        labels (numpy.ndarray): int32 label image, 0 is background
+        n_labels (int): number of components (labels 1..n_labels)
+    """
+    labels, n_labels = ndimage.label(water_mask > 0, structure=structure,
+                                     output=np.int32)
+
+    return labels, n_labels
+
+
+def vectorize_labels(labels, transform, crs=None):
+    """Vectorize a label image: one polygon (with holes)
+    per 4-connected component.
+
+    Args:
+        labels (numpy.ndarray): int32 label image, 0 is background
+        transform (affine.Affine): transform of the label image
+        crs (object): CRS of the polygons (default: None)
+
+    Returns:
+        water_geoseries (geopandas.GeoSeries): water polygons,
+            indexed by component label
+    """
+    polygons = []
+    polygon_labels = []
+    for geometry, value in shapes(labels, mask=labels > 0, transform=transform):
+        polygons.append(shape(geometry))
+        polygon_labels.append(int(value))
+
+    return gpd.GeoSeries(polygons, index=pd.Index(polygon_labels, name="label"), crs=crs)
+
+
+def label_perimeters(labels, n_labels, pixel_width, pixel_height):
+    """Perimeters of all the components of a label image, i.e., the
+    lengths of the pixel edges between each component and any
+    other label (holes included), as in the vectorized polygons.
+
+    Args:
+        labels (numpy.ndarray): int32 label image, 0 is background
+        n_labels (int): number of components
+        pixel_width (float): pixel width in map units
+        pixel_height (float): pixel height in map units
+
+    Returns:
+        perimeters (numpy.ndarray): perimeter of labels 0..n_labels
+    """
+    padded = np.pad(labels, 1)
+    # Horizontal neighbors with different labels share a vertical edge
+    left, right = padded[:, :-1], padded[:, 1:]
+    edges = left != right
+    vertical = np.bincount(left[edges], minlength=n_labels + 1) \
+        + np.bincount(right[edges], minlength=n_labels + 1)
+    top, bottom = padded[:-1, :], padded[1:, :]
+    edges = top != bottom
+    horizontal = np.bincount(top[edges], minlength=n_labels + 1) \
+        + np.bincount(bottom[edges], minlength=n_labels + 1)
+
+    return vertical * pixel_height + horizontal * pixel_width
+
+
+def _raster_values(raster):
+    """Float values and validity of an index raster; compact (int16) ND maps
+    are unscaled and ND_NODATA is invalid, NaNs and ND_FLOAT_NODATA
+    (persisted float maps) are invalid in float maps."""
+    if raster.dtype == np.int16:
+        return raster.astype(np.float32) / ND_SCALE, raster != ND_NODATA
+    return raster, np.isfinite(raster) & (raster != ND_FLOAT_NODATA)
+
+
+def zonal_statistics(labels, rasters, transform, n_labels=None):
+    """Compute the statistics of all the components of a label image
+    in one vectorized pass per raster: pixel count, area, perimeter
+    and <name>_mean, <name>_min, <name>_max of each index raster.
+
+    Args:
+        labels (numpy.ndarray): int32 label image, 0 is background
+        rasters (dict): name -> index raster aligned with labels,
+            e.g., {'ndwi': ndwi, 'ndvi': ndvi}; float maps or compact
+            int16 maps scaled by ND_SCALE
+        transform (affine.Affine): transform of the label image
+        n_labels (int): number of components; default: labels.max()
+
+    Returns:
+        stats (pandas.DataFrame): one row per label 1..n_labels (index "label");
+            area in squared map units, perimeter in map units
+    """
+    try:
+        for name, raster in rasters.items():
+            assert raster.shape == labels.shape
+    except AssertionError as err:
+        logger.error("zonal_statistics: raster %s %s not aligned with labels %s.",
+                     name, raster.shape, labels.shape)
+        raise err
+    if n_labels is None:
+        n_labels = int(labels.max()) if labels.size else 0
+    pixel_width, pixel_height = abs(transform.a), abs(transform.e)
+
+    counts = np.bincount(labels.ravel(), minlength=n_labels + 1)
+    columns = {"pixel_count": counts[1:],
+               "area": counts[1:] * pixel_width * pixel_height,
+               "perimeter": label_perimeters(labels, n_labels,
+                                             pixel_width, pixel_height)[1:]}
+
+    for name, raster in rasters.items():
+        values, valid = _raster_values(raster)
+        # Only the labeled, valid pixels are reduced
+        selected = valid & (labels > 0)
+        zone_labels = labels[selected]
+        zone_values = values[selected].astype(np.float64)
+        valid_counts = np.bincount(zone_labels, minlength=n_labels + 1)
+        sums = np.bincount(zone_labels, weights=zone_values, minlength=n_labels + 1)
+        minima = np.full(n_labels + 1, np.inf)
+        maxima = np.full(n_labels + 1, -np.inf)
+        np.minimum.at(minima, zone_labels, zone_values)
+        np.maximum.at(maxima, zone_labels, zone_values)
+        empty = valid_counts == 0
+        minima[empty] = np.nan
+        maxima[empty] = np.nan
+        with np.errstate(divide='ignore', invalid='ignore'):
+            columns[f"{name}_mean"] = (sums / valid_counts)[1:]
+        columns[f"{name}_min"] = minima[1:]
+        columns[f"{name}_max"] = maxima[1:]
+
+    stats = pd.DataFrame(columns, index=pd.RangeIndex(1, n_labels + 1, name="label"))
+    logger.info("zonal_statistics: statistics of %d components computed.", n_labels)
+
+    return stats
+
+
+def attach_zonal_stats(gdf, stats, label_column="label"):
+    """Attach the zonal statistics to a GeoDataFrame of polygons
+    (e.g., the lakes) as columns, by component label.
+
+    Args:
+        gdf (geopandas.GeoDataFrame): polygons with a label column
+        stats (pandas.DataFrame): output of zonal_statistics()
+        label_column (str): column with the component labels (default: "label")
+
+    Returns:
+        gdf (geopandas.GeoDataFrame): copy of gdf with the statistics columns
+    """
+    try:
+        assert label_column in gdf.columns
+    except AssertionError as err:
+        logger.error("attach_zonal_stats: no %s column in the GeoDataFrame.", label_column)
+        raise err
+
+    return gdf.join(stats, on=label_column)
@@ -64,6 +64,196 @@ def resample_bands():
     '''resample_bands() function from geo_toolkit.'''
     return gt.resample_bands
 
+@pytest.fixture
+def load_bands():
+    '''load_bands() function from geo_toolkit.'''
+    return gt.load_bands
+
+@pytest.fixture
+def run_pipelined():
+    '''run_pipelined() function from geo_toolkit.'''
+    return gt.run_pipelined
+
+@pytest.fixture
+def generate_persist_ndmap():
+    '''generate_persist_ndmap() function from geo_toolkit.'''
+    return gt.generate_persist_ndmap
+
+@pytest.fixture
+def load_ndmap():
+    '''load_ndmap() function from geo_toolkit.'''
+    return gt.load_ndmap
+
+@pytest.fixture
+def threshold_ndmap():
+    '''threshold_ndmap() function from geo_toolkit.'''
+    return gt.threshold_ndmap
+
+@pytest.fixture
+def compute_ndmap_mask():
+    '''compute_ndmap_mask() function from geo_toolkit.'''
+    return gt.compute_ndmap_mask
+
+@pytest.fixture
+def persist_ndmap():
+    '''persist_ndmap() function from geo_toolkit.'''
+    return gt.persist_ndmap
+
+@pytest.fixture
+def export_lakes_catalog():
+    '''export_lakes_catalog() function from geo_toolkit.'''
+    return gt.export_lakes_catalog
+
+@pytest.fixture
+def query_catalog_bbox():
+    '''query_catalog_bbox() function from geo_toolkit.'''
+    return gt.query_catalog_bbox
+
+@pytest.fixture
+def query_catalog_point():
+    '''query_catalog_point() function from geo_toolkit.'''
+    return gt.query_catalog_point
+
+@pytest.fixture
+def create_water_server():
+    '''create_water_server() function from geo_toolkit.'''
+    return gt.create_water_server
+
+@pytest.fixture
+def scene_cache():
+    '''SceneCache class from geo_toolkit.'''
+    return gt.SceneCache
+
+@pytest.fixture
+def stream_water_polygons():
+    '''stream_water_polygons() function from geo_toolkit.'''
+    return gt.stream_water_polygons
+
+@pytest.fixture
+def prescreen_scene():
+    '''prescreen_scene() function from geo_toolkit.'''
+    return gt.prescreen_scene
+
+@pytest.fixture
+def clean_water_mask():
+    '''clean_water_mask() function from geo_toolkit.'''
+    return gt.clean_water_mask
+
+@pytest.fixture
+def tasseled_cap():
+    '''tasseled_cap() function from geo_toolkit.'''
+    return gt.tasseled_cap
+
+@pytest.fixture
+def fit_pca_streaming():
+    '''fit_pca_streaming() function from geo_toolkit.'''
+    return gt.fit_pca_streaming
+
+@pytest.fixture
+def load_classifier():
+    '''load_classifier() function from geo_toolkit.'''
+    return gt.load_classifier
+
+@pytest.fixture
+def predict_raster():
+    '''predict_raster() function from geo_toolkit.'''
+    return gt.predict_raster
+
+@pytest.fixture
+def load_mosaic_bands():
+    '''load_mosaic_bands() function from geo_toolkit.'''
+    return gt.load_mosaic_bands
+
+@pytest.fixture
+def get_raster_stats():
+    '''get_raster_stats() function from geo_toolkit.'''
+    return gt.get_raster_stats
+
+@pytest.fixture
+def otsu_threshold():
+    '''otsu_threshold() function from geo_toolkit.'''
+    return gt.otsu_threshold
+
+@pytest.fixture
+def running_stats():
+    '''RunningStats class from geo_toolkit.'''
+    return gt.RunningStats
+
+@pytest.fixture
+def shared_band_cube():
+    '''SharedBandCube class from geo_toolkit.'''
+    return gt.SharedBandCube
+
+@pytest.fixture
+def map_blocks():
+    '''map_blocks() function from geo_toolkit.'''
+    return gt.map_blocks
+
+@pytest.fixture
+def render_quicklook():
+    '''render_quicklook() function from geo_toolkit.'''
+    return gt.render_quicklook
+
+@pytest.fixture
+def read_raster_overview():
+    '''read_raster_overview() function from geo_toolkit.'''
+    return gt.read_raster_overview
+
+@pytest.fixture
+def get_band_name():
+    '''get_band_name() function from geo_toolkit.'''
+    return gt.get_band_name
+
+@pytest.fixture
+def parse_band_filename():
+    '''parse_band_filename() function from geo_toolkit.'''
+    return gt.parse_band_filename
+
+@pytest.fixture
+def build_product_catalog():
+    '''build_product_catalog() function from geo_toolkit.'''
+    return gt.build_product_catalog
+
+@pytest.fixture
+def query_products():
+    '''query_products() function from geo_toolkit.'''
+    return gt.query_products
+
+@pytest.fixture
+def finest_band_entries():
+    '''finest_band_entries() function from geo_toolkit.'''
+    return gt.finest_band_entries
+
+@pytest.fixture
+def label_water_mask():
+    '''label_water_mask() function from geo_toolkit.'''
+    return gt.label_water_mask
+
+@pytest.fixture
+def vectorize_labels():
+    '''vectorize_labels() function from geo_toolkit.'''
+    return gt.vectorize_labels
+
+@pytest.fixture
+def zonal_statistics():
+    '''zonal_statistics() function from geo_toolkit.'''
+    return gt.zonal_statistics
+
+@pytest.fixture
+def memory_budget():
+    '''MemoryBudget class from geo_toolkit.'''
+    return gt.MemoryBudget
+
+@pytest.fixture
+def parse_memory_size():
+    '''parse_memory_size() function from geo_toolkit.'''
+    return gt.parse_memory_size
+
+@pytest.fixture
+def contour_polygons():
+    '''contour_polygons() function from geo_toolkit.'''
+    return gt.contour_polygons
+
 ## -- Variable plug-ins
 
 def config_dict_plugin():
@@ -0,0 +1,70 @@
+'''This module tests the per-pixel classifier inference
+of the package geo_toolkit using Pytest. The band cube
+and the training data are synthetic.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-04-26
+'''
+import os
+
+import joblib
+import numpy as np
+import pytest
+from sklearn.linear_model import LogisticRegression
+
+def test_predict_raster(load_classifier, predict_raster, logger, tmp_path):
+    """Test predict_raster() with small batches on several threads
+    against a direct predict_proba() of the full cube.
+
+    Args:
+        load_classifier (function object): function fixture.
+        predict_raster (function object): function fixture.
+        logger (object): logger fixture.
+        tmp_path (pathlib.Path): pytest temporary folder.
+
+    Returns: None.
+    """
+    rng = np.random.default_rng(0)
+    band_names = ['03', '04', '8A']
+    images = rng.integers(1, 5000, size=(3, 23, 31), dtype=np.uint16)
+    images[:, 0, 0] = 0 # nodata pixel
+    feature_names = ['03', '8A', 'ndwi']
+
+    # Train on the cube itself: water where the NDWI is positive
+    green = images[0].ravel().astype(float)
+    nir = images[2].ravel().astype(float)
+    with np.errstate(invalid='ignore'):
+        ndwi = np.nan_to_num((green - nir) / (green + nir))
+    features = np.stack([green, nir, ndwi], axis=1).astype(np.float32)
+    labels = (ndwi > 0).astype(int)
+    model = LogisticRegression(max_iter=1000).fit(features, labels)
+    model_path = os.path.join(tmp_path, "model.joblib")
+    joblib.dump({'model': model, 'feature_names': feature_names}, model_path)
+
+    try:
+        model, loaded_features = load_classifier(model_path)
+        assert loaded_features == feature_names
+        probability, stats = predict_raster(model,
+                                            images,
+                                            band_names,
+                                            loaded_features,
+                                            batch_size=100,
+                                            n_jobs=3)
+        assert probability.shape == (23, 31)
+        assert probability.dtype == np.float32
+        assert stats['pixels'] == 23*31
+        assert stats['pixels_per_second'] > 0
+        expected = model.predict_proba(features)[:, 1].reshape(23, 31)
+        assert probability[0, 0] == -9999
+        assert np.allclose(probability.ravel()[1:], expected.ravel()[1:], atol=1e-5)
+        assert ((probability > 0.5) == (ndwi.reshape(23, 31) > 0))[1:].mean() > 0.9
+    except AssertionError as err:
+        logger.error("test_predict_raster: unexpected probabilities!")
+        raise err
+
+    # Missing bands are reported
+    with pytest.raises(AssertionError):
+        predict_raster(model, images[:2], band_names[:2], feature_names)
+    logger.info("test_predict_raster: predict_raster() successfully tested.")
@@ -0,0 +1,98 @@
+'''This module tests the sub-pixel contour vectorizer
+of the package geo_toolkit using Pytest.
+A synthetic ND map with a lake, an island in its hole
+and a small pond is vectorized.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-05-05
+'''
+import numpy as np
+import shapely
+from rasterio.transform import from_origin
+
+def test_contour_polygons(contour_polygons, label_water_mask, vectorize_labels, logger):
+    """Test contour_polygons(): valid polygons with holes at the
+    sub-pixel shorelines, indexed by component label, with fewer
+    vertices than the pixel-edge polygons once simplified.
+
+    Args:
+        contour_polygons (function object): function fixture.
+        label_water_mask (function object): function fixture.
+        vectorize_labels (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    rows, cols = np.mgrid[0:200, 0:300]
+    radius = np.hypot(rows - 100, cols - 100)
+    # Lake of radius 60 with a hole of radius 20 and an island of radius 8
+    ndmap = np.clip(np.minimum((60 - radius) / 20,
+                               np.maximum((radius - 20) / 10, (8 - radius) / 4)), -1, 1)
+    ndmap[50:60, 250:260] = 0.8 # pond
+    transform = from_origin(700000, 5306000, 60, 60)
+    water_mask = (ndmap > 0).astype(np.uint8)
+    labels, n_labels = label_water_mask(water_mask)
+
+    polygons = contour_polygons(ndmap, 0.0, transform, mask=water_mask, labels=labels)
+    simplified = contour_polygons(ndmap, 0.0, transform, mask=water_mask, labels=labels,
+                                  simplify_tolerance=30)
+    pixel_polygons = vectorize_labels(labels, transform)
+    try:
+        assert len(polygons) == n_labels == 3
+        assert polygons.is_valid.all() and simplified.is_valid.all()
+        assert sorted(polygons.index) == sorted(simplified.index) == [1, 2, 3]
+        lake = polygons.loc[labels[100, 45]]
+        assert len(lake.interiors) == 1
+        # The hole contour (ndmap = 0 at radius 20) is at sub-pixel accuracy
+        hole_area = shapely.Polygon(lake.interiors[0]).area / 60**2
+        assert abs(hole_area - np.pi * 20**2) / (np.pi * 20**2) < 0.02
+        assert polygons.loc[labels[100, 100]].contains(shapely.Point(transform * (100.5, 100.5)))
+        assert np.allclose(polygons.loc[pixel_polygons.index].area, pixel_polygons.area, rtol=0.05)
+        assert shapely.get_num_coordinates(simplified.values).sum() \
+            < shapely.get_num_coordinates(pixel_polygons.values).sum() / 2
+    except AssertionError as err:
+        logger.error("test_contour_polygons: unexpected contour polygons!")
+        raise err
+    logger.info("test_contour_polygons: contour_polygons() successfully tested.")
+
+
+def test_contour_polygons_split(contour_polygons, label_water_mask, monkeypatch, logger):
+    """Test contour_polygons() when the simplification splits a component:
+    all the parts are indexed by the label of the component.
+
+    Args:
+        contour_polygons (function object): function fixture.
+        label_water_mask (function object): function fixture.
+        monkeypatch (object): pytest monkeypatch fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    rows, cols = np.mgrid[0:100, 0:200]
+    # Two lakes joined by a channel (one component) and a pond
+    ndmap = np.clip(np.maximum((20 - np.hypot(rows - 50, cols - 40)) / 10,
+                               (20 - np.hypot(rows - 50, cols - 160)) / 10), -1, 1)
+    ndmap[48:53, 55:146] = 0.5 # channel
+    ndmap[5:10, 10:20] = 0.5 # pond
+    transform = from_origin(700000, 5306000, 60, 60)
+    water_mask = (ndmap > 0).astype(np.uint8)
+    labels, n_labels = label_water_mask(water_mask)
+    # Simplification which cuts the channel
+    cut = shapely.box(*(transform * (95, 100)), *(transform * (105, 0)))
+    monkeypatch.setattr(shapely, "simplify",
+                        lambda polygons, *args, **kwargs: shapely.difference(polygons, cut))
+
+    polygons = contour_polygons(ndmap, 0.0, transform, mask=water_mask, labels=labels,
+                                simplify_tolerance=30)
+    try:
+        assert n_labels == 2 and len(polygons) == 3
+        assert sorted(polygons.index) == sorted([labels[50, 40], labels[50, 160],
+                                                 labels[7, 15]])
+        assert polygons.loc[[labels[50, 40]]].contains(
+            shapely.Point(transform * (160.5, 50.5))).any()
+    except AssertionError as err:
+        logger.error("test_contour_polygons_split: unexpected labels of the parts!")
+        raise err
+    logger.info("test_contour_polygons_split: split components successfully tested.")
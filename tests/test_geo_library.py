@@ -29,7 +29,9 @@ import os
 from glob import glob
 import yaml
 import pytest
+import numpy as np
 import rasterio
+from rasterio.transform import from_origin
 
 def test_resample_bands(config_filename,
                         resample_bands,
@@ -92,3 +94,136 @@ def test_resample_bands(config_filename,
         raise err
 
     logger.info("test_resample_bands: resample_bands() successfully tested.")
+
+
+def test_compact_ndmap(tmp_path,
+                       generate_persist_ndmap,
+                       load_ndmap,
+                       threshold_ndmap,
+                       logger):
+    """Test the compact (scaled int16) mode of generate_persist_ndmap(),
+    load_ndmap() and threshold_ndmap() against the float mode.
+    The bands are synthetic uint16 arrays.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        generate_persist_ndmap (function object): function fixture.
+        load_ndmap (function object): function fixture.
+        threshold_ndmap (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 5000, size=(3, 50, 60), dtype=np.uint16)
+    images[:, 0, :] = 0 # nodata row: division by 0
+    band_names = ['02', '03', '8A']
+    profile = {'driver': 'GTiff', 'dtype': 'uint16', 'count': 1,
+               'width': 60, 'height': 50, 'crs': 'EPSG:32632',
+               'transform': from_origin(700000, 5300000, 60, 60)}
+
+    ndwi, _ = generate_persist_ndmap(images, band_names, profile,
+                                     str(tmp_path / "ndwi.tiff"), map_type="ndwi")
+    ndwi_int, _ = generate_persist_ndmap(images, band_names, profile,
+                                         str(tmp_path / "ndwi_int.tiff"),
+                                         map_type="ndwi", compact=True)
+    ndwi_loaded, profile_loaded = load_ndmap(str(tmp_path / "ndwi_int.tiff"))
+    ndwi_float, _ = load_ndmap(str(tmp_path / "ndwi_int.tiff"), as_float=True)
+    try:
+        assert ndwi.min() >= -1 and ndwi.max() <= 1
+        assert ndwi_int.dtype == np.int16 and ndwi_loaded.dtype == np.int16
+        assert profile_loaded['nodata'] == -32768
+        assert np.abs(ndwi_float - ndwi).max() <= 0.5e-4 + 1e-7
+        for threshold in [-0.5, 0.0, 0.1234, 0.3]:
+            # Integer-space thresholding == thresholding of the rounded values
+            expected = threshold_ndmap(np.rint(ndwi*10000)/10000, threshold)
+            expected[0, :] = 0
+            assert np.array_equal(threshold_ndmap(ndwi_loaded, threshold), expected)
+    except AssertionError as err:
+        logger.error("test_compact_ndmap: compact ND map differs from float ND map!")
+        raise err
+
+    logger.info("test_compact_ndmap: compact ND maps successfully tested.")
+
+
+def test_ndmap_mask(compute_ndmap_mask, threshold_ndmap, logger):
+    """Test the fused kernel compute_ndmap_mask() against
+    thresholding the full float NDWI map, with chunks
+    smaller than the image.
+
+    Args:
+        compute_ndmap_mask (function object): function fixture.
+        threshold_ndmap (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    rng = np.random.default_rng(1)
+    images = rng.integers(0, 5000, size=(3, 50, 60), dtype=np.uint16)
+    images[:, 0, :] = 0 # nodata row: division by 0
+    band_names = ['02', '03', '8A']
+    green = images[1].astype(np.float64)
+    nir = images[2].astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ndwi = np.nan_to_num((green - nir) / (green + nir))
+
+    try:
+        for threshold in [-0.5, 0.0, 0.1234, 0.3]:
+            mask, ndmap = compute_ndmap_mask(images, band_names, threshold, chunk_size=77)
+            assert ndmap is None
+            assert mask.dtype == np.uint8 and mask.shape == (50, 60)
+            assert not mask[0, :].any()
+            expected = threshold_ndmap(ndwi, threshold)
+            # Pixels exactly on the threshold may differ by float rounding
+            decided = np.abs(ndwi - threshold) > 1e-6
+            assert np.array_equal(mask[1:][decided[1:]], expected[1:][decided[1:]])
+        mask, ndmap = compute_ndmap_mask(images, band_names, 0.0,
+                                         return_ndmap=True, chunk_size=77)
+        assert ndmap.dtype == np.float32
+        assert np.abs(ndmap - ndwi).max() < 1e-6
+    except AssertionError as err:
+        logger.error("test_ndmap_mask: fused mask differs from thresholded ND map!")
+        raise err
+
+    logger.info("test_ndmap_mask: fused ND mask successfully tested.")
+
+
+def test_persist_ndmap(tmp_path, compute_ndmap_mask, generate_persist_ndmap,
+                       persist_ndmap, logger):
+    """Test that persisting the ND map of the fused kernel with
+    persist_ndmap() writes the same raster as generate_persist_ndmap(),
+    in float and compact format.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        compute_ndmap_mask (function object): function fixture.
+        generate_persist_ndmap (function object): function fixture.
+        persist_ndmap (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    rng = np.random.default_rng(2)
+    images = rng.integers(0, 5000, size=(2, 40, 30), dtype=np.uint16)
+    images[:, 0, :] = 0 # nodata row
+    band_names = ['03', '8A']
+    profile = {'driver': 'GTiff', 'dtype': 'uint16', 'count': 2, 'width': 30,
+               'height': 40, 'crs': 'EPSG:32632',
+               'transform': from_origin(700000, 5306000, 60, 60)}
+    _, ndmap = compute_ndmap_mask(images, band_names, 0.0, return_ndmap=True)
+    try:
+        for compact in [False, True]:
+            generate_persist_ndmap(images, band_names, profile, str(tmp_path / "expected.tiff"),
+                                   map_type="ndwi", compact=compact)
+            persist_ndmap(ndmap, profile, str(tmp_path / "fused.tiff"), compact=compact,
+                          nodata_mask=(images[0] == 0) & (images[1] == 0))
+            with rasterio.open(tmp_path / "expected.tiff") as src:
+                expected, expected_nodata = src.read(1), src.nodata
+            with rasterio.open(tmp_path / "fused.tiff") as src:
+                assert src.nodata == expected_nodata
+                assert np.abs(src.read(1).astype(np.float64) - expected).max() < 1e-6
+    except AssertionError as err:
+        logger.error("test_persist_ndmap: persisted fused ND map differs!")
+        raise err
+
+    logger.info("test_persist_ndmap: fused ND map persistence successfully tested.")
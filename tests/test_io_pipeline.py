@@ -0,0 +1,95 @@
+'''This module tests the pipelined (overlapped I/O) band
+processing of the package geo_toolkit using Pytest.
+Synthetic bands are written to a temporary folder.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-04-29
+'''
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+def test_run_pipelined(run_pipelined, logger):
+    """Test run_pipelined(): results in order, and errors
+    of the read and write stages raised in the caller.
+
+    Args:
+        run_pipelined (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    written = []
+    def failing_write(item, result):
+        if item == 5:
+            raise IOError("disk full")
+        written.append((item, result))
+
+    try:
+        results = run_pipelined(range(10), read=lambda i: i*2,
+                                process=lambda i, data: data + 1, read_ahead=1)
+        assert results == [i*2 + 1 for i in range(10)]
+        run_pipelined(range(10), read=lambda i: i,
+                      write=lambda i, result: written.append((i, result)))
+        assert written == [(i, i) for i in range(10)]
+    except AssertionError as err:
+        logger.error("test_run_pipelined: unexpected results!")
+        raise err
+
+    written.clear()
+    with pytest.raises(IOError):
+        run_pipelined(range(100), read=lambda i: i, write=failing_write, write_behind=1)
+    assert written == [(i, i) for i in range(5)]
+    with pytest.raises(ZeroDivisionError):
+        run_pipelined(range(10), read=lambda i: 1 // (i - 3))
+    logger.info("test_run_pipelined: run_pipelined() successfully tested.")
+
+
+def test_pipelined_bands(tmp_path, monkeypatch, resample_bands, load_bands, logger):
+    """Test that resample_bands() and load_bands() produce
+    the same results in pipelined and sequential mode.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        monkeypatch (pytest.MonkeyPatch): pytest monkeypatch fixture.
+        resample_bands (function object): function fixture.
+        load_bands (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("scene")
+    rng = np.random.default_rng(0)
+    for band in ["B02", "B03", "B04", "B8A"]:
+        with rasterio.open(os.path.join("scene", f"T32UQU_20230207T101109_{band}_20m.tiff"),
+                           'w', driver='GTiff', dtype='uint16', count=1, width=120,
+                           height=90, crs='EPSG:32632',
+                           transform=from_origin(700000, 5306000, 20, 20)) as dst:
+            dst.write(rng.integers(1, 5000, size=(90, 120), dtype=np.uint16), 1)
+    band_paths = sorted(os.path.join("scene", name) for name in os.listdir("scene"))
+
+    resample_bands(band_paths, resolution=(60, 60), output_folder="sequential")
+    resample_bands(band_paths, resolution=(60, 60), output_folder="pipelined",
+                   pipelined=True)
+    try:
+        for path in band_paths:
+            filename = os.path.basename(path)
+            with rasterio.open(os.path.join("scene", "sequential", filename)) as src:
+                expected = src.read()
+            with rasterio.open(os.path.join("scene", "pipelined", filename)) as src:
+                assert np.array_equal(src.read(), expected)
+        arrays, names, _ = load_bands(os.path.join("scene", "sequential"))
+        arrays_p, names_p, _ = load_bands(os.path.join("scene", "sequential"),
+                                          pipelined=True)
+        assert names_p == names
+        assert np.array_equal(arrays_p, arrays)
+    except AssertionError as err:
+        logger.error("test_pipelined_bands: pipelined and sequential results differ!")
+        raise err
+    logger.info("test_pipelined_bands: pipelined band I/O successfully tested.")
@@ -0,0 +1,49 @@
+'''This module tests the water mask cleaning functions
+of the package geo_toolkit using Pytest.
+The masks are synthetic.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-04-21
+'''
+import numpy as np
+from scipy import ndimage
+
+def test_clean_water_mask(clean_water_mask, logger):
+    """Test clean_water_mask(): speckle and small blobs are removed,
+    small holes are filled, large holes and lakes are kept.
+
+    Args:
+        clean_water_mask (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    rng = np.random.default_rng(0)
+    water_mask = (rng.random((200, 200)) > 0.98).astype(np.uint8) # speckle
+    water_mask[20:80, 20:80] = 1 # lake with a small and a large hole
+    water_mask[30:32, 30:32] = 0
+    water_mask[50:70, 50:70] = 0
+    water_mask[120:190, 100:190] = 1 # lake touching nothing
+    water_mask[150:153, 20:23] = 1 # small blob
+
+    cleaned = clean_water_mask(water_mask,
+                               opening_iterations=1,
+                               closing_iterations=0,
+                               max_hole_area=10*100,
+                               min_area=20*100,
+                               pixel_area=100)
+    _, num_components = ndimage.label(cleaned)
+    try:
+        assert cleaned.dtype == np.uint8
+        assert num_components == 2
+        assert cleaned[30, 30] == 1 # small hole filled
+        assert cleaned[60, 60] == 0 # large hole kept
+        assert cleaned[151, 21] == 0 # small blob removed
+        assert cleaned[150, 150] == 1
+    except AssertionError as err:
+        logger.error("test_clean_water_mask: unexpected cleaned mask!")
+        raise err
+
+    logger.info("test_clean_water_mask: mask cleaning successfully tested.")
@@ -0,0 +1,84 @@
+'''This module tests the memory-budget governor
+of the package geo_toolkit using Pytest.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-05-04
+'''
+import tracemalloc
+
+import numpy as np
+import pytest
+
+def test_memory_budget_config(tmp_path, monkeypatch, memory_budget,
+                              parse_memory_size, logger):
+    """Test parse_memory_size() and the priority of the limit sources
+    of MemoryBudget.from_config(): argument, environment, config file.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        monkeypatch (pytest.MonkeyPatch): pytest monkeypatch fixture.
+        memory_budget (class object): class fixture.
+        parse_memory_size (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text("memory_budget: 512MB\n")
+    monkeypatch.delenv("GEO_TOOLKIT_MEMORY_BUDGET", raising=False)
+    try:
+        assert parse_memory_size("1.5GiB") == int(1.5 * 2**30)
+        assert parse_memory_size(1000) == 1000
+        assert 0 < parse_memory_size("10%")
+        assert memory_budget.from_config(config=str(config_path)).limit == 512 * 2**20
+        monkeypatch.setenv("GEO_TOOLKIT_MEMORY_BUDGET", "2G")
+        assert memory_budget.from_config(config=str(config_path)).limit == 2 * 2**30
+        assert memory_budget.from_config(limit="1G").limit == 2**30
+    except AssertionError as err:
+        logger.error("test_memory_budget_config: unexpected memory limit!")
+        raise err
+    with pytest.raises(AssertionError):
+        parse_memory_size("lots")
+    logger.info("test_memory_budget_config: memory budget config successfully tested.")
+
+
+def test_memory_budget_plan(memory_budget, logger):
+    """Test the plans of MemoryBudget: in memory vs. streaming,
+    block and chunk sizes within the budget, and stage reports.
+
+    Args:
+        memory_budget (class object): class fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    budget = memory_budget("256MB", trace=True)
+    try:
+        assert budget.plan_scene((1000, 1000), band_count=13)["in_memory"]
+        plan = budget.plan_scene((10980, 10980), band_count=13)
+        assert not plan["in_memory"]
+        block_size = plan["block_size"]
+        assert block_size % 256 == 0
+        assert block_size**2 * (2 * 6 + 32) <= budget.limit * 0.5
+        assert (block_size + 256)**2 * (2 * 6 + 32) > budget.limit * 0.5
+        assert plan["chunk_size"] * 16 <= budget.limit * 0.25
+        assert budget.concurrency(100 * 2**20, max_workers=8) == 2
+        assert budget.cache_capacity(200 * 2**20) == 1
+    except AssertionError as err:
+        logger.error("test_memory_budget_plan: unexpected plan!")
+        raise err
+
+    with budget.stage("allocate", planned_bytes=8 * 2**20):
+        array = np.ones(2**20) # 8 MB
+    del array
+    records = budget.report()
+    tracemalloc.stop()
+    try:
+        assert records[0]["stage"] == "allocate"
+        assert records[0]["observed_peak"] >= 8 * 2**20
+    except AssertionError as err:
+        logger.error("test_memory_budget_plan: unexpected stage report!")
+        raise err
+    logger.info("test_memory_budget_plan: memory plan successfully tested.")
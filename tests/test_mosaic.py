@@ -0,0 +1,69 @@
+'''This module tests the virtual mosaic of adjacent tiles
+of the package geo_toolkit using Pytest.
+Synthetic tiles are written to a temporary folder.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-04-27
+'''
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+import geopandas as gpd
+from shapely.geometry import box
+
+def test_load_mosaic_bands(tmp_path, load_mosaic_bands, logger):
+    """Test load_mosaic_bands() with a ROI which spans the border
+    of two adjacent tiles; a third tile outside the ROI is ignored.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        load_mosaic_bands (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    # 3 km x 3 km tiles at 10 m: T1 and T2 side by side, T3 far away
+    tiles = {"T32UPU": (700000, 100), "T32UQU": (703000, 200), "T32UQV": (750000, 300)}
+    for tile, (left, value) in tiles.items():
+        for band in ["B03", "B8A"]:
+            with rasterio.open(tmp_path / f"{tile}_20230207T101109_{band}_10m.tiff", 'w',
+                               driver='GTiff', dtype='uint16', count=1, width=300,
+                               height=300, crs='EPSG:32632',
+                               transform=from_origin(left, 5306000, 10, 10)) as dst:
+                dst.write(np.full((300, 300), value, dtype=np.uint16), 1)
+    band_paths = [str(path) for path in tmp_path.glob("*.tiff")]
+    gdf_bbox = gpd.GeoSeries([box(702000, 5303000, 704000, 5305000)], crs='EPSG:32632')
+
+    try:
+        band_arrays, band_names, profile = load_mosaic_bands(band_paths,
+                                                             gdf_bbox,
+                                                             resolution=(20, 20),
+                                                             resampling=Resampling.nearest)
+        assert band_names == ['03', '8A']
+        assert band_arrays.shape == (2, 100, 100)
+        assert profile['transform'] == from_origin(702000, 5305000, 20, 20)
+        # Left half from the first tile, right half from the second one
+        assert (band_arrays[:, :, :50] == 100).all()
+        assert (band_arrays[:, :, 50:] == 200).all()
+    except AssertionError as err:
+        logger.error("test_load_mosaic_bands: unexpected mosaic!")
+        raise err
+    logger.info("test_load_mosaic_bands: load_mosaic_bands() successfully tested.")
+
+    # Reprojected to lng/lat, a ROI inside the tiles is covered without gaps
+    gdf_bbox = gpd.GeoSeries([box(702000, 5304000, 704000, 5305000)], crs='EPSG:32632')
+    try:
+        band_arrays, _, profile = load_mosaic_bands(band_paths,
+                                                    gdf_bbox,
+                                                    resolution=(1e-4, 1e-4),
+                                                    crs='EPSG:4326')
+        assert profile['crs'] == 'EPSG:4326'
+        assert (band_arrays > 0).all()
+        assert set(np.unique(band_arrays)) <= set(range(100, 201))
+    except AssertionError as err:
+        logger.error("test_load_mosaic_bands: unexpected reprojected mosaic!")
+        raise err
+    logger.info("test_load_mosaic_bands: reprojected mosaic successfully tested.")
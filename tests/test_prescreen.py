@@ -0,0 +1,63 @@
+'''This module tests the quicklook pre-screen
+of the package geo_toolkit using Pytest.
+Synthetic bands with a lake and a cloud are written
+to a temporary folder.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-04-20
+'''
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+import geopandas as gpd
+from shapely.geometry import Point
+
+def test_prescreen_scene(tmp_path, prescreen_scene, logger):
+    """Test prescreen_scene(): a point in a clear lake passes,
+    a point under a cloud and a point on land are rejected.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        prescreen_scene (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    # 6 km x 6 km at 20 m: lake in the upper-left quarter,
+    # cloud over the upper-right quarter
+    blue = np.full((300, 300), 1200, dtype=np.uint16)
+    green = np.full((300, 300), 1000, dtype=np.uint16)
+    nir = np.full((300, 300), 2500, dtype=np.uint16)
+    green[:150, :150], nir[:150, :150] = 1500, 500
+    blue[:150, 150:], green[:150, 150:], nir[:150, 150:] = 6000, 6000, 5800
+    for band, img in [("B02", blue), ("B03", green), ("B8A", nir)]:
+        with rasterio.open(tmp_path / f"T32UQU_20230207T101109_{band}_20m.tiff", 'w',
+                           driver='GTiff', dtype='uint16', count=1, width=300,
+                           height=300, crs='EPSG:32632',
+                           transform=from_origin(700000, 5306000, 20, 20)) as dst:
+            dst.write(img, 1)
+    band_paths = sorted(str(path) for path in tmp_path.glob("*.tiff"))
+    bounds = (700000, 5300000, 706000, 5306000)
+    points = gpd.GeoDataFrame({'id': ['lake', 'cloud', 'land']},
+                              geometry=[Point(701500, 5304500),
+                                        Point(704500, 5304500),
+                                        Point(703000, 5301500)],
+                              crs='EPSG:32632')
+
+    try:
+        result = prescreen_scene(band_paths, bounds, points.iloc[:1])
+        assert result['passed']
+        assert result['points'][0]['water_fraction'] == 1.0
+        result = prescreen_scene(band_paths, bounds, points)
+        assert not result['passed']
+        assert "point cloud: cloud fraction" in result['reason']
+        assert "point land: water fraction" in result['reason']
+        result = prescreen_scene(band_paths, bounds, points, require_all=False)
+        assert result['passed']
+    except AssertionError as err:
+        logger.error("test_prescreen_scene: unexpected pre-screen results!")
+        raise err
+
+    logger.info("test_prescreen_scene: pre-screen successfully tested.")
@@ -0,0 +1,135 @@
+'''This module tests the Sentinel 2 product catalog
+of the package geo_toolkit using Pytest.
+A SAFE product and a flat folder with small synthetic
+bands are written to a temporary folder.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-05-02
+'''
+import os
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+def write_band(path, origin_x, resolution):
+    """Write a small synthetic band (GeoTIFF content, any extension)."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with rasterio.open(path, 'w', driver='GTiff', dtype='uint16', count=1,
+                       width=10, height=10, crs='EPSG:32632',
+                       transform=from_origin(origin_x, 5306000, resolution, resolution)) as dst:
+        dst.write(np.ones((10, 10), dtype=np.uint16), 1)
+
+
+def test_parse_band_filename(parse_band_filename, get_band_name, logger):
+    """Test parse_band_filename() with SAFE and flat folder names.
+
+    Args:
+        parse_band_filename (function object): function fixture.
+        get_band_name (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    try:
+        info = parse_band_filename("GRANULE/L1C_T32UQU_A039000_20230207T101109/"
+                                   "IMG_DATA/T32UQU_20230207T101109_B8A.jp2")
+        assert info["tile"] == "32UQU" and info["band"] == "8A"
+        assert info["date"] == "2023-02-07" and info["resolution"] == 20
+        info = parse_band_filename("T32UQU_20230207T101109_B03_60m.tiff")
+        assert info["band"] == "03" and info["resolution"] == 60
+        assert info["extension"] == "tiff"
+        assert parse_band_filename("T32UQU_20230207T101109_TCI_10m.jp2") is None
+        assert get_band_name("T32UQU_20230207T101109_B11.jp2") == "11"
+    except AssertionError as err:
+        logger.error("test_parse_band_filename: unexpected parsing!")
+        raise err
+    logger.info("test_parse_band_filename: band filenames successfully tested.")
+
+
+def test_product_catalog(tmp_path, build_product_catalog, query_products, logger):
+    """Test build_product_catalog() (incremental updates)
+    and query_products().
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        build_product_catalog (function object): function fixture.
+        query_products (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    safe_path = os.path.join(tmp_path, "products",
+                             "S2A_MSIL1C_20230207T101109_N0509_R022_T32UQU_20230207T121212.SAFE",
+                             "GRANULE", "L1C_T32UQU_A039000_20230207T101109", "IMG_DATA")
+    flat_path = os.path.join(tmp_path, "products", "flat")
+    for band in ["B03", "B8A"]:
+        write_band(os.path.join(safe_path, f"T32UQU_20230207T101109_{band}.jp2"), 700000, 20)
+    write_band(os.path.join(flat_path, "T32UPU_20230212T101109_B03_10m.tiff"), 600000, 10)
+    write_band(os.path.join(flat_path, "processed", "T32UPU_20230212T101109_B03_10m.tiff"),
+               600000, 10)
+    manifest_path = os.path.join(tmp_path, "catalog.json")
+    roots = [os.path.join(tmp_path, "products")]
+
+    catalog = build_product_catalog(roots, manifest_path, exclude_dirs=["processed"])
+    try:
+        assert catalog["last_update"] == {"found": 3, "read": 3, "removed": 0}
+        entry = query_products(catalog, tile="T32UQU", bands=["8A"])[0]
+        assert entry["level"] == "L1C" and entry["crs"] == "EPSG:32632"
+        assert entry["bounds"] == [700000, 5306000 - 200, 700000 + 200, 5306000]
+        assert len(query_products(catalog, start_date="2023-02-10")) == 1
+        assert len(query_products(catalog, end_date="2023-02-07")) == 2
+        west, south, east, north = entry["bounds_wgs84"]
+        assert len(query_products(catalog, bbox=(west, south, east, north))) == 2
+        assert query_products(catalog, bbox=(0, 0, 1, 1)) == []
+        assert len(query_products(catalog, path_prefix=flat_path)) == 1
+    except AssertionError as err:
+        logger.error("test_product_catalog: unexpected catalog entries!")
+        raise err
+
+    # Unchanged files are not read again; deleted files are removed
+    os.remove(os.path.join(flat_path, "T32UPU_20230212T101109_B03_10m.tiff"))
+    catalog = build_product_catalog(roots, manifest_path, exclude_dirs=["processed"])
+    try:
+        assert catalog["last_update"] == {"found": 2, "read": 0, "removed": 1}
+        assert len(catalog["entries"]) == 2
+    except AssertionError as err:
+        logger.error("test_product_catalog: unexpected incremental update!")
+        raise err
+    logger.info("test_product_catalog: product catalog successfully tested.")
+
+
+def test_finest_band_entries(tmp_path, build_product_catalog, query_products,
+                             finest_band_entries, logger):
+    """Test finest_band_entries() with an L2A SAFE product,
+    which contains bands at several resolutions.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        build_product_catalog (function object): function fixture.
+        query_products (function object): function fixture.
+        finest_band_entries (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    img_path = os.path.join(tmp_path, "products",
+                            "S2A_MSIL2A_20230207T101109_N0509_R022_T32UQU_20230207T121212.SAFE",
+                            "GRANULE", "L2A_T32UQU_A039000_20230207T101109", "IMG_DATA")
+    for band, resolution in [("B03", 10), ("B03", 20), ("B03", 60), ("B8A", 20), ("B8A", 60)]:
+        write_band(os.path.join(img_path, f"R{resolution}m",
+                                f"T32UQU_20230207T101109_{band}_{resolution}m.jp2"),
+                   700000, resolution)
+    catalog = build_product_catalog([os.path.join(tmp_path, "products")],
+                                    os.path.join(tmp_path, "catalog.json"))
+
+    entries = finest_band_entries(query_products(catalog, tile="T32UQU"))
+    try:
+        assert [(entry["band"], entry["resolution"]) for entry in entries] \
+            == [("03", 10), ("8A", 20)]
+    except AssertionError as err:
+        logger.error("test_finest_band_entries: unexpected band entries!")
+        raise err
+    logger.info("test_finest_band_entries: band entries successfully tested.")
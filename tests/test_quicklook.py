@@ -0,0 +1,87 @@
+'''This module tests the headless quicklook renderer
+of the package geo_toolkit using Pytest.
+The water mask and geometries are synthetic.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-05-01
+'''
+import numpy as np
+import rasterio
+from PIL import Image
+from rasterio.transform import from_origin
+from shapely.geometry import Point, box
+
+def test_render_quicklook(tmp_path, render_quicklook, logger):
+    """Test render_quicklook(): fixed output size for any raster
+    size, outlines and points drawn at their location and
+    a valid PNG file.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        render_quicklook (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    transform = from_origin(700000, 5306000, 10, 10)
+    mask = np.zeros((3000, 2000), dtype=np.uint8)
+    mask[1000:2000, 500:1500] = 1 # lake: 10 km x 10 km
+    lake = box(705000, 5286000, 715000, 5296000)
+    point = Point(710000, 5291000)
+    path = str(tmp_path / "quicklook.png")
+
+    try:
+        canvas = render_quicklook(mask, transform, path, polygons=[lake],
+                                  points=[point], size=(400, 300))
+        assert canvas.shape == (300, 400, 3)
+        # Scale 1/10: the lake is rows 100-200, columns 50-150, centered
+        # horizontally with an offset of (400 - 200) / 2 = 100 columns
+        assert (canvas[150, 160] == 255).all() # water
+        assert (canvas[50, 160] == 0).all() # land
+        assert tuple(canvas[100, 190]) == (255, 0, 0) # outline
+        assert tuple(canvas[150, 200]) == (0, 0, 255) # point
+        assert np.array_equal(np.asarray(Image.open(path).convert("RGB")), canvas)
+        small = render_quicklook(mask[:300, :200], transform, size=(400, 300))
+        assert small.shape == (300, 400, 3)
+        ndmap = render_quicklook(np.linspace(-1, 1, 600).reshape(20, 30), transform,
+                                 size=(400, 300), mode="ndmap")
+        assert ndmap.shape == (300, 400, 3) and ndmap.max() > 200
+    except AssertionError as err:
+        logger.error("test_render_quicklook: unexpected quicklook!")
+        raise err
+    logger.info("test_render_quicklook: render_quicklook() successfully tested.")
+
+
+def test_read_raster_overview(tmp_path, read_raster_overview, logger):
+    """Test read_raster_overview(): strip-wise reads give the same
+    overview as raster_overview() of the full raster.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        read_raster_overview (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    transform = from_origin(700000, 5306000, 10, 10)
+    mask = np.zeros((3000, 2000), dtype=np.uint8)
+    mask[1234, :] = 1 # one pixel wide channel
+    mask[2000:2999, 100:600] = 1
+    path = str(tmp_path / "mask.tiff")
+    with rasterio.open(path, 'w', driver='GTiff', dtype='uint8', count=1,
+                       width=2000, height=3000, crs='EPSG:32632',
+                       transform=transform) as dst:
+        dst.write(mask, 1)
+
+    try:
+        overview, overview_transform = read_raster_overview(path, size=(400, 300),
+                                                            strip_rows=7)
+        assert np.array_equal(overview, mask.reshape(300, 10, 200, 10).max(axis=(1, 3)))
+        assert overview_transform == from_origin(700000, 5306000, 100, 100)
+        assert overview[123].all()
+    except AssertionError as err:
+        logger.error("test_read_raster_overview: unexpected overview!")
+        raise err
+    logger.info("test_read_raster_overview: read_raster_overview() successfully tested.")
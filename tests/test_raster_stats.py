@@ -0,0 +1,125 @@
+'''This module tests the streaming raster statistics
+of the package geo_toolkit using Pytest. A synthetic
+bimodal ND map is written to a temporary folder.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-04-28
+'''
+import os
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+def test_get_raster_stats(tmp_path, get_raster_stats, otsu_threshold, logger):
+    """Test get_raster_stats() block by block against NumPy,
+    the reuse of the sidecar and the Otsu threshold.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        get_raster_stats (function object): function fixture.
+        otsu_threshold (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    # Land around -0.4, water around 0.5; nodata border
+    rng = np.random.default_rng(0)
+    ndmap = rng.normal(-0.4, 0.1, size=(150, 170)).astype(np.float32)
+    ndmap[40:100, 50:120] = rng.normal(0.5, 0.1, size=(60, 70))
+    ndmap[0, :] = -9999
+    path = str(tmp_path / "ndwi.tiff")
+    with rasterio.open(path, 'w', driver='GTiff', dtype='float32', count=1,
+                       width=170, height=150, crs='EPSG:32632', nodata=-9999,
+                       transform=from_origin(700000, 5306000, 60, 60)) as dst:
+        dst.write(ndmap, 1)
+    values = ndmap[1:].astype(np.float64)
+
+    try:
+        stats = get_raster_stats(path, block_size=64)
+        assert stats.count == values.size
+        assert np.isclose(stats.mean, values.mean())
+        assert np.isclose(stats.variance, values.var())
+        assert stats.min == values.min() and stats.max == values.max()
+        bin_width = 2.0 / stats.bins
+        assert abs(stats.percentile(50) - np.percentile(values, 50)) < 2*bin_width
+        assert abs(stats.percentile(95) - np.percentile(values, 95)) < 2*bin_width
+        assert os.path.isfile(path + ".stats.json")
+        reloaded = get_raster_stats(path)
+        assert reloaded.count == stats.count
+        assert (reloaded.histogram == stats.histogram).all()
+        threshold = otsu_threshold(stats)
+        assert -0.2 < threshold < 0.3
+    except AssertionError as err:
+        logger.error("test_get_raster_stats: unexpected statistics!")
+        raise err
+    logger.info("test_get_raster_stats: get_raster_stats() successfully tested.")
+
+
+def test_running_stats_merge(running_stats, logger):
+    """Test that merging the statistics of two halves
+    equals the statistics of the whole.
+
+    Args:
+        running_stats (class object): class fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    rng = np.random.default_rng(1)
+    values = rng.uniform(0, 5000, size=10001)
+    whole = running_stats((0, 20000), 2000).update(values)
+    merged = running_stats((0, 20000), 2000).update(values[:3000])
+    merged.merge(running_stats((0, 20000), 2000).update(values[3000:]))
+
+    try:
+        assert merged.count == whole.count
+        assert np.isclose(merged.mean, whole.mean)
+        assert np.isclose(merged.variance, whole.variance)
+        assert (merged.histogram == whole.histogram).all()
+    except AssertionError as err:
+        logger.error("test_running_stats_merge: merged statistics differ!")
+        raise err
+    logger.info("test_running_stats_merge: RunningStats.merge() successfully tested.")
+
+
+def test_ndmap_stats_nodata(tmp_path, generate_persist_ndmap, get_raster_stats,
+                            otsu_threshold, logger):
+    """Test that the zero-filled pixels of the bands (A + B = 0, e.g.,
+    the ROI corners left by the crop) are nodata in a persisted float
+    ND map and do not enter its histogram or Otsu threshold.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        generate_persist_ndmap (function object): function fixture.
+        get_raster_stats (function object): function fixture.
+        otsu_threshold (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    # Land NDWI around -0.4, water around 0.5; zero-filled corner
+    rng = np.random.default_rng(1)
+    ndwi = rng.normal(-0.4, 0.1, size=(150, 170))
+    ndwi[40:100, 50:120] = rng.normal(0.5, 0.1, size=(60, 70))
+    images = np.rint(np.stack([1000*(1 + ndwi), 1000*(1 - ndwi)])).astype(np.uint16)
+    images[:, :60, :70] = 0
+    profile = {'driver': 'GTiff', 'dtype': 'uint16', 'count': 1,
+               'width': 170, 'height': 150, 'crs': 'EPSG:32632',
+               'transform': from_origin(700000, 5306000, 60, 60)}
+    path = str(tmp_path / "ndwi.tiff")
+    generate_persist_ndmap(images, ['03', '8A'], profile, path, map_type="ndwi")
+
+    try:
+        with rasterio.open(path) as src:
+            stored = src.read(1)
+        assert (stored[:60, :70] == src.nodata).all()
+        stats = get_raster_stats(path, block_size=64)
+        assert stats.count == 150*170 - 60*70
+        assert -0.2 < otsu_threshold(stats) < 0.3
+    except AssertionError as err:
+        logger.error("test_ndmap_stats_nodata: zero-filled pixels counted as data!")
+        raise err
+    logger.info("test_ndmap_stats_nodata: nodata of the float ND maps successfully tested.")
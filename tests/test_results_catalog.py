@@ -0,0 +1,128 @@
+'''This module tests the GeoPackage results catalog
+of the package geo_toolkit using Pytest.
+The lake polygons are synthetic, so no raster data is needed.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-04-12
+'''
+import sqlite3
+
+import geopandas as gpd
+from shapely.geometry import box
+
+def test_export_query_catalog(tmp_path,
+                              export_lakes_catalog,
+                              query_catalog_bbox,
+                              query_catalog_point,
+                              logger):
+    """Test export_lakes_catalog(), query_catalog_bbox()
+    and query_catalog_point() functions.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        export_lakes_catalog (function object): function fixture.
+        query_catalog_bbox (function object): function fixture.
+        query_catalog_point (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    catalog_path = str(tmp_path / "results_catalog.gpkg")
+    # Two scenes in UTM 32N, each with two square lakes of 1 km
+    for scene, x_0 in [("scene_1", 700000), ("scene_2", 650000)]:
+        gdf_lakes = gpd.GeoDataFrame(
+            {'id': ['A', 'B'],
+             'geometry': [box(x_0, 5300000, x_0 + 1000, 5301000),
+                          box(x_0 + 5000, 5300000, x_0 + 6000, 5301000)]},
+            crs='epsg:32632')
+        export_lakes_catalog(catalog_path,
+                             gdf_lakes,
+                             scene_id=scene,
+                             scene_metadata={'tile': 'T32UQU',
+                                             'ndwi_path': f"{scene}/ndwi.tiff"})
+    # Re-exporting a scene replaces its polygons
+    export_lakes_catalog(catalog_path, gdf_lakes, scene_id="scene_2")
+
+    with sqlite3.connect(catalog_path) as conn:
+        num_lakes = conn.execute("SELECT COUNT(*) FROM lakes").fetchone()[0]
+        num_rtree = conn.execute("SELECT COUNT(*) FROM rtree_lakes_geom").fetchone()[0]
+    try:
+        assert num_lakes == 4
+        assert num_rtree == 4
+    except AssertionError as err:
+        logger.error("test_export_query_catalog: unexpected number of catalog rows!")
+        raise err
+
+    # Lake A of scene_1 in lng/lat
+    lake = gpd.GeoSeries([box(700000, 5300000, 701000, 5301000)],
+                         crs='epsg:32632').to_crs(epsg=4326).iloc[0]
+    center = lake.centroid
+    try:
+        gdf = query_catalog_point(catalog_path, center.x, center.y)
+        assert list(gdf.scene_id) == ["scene_1"]
+        assert list(gdf.lake_id) == ["A"]
+        assert gdf.ndwi_path[0] == "scene_1/ndwi.tiff"
+        gdf = query_catalog_bbox(catalog_path, [-180, -90, 180, 90])
+        assert len(gdf) == 4
+        gdf = query_catalog_bbox(catalog_path, list(lake.bounds))
+        assert len(gdf) == 1
+    except AssertionError as err:
+        logger.error("test_export_query_catalog: unexpected query results!")
+        raise err
+
+    logger.info("test_export_query_catalog: results catalog successfully tested.")
+
+
+def test_catalog_rtree_triggers(tmp_path,
+                                export_lakes_catalog,
+                                query_catalog_bbox,
+                                logger):
+    """Test that the R-tree of the results catalog is kept
+    up to date by its triggers when the lakes layer is edited
+    outside of export_lakes_catalog(), i.e., with GDAL or SQL.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        export_lakes_catalog (function object): function fixture.
+        query_catalog_bbox (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    catalog_path = str(tmp_path / "results_catalog.gpkg")
+    gdf_lakes = gpd.GeoDataFrame(
+        {'id': ['A'],
+         'geometry': [box(700000, 5300000, 701000, 5301000)]},
+        crs='epsg:32632')
+    export_lakes_catalog(catalog_path, gdf_lakes, scene_id="scene_1")
+
+    # Lake appended with GDAL (geopandas)
+    gdf_manual = gpd.GeoDataFrame(
+        {'scene_id': ['manual'],
+         'lake_id': ['C'],
+         'geom': [box(10.0, 45.0, 10.01, 45.01)]},
+        geometry='geom',
+        crs='epsg:4326')
+    gdf_manual.to_file(catalog_path, layer="lakes", mode="a", driver="GPKG")
+    try:
+        gdf = query_catalog_bbox(catalog_path, [9.9, 44.9, 10.1, 45.1])
+        assert list(gdf.lake_id) == ["C"]
+    except AssertionError as err:
+        logger.error("test_catalog_rtree_triggers: appended lake not indexed!")
+        raise err
+
+    # Lake deleted with plain SQL
+    with sqlite3.connect(catalog_path) as conn:
+        conn.execute("DELETE FROM lakes WHERE lake_id = 'A'")
+        num_rtree = conn.execute("SELECT COUNT(*) FROM rtree_lakes_geom").fetchone()[0]
+    try:
+        assert num_rtree == 1
+        gdf = query_catalog_bbox(catalog_path, [-180, -90, 180, 90])
+        assert list(gdf.lake_id) == ["C"]
+    except AssertionError as err:
+        logger.error("test_catalog_rtree_triggers: deleted lake still indexed!")
+        raise err
+
+    logger.info("test_catalog_rtree_triggers: results catalog triggers successfully tested.")
@@ -0,0 +1,90 @@
+'''This module tests the shared-memory band cube
+of the package geo_toolkit using Pytest.
+The band cube is synthetic.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-04-30
+'''
+import os
+import pickle
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import geo_toolkit as gt
+
+def test_shared_band_cube(shared_band_cube, map_blocks, logger):
+    """Test map_blocks() on a shared band cube (shared memory and
+    memory-mapped file) against the direct computation, and the
+    cleanup of the cube.
+
+    Args:
+        shared_band_cube (class object): class fixture.
+        map_blocks (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 5000, size=(3, 101, 80), dtype=np.uint16)
+    band_names = ['02', '03', '8A']
+    expected, _ = gt.compute_ndmap_mask(images, band_names, 0.1)
+
+    for backend in ["shm", "memmap"]:
+        cube = shared_band_cube.from_array(images, band_names, backend=backend)
+        try:
+            assert len(pickle.dumps(cube.descriptor)) < 1000
+            results = map_blocks(gt.compute_ndmap_mask, cube, args=(0.1,),
+                                 block_rows=30, max_workers=2)
+            assert len(results) == 4
+            mask = np.concatenate([result[0] for result in results])
+            assert np.array_equal(mask, expected)
+        except AssertionError as err:
+            logger.error("test_shared_band_cube: unexpected %s results!", backend)
+            raise err
+        finally:
+            cube.close()
+
+        # The owner removed the segment/file
+        with pytest.raises(FileNotFoundError):
+            shared_band_cube(cube.descriptor, owner=False)
+        logger.info("test_shared_band_cube: %s cube successfully tested.", backend)
+
+
+def test_stale_memmap_files(tmp_path, shared_band_cube, logger):
+    """Test that the memmap files left by crashed owners are
+    removed when a memmap cube is created in the same folder,
+    and that those of running owners are kept.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        shared_band_cube (class object): class fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    # Process id of a finished process
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    stale = tmp_path / f"geo_cube_{'0' * 16}_{process.pid}.dat"
+    stale.write_bytes(b"0")
+    running = shared_band_cube.empty((1, 2, 2), np.uint8, backend="memmap",
+                                     directory=str(tmp_path))
+
+    cube = shared_band_cube.empty((1, 2, 2), np.uint8, backend="memmap",
+                                  directory=str(tmp_path))
+    try:
+        assert not stale.exists()
+        assert os.path.isfile(running.descriptor["path"])
+        assert os.path.isfile(cube.descriptor["path"])
+    except AssertionError as err:
+        logger.error("test_stale_memmap_files: unexpected memmap files!")
+        raise err
+    finally:
+        running.close()
+        cube.close()
+    logger.info("test_stale_memmap_files: stale files successfully tested.")
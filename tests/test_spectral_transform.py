@@ -0,0 +1,83 @@
+'''This module tests the linear spectral transforms
+(tasseled cap, streaming PCA) of the package geo_toolkit
+using Pytest. The band cubes are synthetic.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-04-24
+'''
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+def test_tasseled_cap(tasseled_cap, logger):
+    """Test tasseled_cap() with a small chunk size against
+    a direct (unchunked) matrix multiplication.
+
+    Args:
+        tasseled_cap (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    rng = np.random.default_rng(0)
+    band_names = ['01', '02', '03', '04', '08', '8A', '11', '12']
+    images = rng.integers(1, 10000, size=(8, 37, 41), dtype=np.uint16)
+    images[:, 0, 0] = 0 # nodata pixel
+
+    components = tasseled_cap(images, band_names, chunk_size=100)
+    coefficients = np.array([
+        [0.3510, 0.3813, 0.3437, 0.7196, 0.2396, 0.1949],
+        [-0.3599, -0.3533, -0.4734, 0.6633, 0.0087, -0.2856],
+        [0.2578, 0.2305, 0.0883, 0.1071, -0.7611, -0.5308]])
+    expected = np.einsum('kb,bhw->khw', coefficients, images[[1, 2, 3, 5, 6, 7]] * 1e-4)
+    try:
+        assert components.dtype == np.float32
+        assert components.shape == (3, 37, 41)
+        assert np.all(components[:, 0, 0] == -9999)
+        assert np.allclose(components[:, 1:, 1:], expected[:, 1:, 1:], atol=1e-5)
+    except AssertionError as err:
+        logger.error("test_tasseled_cap: unexpected tasseled cap components!")
+        raise err
+
+    logger.info("test_tasseled_cap: tasseled cap successfully tested.")
+
+def test_fit_pca_streaming(tmp_path, fit_pca_streaming, logger):
+    """Test fit_pca_streaming() on bands written to disk:
+    the streamed PCA must match the PCA of all pixels.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        fit_pca_streaming (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    rng = np.random.default_rng(1)
+    latent = rng.normal(size=(2, 120, 120))
+    mixing = np.array([[3.0, 1.0], [2.0, -1.0], [1.0, 0.5]])
+    images = (np.einsum('bk,khw->bhw', mixing, latent) * 100 + 5000).astype(np.uint16)
+    for band, img in zip(['B03', 'B04', 'B8A'], images):
+        with rasterio.open(tmp_path / f"T32UQU_20230207T101109_{band}_10m.tiff", 'w',
+                           driver='GTiff', dtype='uint16', count=1, width=120,
+                           height=120, crs='EPSG:32632',
+                           transform=from_origin(700000, 5300000, 10, 10)) as dst:
+            dst.write(img, 1)
+    band_paths = sorted(str(path) for path in tmp_path.glob("*.tiff"))
+
+    pca, band_names = fit_pca_streaming(band_paths, n_components=2,
+                                        sample_fraction=1.0, block_size=50)
+    pixels = images.reshape(3, -1).T.astype(np.float64)
+    eigenvalues, eigenvectors = np.linalg.eigh(np.cov(pixels, rowvar=False))
+    try:
+        assert band_names == ['03', '04', '8A']
+        assert pca.count == 120*120
+        assert np.allclose(pca.mean_, pixels.mean(axis=0))
+        assert np.allclose(pca.explained_variance_, eigenvalues[::-1][:2])
+        assert np.allclose(np.abs(pca.components_), np.abs(eigenvectors[:, ::-1][:, :2].T))
+    except AssertionError as err:
+        logger.error("test_fit_pca_streaming: streamed PCA differs from full PCA!")
+        raise err
+
+    logger.info("test_fit_pca_streaming: streaming PCA successfully tested.")
@@ -0,0 +1,63 @@
+'''This module tests the streaming (block-window) water
+extraction pipeline of the package geo_toolkit using Pytest.
+Synthetic bands with different resolutions and blobs
+which span several blocks are written to a temporary folder.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-04-18
+'''
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+def test_stream_water_polygons(tmp_path, stream_water_polygons, logger):
+    """Test stream_water_polygons() with a small block size:
+    the blobs must be the same as with whole-raster processing.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        stream_water_polygons (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    # Water blobs at 20 m: a U-shaped lake (spans 6 blocks of 32 px at 10 m),
+    # a lake with an island and a single pixel
+    water = np.zeros((100, 100), dtype=bool)
+    water[10:60, 10:20] = True
+    water[10:60, 40:50] = True
+    water[50:60, 10:50] = True
+    water[70:95, 60:95] = True
+    water[80:85, 70:75] = False
+    water[5, 90] = True
+    green = np.where(water, 2000, 500).astype(np.uint16)
+    nir = np.where(water, 500, 2000).astype(np.uint16)
+    for band, img, res in [("B03", np.kron(green, np.ones((2, 2), np.uint16)), 10),
+                           ("B8A", nir, 20)]:
+        with rasterio.open(tmp_path / f"T32UQU_20230207T101109_{band}_{res}m.tiff", 'w',
+                           driver='GTiff', dtype='uint16', count=1,
+                           width=img.shape[1], height=img.shape[0], crs='EPSG:32632',
+                           transform=from_origin(700000, 5300000, res, res)) as dst:
+            dst.write(img, 1)
+    band_paths = sorted(str(path) for path in tmp_path.glob("*.tiff"))
+
+    water_geoseries, mask_path = stream_water_polygons(band_paths,
+                                                       str(tmp_path / "processed"),
+                                                       threshold=0.0,
+                                                       block_size=32)
+    with rasterio.open(mask_path) as src:
+        water_mask = src.read(1)
+    try:
+        assert water_mask.shape == (200, 200)
+        assert np.array_equal(water_mask, np.kron(water, np.ones((2, 2))))
+        assert len(water_geoseries) == 3
+        areas = sorted(water_geoseries.area / 100)
+        assert areas == sorted([4*(500 + 500 + 400 - 200), 4*(875 - 25), 4])
+        assert all(polygon.geom_type == "Polygon" for polygon in water_geoseries)
+    except AssertionError as err:
+        logger.error("test_stream_water_polygons: unexpected streaming results!")
+        raise err
+
+    logger.info("test_stream_water_polygons: streaming pipeline successfully tested.")
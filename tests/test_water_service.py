@@ -0,0 +1,146 @@
+'''This module tests the water query service
+of the package geo_toolkit using Pytest.
+A synthetic scene (3 bands, 60 m, one square lake)
+is written to a temporary folder and the service
+is queried on localhost.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-04-14
+'''
+import json
+import threading
+import urllib.request
+from urllib.error import HTTPError
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import transform as transform_coords
+
+# Upper-left corner of the synthetic scene in EPSG:32632
+ORIGIN = (700000, 5300000)
+
+def write_synthetic_scene(scene_path):
+    """Write B02, B03 and B8A bands of a 100x100 scene
+    with a 20x20 pixel lake at rows/cols 40:60.
+
+    Args:
+        scene_path (pathlib.Path): folder to write the bands to.
+
+    Returns: None.
+    """
+    green = np.full((100, 100), 1000, dtype=np.uint16)
+    nir = np.full((100, 100), 1000, dtype=np.uint16)
+    green[40:60, 40:60] = 2000
+    nir[40:60, 40:60] = 500
+    profile = {'driver': 'GTiff', 'dtype': 'uint16', 'count': 1,
+               'width': 100, 'height': 100, 'crs': 'EPSG:32632',
+               'transform': from_origin(*ORIGIN, 60, 60)}
+    for band, img in [("B02", green), ("B03", green), ("B8A", nir)]:
+        filename = scene_path / f"T32UQU_20230207T101109_{band}_60m.tiff"
+        with rasterio.open(filename, 'w', **profile) as dst:
+            dst.write(img, 1)
+
+def test_water_service(tmp_path, create_water_server, logger):
+    """Test the water query service endpoints.
+
+    Args:
+        tmp_path (pathlib.Path): pytest temporary folder.
+        create_water_server (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    write_synthetic_scene(tmp_path)
+    broken_path = tmp_path / "broken"
+    broken_path.mkdir()
+    (broken_path / "T32UQU_20230207T101109_B03_60m.tiff").write_bytes(b"not a raster")
+    server = create_water_server({"scene": str(tmp_path), "broken": str(broken_path)},
+                                 port=0, preload=True, cache_capacity=1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    # Lake center and scene bbox in lng/lat
+    lons, lats = transform_coords("EPSG:32632", "EPSG:4326",
+                                  [ORIGIN[0] + 50*60, ORIGIN[0], ORIGIN[0] + 6000],
+                                  [ORIGIN[1] - 50*60, ORIGIN[1] - 6000, ORIGIN[1]])
+    try:
+        with urllib.request.urlopen(f"{url}/polygon?scene=scene&lon={lons[0]}"
+                                    f"&lat={lats[0]}&threshold=0.3") as response:
+            result = json.load(response)["result"]
+        assert result["properties"]["pixel_count"] == 400
+        assert result["geometry"]["type"] == "Polygon"
+        bbox = f"{min(lons)},{min(lats)},{max(lons)},{max(lats)}"
+        with urllib.request.urlopen(f"{url}/mask?scene=scene&bbox={bbox}"
+                                    "&threshold=0.3") as response:
+            result = json.load(response)["result"]
+        assert result["water_pixels"] == 400
+        # Cached bytes estimated from the band headers
+        cache = server.scene_cache
+        assert cache.estimate_nbytes(str(tmp_path)) == cache.nbytes()
+        # Unknown scene
+        with pytest.raises(HTTPError) as err:
+            urllib.request.urlopen(f"{url}/polygon?scene=other&lon=0&lat=0")
+        assert err.value.code == 400
+        # Band files which cannot be read
+        with pytest.raises(HTTPError) as err:
+            urllib.request.urlopen(f"{url}/polygon?scene=broken&lon=0&lat=0")
+        assert err.value.code == 500
+        assert "error" in json.load(err.value)
+    except AssertionError as err:
+        logger.error("test_water_service: unexpected query results!")
+        raise err
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    logger.info("test_water_service: water service successfully tested.")
+
+
+def test_scene_cache(scene_cache, logger):
+    """Test that SceneCache serves cached scenes while
+    another scene is being loaded, and loads a scene once
+    for concurrent requests.
+
+    Args:
+        scene_cache (class object): class fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    cache = scene_cache({"fast": "fast", "slow": "slow"}, capacity=2)
+    release = threading.Event()
+    loads = []
+
+    def load(scene_id):
+        loads.append(scene_id)
+        if scene_id == "slow":
+            release.wait(timeout=10)
+        return {"bands": np.zeros((1, 2, 2))}
+
+    cache._load = load # pylint: disable=protected-access
+    cache.get("fast")
+    loaders = [threading.Thread(target=cache.get, args=("slow",)) for _ in range(2)]
+    for loader in loaders:
+        loader.start()
+    try:
+        # The slow scene is loading: the cached scene is served
+        fast_done = threading.Event()
+        threading.Thread(target=lambda: (cache.get("fast"), fast_done.set())).start()
+        assert fast_done.wait(timeout=5)
+        assert not release.is_set()
+        release.set()
+        for loader in loaders:
+            loader.join(timeout=10)
+        assert loads == ["fast", "slow"]
+        assert cache.loaded() == ["fast", "slow"]
+    except AssertionError as err:
+        logger.error("test_scene_cache: unexpected cache behavior!")
+        raise err
+    finally:
+        release.set()
+
+    logger.info("test_scene_cache: scene cache successfully tested.")
@@ -0,0 +1,58 @@
+'''This module tests the vectorized zonal statistics
+of the package geo_toolkit using Pytest.
+The statistics of a synthetic label image are compared
+with the polygons vectorized from it and with a
+per-component (masked) computation.
+The present testing module uses the fixtures defined in
+conftest.py.
+
+Author: Mikel Sagardia
+Date: 2023-05-03
+'''
+import numpy as np
+from rasterio.transform import from_origin
+
+def test_zonal_statistics(label_water_mask, vectorize_labels, zonal_statistics, logger):
+    """Test zonal_statistics(): area and perimeter equal to those
+    of the vectorized polygons (holes included), and index
+    statistics equal to a per-component computation.
+
+    Args:
+        label_water_mask (function object): function fixture.
+        vectorize_labels (function object): function fixture.
+        zonal_statistics (function object): function fixture.
+        logger (object): logger fixture.
+
+    Returns: None.
+    """
+    rng = np.random.default_rng(0)
+    water_mask = np.zeros((60, 80), dtype=np.uint8)
+    water_mask[5:25, 5:30] = 1
+    water_mask[10:15, 10:15] = 0 # hole
+    water_mask[30:60, 50:80] = 1 # touches the border
+    water_mask[40, 10] = 1 # single pixel
+    ndwi = rng.uniform(-1, 1, size=water_mask.shape)
+    ndvi = np.round(rng.uniform(-1, 1, size=water_mask.shape) * 10000).astype(np.int16)
+    ndvi[35, 60] = -32768 # nodata of compact maps
+    transform = from_origin(700000, 5306000, 60, 60)
+
+    labels, n_labels = label_water_mask(water_mask)
+    polygons = vectorize_labels(labels, transform)
+    stats = zonal_statistics(labels, {'ndwi': ndwi, 'ndvi': ndvi}, transform)
+    try:
+        assert n_labels == 3 and len(stats) == 3 and len(polygons) == 3
+        assert np.allclose(stats.loc[polygons.index, 'area'], polygons.area)
+        assert np.allclose(stats.loc[polygons.index, 'perimeter'], polygons.length)
+        for label in range(1, n_labels + 1):
+            zone = labels == label
+            assert stats.loc[label, 'pixel_count'] == zone.sum()
+            assert np.isclose(stats.loc[label, 'ndwi_mean'], ndwi[zone].mean())
+            assert np.isclose(stats.loc[label, 'ndwi_min'], ndwi[zone].min())
+            assert np.isclose(stats.loc[label, 'ndwi_max'], ndwi[zone].max())
+            values = ndvi[zone & (ndvi != -32768)] / 10000
+            assert np.isclose(stats.loc[label, 'ndvi_mean'], values.mean())
+            assert np.isclose(stats.loc[label, 'ndvi_min'], values.min())
+    except AssertionError as err:
+        logger.error("test_zonal_statistics: unexpected zonal statistics!")
+        raise err
+    logger.info("test_zonal_statistics: zonal_statistics() successfully tested.")
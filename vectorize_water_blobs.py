@@ -8,26 +8,51 @@ Author: Mikel Sagardia
 Date: 2023-03-27
 """
 import os
-from glob import glob
+import sys
+import math
 
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-import matplotlib.pyplot as plt
-
-import rasterio
-import rasterio.plot
-from rasterio.features import shapes
 
 from shapely.geometry import box
-from shapely.geometry import shape
 
 from geo_toolkit import (
     logger,
     resample_bands,
     crop_bands,
     load_bands,
-    generate_persist_ndmap
+    generate_persist_ndmap,
+    persist_ndmap,
+    select_nd_bands,
+    load_ndmap,
+    threshold_ndmap,
+    compute_ndmap_mask,
+    export_lakes_catalog,
+    stream_water_polygons,
+    prescreen_scene,
+    clean_water_mask,
+    TASSELED_CAP_S2,
+    tasseled_cap,
+    persist_components,
+    load_classifier,
+    predict_raster,
+    persist_probability,
+    load_mosaic_bands,
+    get_raster_stats,
+    otsu_threshold,
+    render_quicklook,
+    read_raster_overview,
+    compute_ndvi,
+    label_water_mask,
+    vectorize_labels,
+    zonal_statistics,
+    attach_zonal_stats,
+    build_product_catalog,
+    query_products,
+    finest_band_entries,
+    MemoryBudget,
+    contour_polygons
 )
 
 if __name__ == '__main__':
@@ -43,6 +68,75 @@ if __name__ == '__main__':
     SCENE_1_PATH = DATA_PATH + "scene_1"
     SCENE_2_PATH = DATA_PATH + "scene_2"
     OUTPUT_FOLDER = "processed"
+    # GeoPackage with the lake polygons of all processed scenes
+    CATALOG_PATH = DATA_PATH + "results_catalog.gpkg"
+    # JSON manifest of the band files (tile, date, band, CRS, bounds)
+    PRODUCT_CATALOG_PATH = DATA_PATH + "product_catalog.json"
+    # Store ND maps as int16 scaled by 10000 instead of float32
+    COMPACT_NDMAPS = False
+    # NDWI value above which a pixel is water
+    NDMAP_THRESHOLD = 0.0
+    # Use the Otsu threshold of the ND map histogram (stats sidecar) instead
+    AUTO_THRESHOLD = False
+    # Compute the water mask straight from the bands (fused kernel)
+    # instead of reloading and thresholding ndwi.tiff; the NDWI of the
+    # kernel is persisted if PERSIST_NDMAPS
+    FUSED_MASK = True
+    # Persist the float/compact ND maps; forced (with a warning) when the
+    # fused kernel is not used (not FUSED_MASK, AUTO_THRESHOLD or a classifier),
+    # since step 3 then reloads ndwi.tiff (or its statistics)
+    PERSIST_NDMAPS = True
+    # Process the bands block by block at full resolution (bounded memory)
+    STREAMING = False
+    BLOCK_SIZE = None # None: from the memory budget
+    # Memory limit, e.g., "4G" or "50%"; None: GEO_TOOLKIT_MEMORY_BUDGET
+    # or half of the available memory. Steps 1-3 switch to STREAMING
+    # if the scene does not fit in it
+    MEMORY_BUDGET = None
+    # Report the observed peak memory of every step (tracemalloc, slower)
+    TRACE_MEMORY = False
+    # Overlap band reads, processing and writes (network storage)
+    PIPELINED_IO = False
+    # Folders of adjacent tiles of the same date, if the ROI spans
+    # tile borders; the ROI is then loaded as a virtual mosaic
+    MOSAIC_PATHS = []
+    # Persist the tasseled cap components (alternative to the NDWI)
+    TASSELED_CAP = False
+    # Per-pixel classifier (joblib or ONNX) used instead of the NDWI;
+    # None to threshold the NDWI
+    CLASSIFIER_PATH = None
+    CLASSIFIER_FEATURES = ['02', '03', '04', '8A', '11', '12', 'ndwi', 'ndvi']
+    CLASSIFIER_THRESHOLD = 0.5
+    # Pixels per classifier batch which sizes the number of threads
+    CLASSIFIER_BATCH_SIZE = 65536
+    # Water polygons: "pixel" (pixel edges of the mask) or "contour"
+    # (sub-pixel contours of the ND map, simplified to CONTOUR_TOLERANCE m)
+    VECTORIZER = "pixel"
+    CONTOUR_TOLERANCE = 30
+    # Per-lake area, perimeter and NDWI/NDVI statistics (not when STREAMING)
+    ZONAL_STATS = True
+    # Mask cleaning before vectorization; areas in m^2
+    MASK_CLEANING = {
+        'opening_iterations': 1,
+        'closing_iterations': 1,
+        'max_hole_area': 20000,
+        'min_area': 20000
+    }
+    # Skip the scene if a coarse quicklook shows no usable water signal;
+    # off by default: the target points of scene 2 lie outside the
+    # detected water (step 4 takes the closest polygon)
+    PRESCREEN = False
+    PRESCREEN_CRITERIA = {
+        'resolution': 160, # quicklook pixel size (m)
+        'radius': 500, # disc around each target point (m)
+        'ndwi_threshold': 0.0,
+        'cloud_threshold': 2500, # B02 digital number
+        'min_water_fraction': 0.5,
+        'max_cloud_fraction': 0.3,
+        'require_all': False # at least one target point must pass
+    }
+    # Exit code of a scene rejected by the pre-screen (not processed)
+    PRESCREEN_EXIT_CODE = 2
 
     # Lng/Lat format in EPSG:4326
     SCENE_1_BBOX = [12.276740855204856, 47.76998650888808, 12.830008478699462, 48.06602436853697]
@@ -65,130 +159,310 @@ if __name__ == '__main__':
     # Load points of interest, target (GeoJSON)
     gdf_points = gpd.read_file(os.path.join(SCENE_PATH, 'lakes.geojson'))
 
-    # Load band filenames
-    band_paths = glob(os.path.join(SCENE_PATH, "*B?*.jp2"))
-    band_paths.sort()
-
-    # Load raster src to get CRS
-    with rasterio.open(band_paths[0]) as src:
-        band_crs = src.crs
+    # Load band filenames and CRS from the product catalog;
+    # only new or modified band files are opened
+    scene_roots = [SCENE_PATH] + MOSAIC_PATHS
+    product_catalog = build_product_catalog(scene_roots,
+                                            PRODUCT_CATALOG_PATH,
+                                            exclude_dirs=[OUTPUT_FOLDER])
+    # One file per band: L2A products contain bands at several resolutions
+    band_entries = finest_band_entries([entry for entry in query_products(product_catalog,
+                                                                          path_prefix=SCENE_PATH)
+                                        if entry['extension'] == "jp2"])
+    band_paths = [entry['path'] for entry in band_entries]
+    band_crs = band_entries[0]['crs']
 
     # Transform all data to the same CRS
-    gdf_points = gdf_points.to_crs(src.crs)
-    gdf_bbox = gdf_bbox.to_crs(src.crs)
-
-    ## -- Step 1: Resample, Crop and Persist Rasters
-
-    resample_bands(band_paths,
-                   resolution=(60,60),
-                   output_folder=OUTPUT_FOLDER)
-
-    # Modified scene path, after resampling
-    #scene_path_ = SCENE_PATH # Use un-resampled files
-    scene_path_ = os.path.join(SCENE_PATH, OUTPUT_FOLDER)
-
-    # Re-load band filenames, after resampling
-    band_paths = glob(os.path.join(scene_path_, "*B?*.jp2"))
-    band_paths.sort()
-
-    crop_bands(band_paths,
-               gdf_bbox,
-               output_folder=".") # Re-write the resampled files
-               #output_folder=OUTPUT_FOLDER) # Using un-resampled files
-
-    band_arrays, band_names, profile = load_bands(scene_path_)
-
-    ## -- Step 2: Compute the NDVI and the NDWI Maps
-
-    maps = ["ndvi", "ndwi"]
-    for ndi in maps:
-        output_path = os.path.join(SCENE_PATH, OUTPUT_FOLDER, ndi+".tiff")
-        ndmap, ndmap_profile = generate_persist_ndmap(band_arrays,
-                                                    band_names,
-                                                    profile,
-                                                    output_path,
-                                                    map_type=ndi)
-
-    ## -- Step 3: Extract Water Shapes
-
-    # Load ND-map raster file
-    filename = "ndwi.tiff"
-    ndmap_filepath = os.path.join(SCENE_PATH, OUTPUT_FOLDER, filename)
-
-    try:
-        with rasterio.open(ndmap_filepath) as ndmap_src:
-            ndmap = ndmap_src.read(1)
-            ndmap_transform = ndmap_src.transform
-            ndmap_crs = ndmap_src.crs
-    except FileNotFoundError as err:
-        logger.error("main: ndmap_filepath does not exist: %s",
-                     ndmap_filepath)
-        raise err
-
-    # Compute mask (thresholding)
-    ndmap_threshold = 0.3
-    value_mask = 1
-    water_mask = np.where(ndmap > ndmap_threshold,
-                            abs(value_mask-1),
-                            value_mask)
-    logger.info("main: index map correctly masked.")
-
-    # Generate polygons from water bodies
-    water_polygons = []
-    for single_water_mask, value in shapes(water_mask.astype(dtype='int16'),
-                                           transform=ndmap_transform):
-        if value == value_mask:
-            water_polygons.append(shape(single_water_mask))
-    logger.info("main: %s water polygons extracted.", str(len(water_polygons)))
-
-    try:
-        assert len(water_polygons) > 0
-    except AssertionError as err:
-        logger.warning("main: water_polygons is empty!")
-        #raise err
-
-    # Convert water polygons to geoseries
-    water_geoseries = gpd.GeoSeries(water_polygons, crs=ndmap_crs)
+    gdf_points = gdf_points.to_crs(band_crs)
+    gdf_bbox = gdf_bbox.to_crs(band_crs)
+
+    # Plan the memory of steps 1-3 for the ROI at 60 m
+    budget = MemoryBudget.from_config(limit=MEMORY_BUDGET, trace=TRACE_MEMORY)
+    minx, miny, maxx, maxy = gdf_bbox.total_bounds
+    memory_plan = budget.plan_scene((math.ceil((maxy - miny) / 60), math.ceil((maxx - minx) / 60)),
+                                    band_count=len(band_paths),
+                                    dtype=band_entries[0]['dtype'])
+    if not memory_plan['in_memory'] and not STREAMING:
+        if MOSAIC_PATHS:
+            logger.warning("main: the mosaic ROI exceeds the memory budget; "
+                           "it cannot be streamed.")
+        else:
+            logger.warning("main: the scene exceeds the memory budget; streaming it.")
+            STREAMING = True
+    block_size = BLOCK_SIZE or memory_plan['block_size']
+
+    ## -- Step 0: Quicklook Pre-Screen
+
+    if PRESCREEN:
+        budget.start_stage("step_0_prescreen")
+        prescreen = prescreen_scene(band_paths,
+                                    tuple(gdf_bbox.total_bounds),
+                                    gdf_points,
+                                    **PRESCREEN_CRITERIA)
+        if not prescreen['passed']:
+            logger.warning("main: scene %s rejected by the pre-screen, not processed: %s",
+                           SCENE, prescreen['reason'])
+            sys.exit(PRESCREEN_EXIT_CODE)
+
+    ndmap_threshold = NDMAP_THRESHOLD
+
+    if STREAMING:
+
+        ## -- Steps 1-3 (streaming): full resolution, block by block
+        budget.start_stage("steps_1_3_streaming")
+
+        # Mask and labels are written window by window; blobs
+        # spanning several blocks are merged before vectorization
+        water_geoseries, water_mask_path = stream_water_polygons(
+            band_paths,
+            os.path.join(SCENE_PATH, OUTPUT_FOLDER),
+            threshold=ndmap_threshold,
+            block_size=block_size,
+            bounds=tuple(gdf_bbox.total_bounds))
+        # No ND map is persisted when streaming
+        persisted_paths = {}
+        # Only a decimated overview of the mask is read, for the quicklook
+        water_mask, ndmap_transform = read_raster_overview(water_mask_path)
+        ndmap_crs = water_geoseries.crs
+
+    else:
+
+        ## -- Step 1: Resample, Crop and Persist Rasters
+        budget.start_stage("step_1_load", memory_plan['planned_bytes'])
+
+        if MOSAIC_PATHS:
+            # Reproject and read only the ROI windows of each tile; no rasters persisted
+            for tile_path in MOSAIC_PATHS:
+                tile_entries = [entry for entry in query_products(product_catalog,
+                                                                  path_prefix=tile_path)
+                                if entry['extension'] == "jp2"]
+                band_paths += [entry['path'] for entry in finest_band_entries(tile_entries)]
+            band_arrays, band_names, profile = load_mosaic_bands(band_paths,
+                                                                 gdf_bbox,
+                                                                 resolution=(60,60))
+            os.makedirs(os.path.join(SCENE_PATH, OUTPUT_FOLDER), exist_ok=True)
+        else:
+            # Bands in flight: full native bands when resampling,
+            # ROI bands (memory plan) when cropping and loading
+            native_bytes = max(entry['width'] * entry['height'] * np.dtype(entry['dtype']).itemsize
+                               for entry in band_entries)
+            # Paths of the resampled bands, in the order of the catalog entries
+            band_paths = resample_bands(band_paths,
+                                        resolution=(60,60),
+                                        output_folder=OUTPUT_FOLDER,
+                                        pipelined=PIPELINED_IO,
+                                        read_ahead=budget.concurrency(native_bytes, share=0.5))
+
+            # Modified scene path, after resampling
+            #scene_path_ = SCENE_PATH # Use un-resampled files
+            scene_path_ = os.path.dirname(band_paths[0])
+
+            crop_bands(band_paths,
+                       gdf_bbox,
+                       output_folder=".", # Re-write the resampled files
+                       pipelined=PIPELINED_IO,
+                       read_ahead=memory_plan['workers'])
+                       #output_folder=OUTPUT_FOLDER) # Using un-resampled files
+
+            band_arrays, band_names, profile = load_bands(scene_path_,
+                                                          pipelined=PIPELINED_IO,
+                                                          read_ahead=memory_plan['workers'])
+
+        ## -- Step 2: Compute the NDVI and the NDWI Maps
+        budget.start_stage("step_2_ndmaps")
+
+        # The fused kernel of step 3 returns the NDWI with the mask
+        fused_mask = FUSED_MASK and CLASSIFIER_PATH is None and not AUTO_THRESHOLD
+        if not fused_mask and not PERSIST_NDMAPS:
+            logger.warning("main: the ND maps are persisted, since step 3 "
+                           "reloads ndwi.tiff without the fused kernel.")
+            PERSIST_NDMAPS = True
+        maps = []
+        if PERSIST_NDMAPS:
+            maps = ["ndvi"] if fused_mask else ["ndvi", "ndwi"]
+        # Index maps kept in memory for the zonal statistics of step 4
+        index_maps = {}
+        # ND maps written in this run (recorded in the results catalog)
+        persisted_paths = {}
+        for ndi in maps:
+            output_path = os.path.join(SCENE_PATH, OUTPUT_FOLDER, ndi+".tiff")
+            ndmap, ndmap_profile = generate_persist_ndmap(band_arrays,
+                                                        band_names,
+                                                        profile,
+                                                        output_path,
+                                                        map_type=ndi,
+                                                        compact=COMPACT_NDMAPS)
+            index_maps[ndi] = ndmap
+            persisted_paths[ndi] = output_path
+
+        if TASSELED_CAP:
+            components = tasseled_cap(band_arrays, band_names)
+            persist_components(components,
+                               TASSELED_CAP_S2['components'],
+                               profile,
+                               os.path.join(SCENE_PATH, OUTPUT_FOLDER),
+                               prefix="tc_")
+
+        if CLASSIFIER_PATH is not None:
+            model, feature_names = load_classifier(CLASSIFIER_PATH)
+            features = feature_names or CLASSIFIER_FEATURES
+            # float32 features and float64 probabilities per pixel; as many
+            # threads as default-size batches fit in a quarter of the budget
+            bytes_per_pixel = 4 * len(features) + 16
+            n_jobs = budget.concurrency(bytes_per_pixel * CLASSIFIER_BATCH_SIZE, share=0.25)
+            probability, _ = predict_raster(model,
+                                            band_arrays,
+                                            band_names,
+                                            features,
+                                            batch_size=budget.chunk_size(bytes_per_pixel,
+                                                                         concurrency=n_jobs),
+                                            n_jobs=n_jobs)
+            persisted_paths['probability'] = os.path.join(SCENE_PATH, OUTPUT_FOLDER,
+                                                          "water_probability.tiff")
+            persist_probability(probability,
+                                profile,
+                                persisted_paths['probability'])
+            ndmap_threshold = CLASSIFIER_THRESHOLD
+
+        ## -- Step 3: Extract Water Shapes
+        budget.start_stage("step_3_water_shapes")
+
+        # Load ND-map (or water probability) raster file
+        filename = "ndwi.tiff" if CLASSIFIER_PATH is None else "water_probability.tiff"
+        ndmap_filepath = os.path.join(SCENE_PATH, OUTPUT_FOLDER, filename)
+
+        value_mask = 1
+        if fused_mask:
+            # The NDWI is computed once (float32) and only if it is persisted
+            # or used later (contours, statistics); the map is not reloaded
+            return_ndmap = PERSIST_NDMAPS or ZONAL_STATS or VECTORIZER == "contour"
+            water_mask, ndmap = compute_ndmap_mask(band_arrays,
+                                                   band_names,
+                                                   ndmap_threshold,
+                                                   map_type="ndwi",
+                                                   return_ndmap=return_ndmap,
+                                                   chunk_size=memory_plan['chunk_size'])
+            if PERSIST_NDMAPS:
+                green, nir = select_nd_bands(band_arrays, band_names, map_type="ndwi")
+                ndmap, ndmap_profile = persist_ndmap(ndmap,
+                                                     profile,
+                                                     ndmap_filepath,
+                                                     compact=COMPACT_NDMAPS,
+                                                     nodata_mask=(green == 0) & (nir == 0))
+                persisted_paths['ndwi'] = ndmap_filepath
+            ndmap_transform = profile['transform']
+            ndmap_crs = profile['crs']
+            index_maps['ndwi'] = ndmap
+            logger.info("main: water mask computed from the bands.")
+        else:
+            try:
+                ndmap, ndmap_profile = load_ndmap(ndmap_filepath)
+                ndmap_transform = ndmap_profile['transform']
+                ndmap_crs = ndmap_profile['crs']
+            except FileNotFoundError as err:
+                logger.error("main: ndmap_filepath does not exist: %s",
+                             ndmap_filepath)
+                raise err
+
+            if AUTO_THRESHOLD and CLASSIFIER_PATH is None:
+                # Histogram from the sidecar ndwi.tiff.stats.json (computed once)
+                ndmap_threshold = otsu_threshold(get_raster_stats(ndmap_filepath))
+
+            # Compute mask (thresholding): water pixels are value_mask
+            # Compact (int16) maps are thresholded in integer space
+            water_mask = threshold_ndmap(ndmap, ndmap_threshold)
+            logger.info("main: index map correctly masked.")
+
+        # Remove speckle, small holes and small blobs
+        water_mask = clean_water_mask(water_mask,
+                                      pixel_area=abs(ndmap_transform.a*ndmap_transform.e),
+                                      **MASK_CLEANING)
+
+        # Generate polygons from water bodies: one per connected
+        # component, indexed by its label (reused for the zonal statistics)
+        water_labels, n_labels = label_water_mask(water_mask == value_mask)
+        if VECTORIZER == "contour":
+            # Sub-pixel shorelines on the continuous map, following the cleaned mask
+            water_geoseries = contour_polygons(ndmap,
+                                               ndmap_threshold,
+                                               ndmap_transform,
+                                               mask=water_mask == value_mask,
+                                               simplify_tolerance=CONTOUR_TOLERANCE,
+                                               labels=water_labels,
+                                               crs=ndmap_crs)
+        else:
+            water_geoseries = vectorize_labels(water_labels, ndmap_transform, crs=ndmap_crs)
+        logger.info("main: %s water polygons extracted.", str(len(water_geoseries)))
+
+        try:
+            assert len(water_geoseries) > 0
+        except AssertionError as err:
+            logger.warning("main: water_polygons is empty!")
+            #raise err
 
     ## -- Step 4: Identify Lake Polygons
+    budget.start_stage("step_4_lakes")
 
     # Filter water body polygons:
     # take the ones which contain or are closest to the target points.
     ids = []
     polygons = []
+    labels = []
     for i, point in gdf_points.iterrows():
         ids.append(point.id)
         if SCENE == 1:
             mask = water_geoseries.contains(point.geometry)
             polygons.append(water_geoseries[mask].values[0])
+            labels.append(water_geoseries[mask].index[0])
         elif SCENE == 2:
             dist = water_geoseries.distance(point.geometry)
             closest = dist.argmin()
-            polygons.append(water_geoseries.loc[closest])
+            polygons.append(water_geoseries.iloc[closest])
+            labels.append(water_geoseries.index[closest])
 
     # Assemble GeoDataFrame and save it
-    gdf_lakes = gpd.GeoDataFrame({'id': ids, 'geometry': polygons}, crs = ndmap_crs)
+    gdf_lakes = gpd.GeoDataFrame({'id': ids, 'label': labels, 'geometry': polygons},
+                                 crs = ndmap_crs)
+
+    if ZONAL_STATS and not STREAMING:
+        # Area, perimeter and NDWI/NDVI statistics of all the water
+        # components from the label image, attached to the lakes;
+        # the maps of steps 2-3 are reused (NDVI computed if not persisted)
+        if 'ndvi' not in index_maps:
+            index_maps['ndvi'] = compute_ndvi(band_arrays, band_names, compact=True)
+        zone_stats = zonal_statistics(water_labels, index_maps, ndmap_transform, n_labels)
+        gdf_lakes = attach_zonal_stats(gdf_lakes, zone_stats)
     gdf_filename = os.path.join(SCENE_PATH,
                                 OUTPUT_FOLDER,
                                 f"scene_{SCENE}_lake_polygons.geojson")
     gdf_lakes.to_file(gdf_filename, driver='GeoJSON')
     logger.info("main: lake polygons identified and saved: %s.", gdf_filename)
 
-    # Plot the final result:
-    # masked raster + select water polygons + original target points
-    fig, ax = plt.subplots(figsize=(7, 7))
-    rasterio.plot.show(water_mask,
-                       transform=ndmap_transform,
-                       ax=ax,
-                       cmap='gray')
-    gdf_lakes.plot(ax=ax,
-                   alpha=0.75,
-                   facecolor='none',
-                   edgecolor='red',
-                   linewidth=2) # 10
-    gdf_points.plot(ax=ax, markersize=30, color='blue')
-    plt.title(f"Scene {SCENE}: Identified lake polygons + points")
-
+    # Add lake polygons to the cross-scene results catalog
+    tile = "T" + band_entries[0]['tile']
+    sensing_date = band_entries[0]['datetime']
+    export_lakes_catalog(CATALOG_PATH,
+                         gdf_lakes,
+                         scene_id=f"scene_{SCENE}",
+                         scene_metadata={
+                             'tile': tile,
+                             'sensing_date': sensing_date,
+                             'band_paths': band_paths,
+                             'ndvi_path': persisted_paths.get('ndvi'),
+                             'ndwi_path': persisted_paths.get('ndwi'),
+                             'probability_path': persisted_paths.get('probability'),
+                             'water_mask_path': water_mask_path if STREAMING else None,
+                             'ndmap_threshold': ndmap_threshold
+                         })
+
+    # Quicklook of the final result (headless, fixed size):
+    # water mask + selected water polygons + original target points
     plot_filename = os.path.join(SCENE_PATH, OUTPUT_FOLDER, f"scene_{SCENE}_lake_polygons.png")
-    plt.savefig(plot_filename,dpi=200,transparent=False,bbox_inches='tight')
-    plt.show()
+    render_quicklook(water_mask,
+                     ndmap_transform,
+                     plot_filename,
+                     polygons=gdf_lakes.geometry,
+                     points=gdf_points.geometry)
+
+    # Planned vs. observed peak memory of every step
+    budget.report()